@@ -0,0 +1,397 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid as uuid_lib
+
+from aiohttp import web, ClientSession, ClientTimeout
+from dotenv import load_dotenv
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.messages import HumanMessage
+
+from dataset import first_prompt, second_prompt, trend_prompt
+from tools.accounting import check_budget, estimate_prompt_tokens
+from tools.async_utils import fetch_json_async, fetch_user_data_async
+from tools.chat import billing_cycle_rows, build_first_query
+from tools.cohort import peer_comparison
+from tools.drivers import driver_fast_path
+from tools.followup_cache import get_followup_cache, pair_key
+from tools.llm import get_chat_model
+from tools.endpoints import get_endpoint_selector
+from tools.env_config import env_properties_dict
+from tools.metrics import span, record_llm_usage, configure_metrics_from_env
+from tools.preprocessing import preprocess
+from tools.routing import route_chain
+from tools.structured import structured_output_enabled, astructured_first_answer, first_prompt_tokens
+from tools.trend import aexplain_trend, build_trend_query
+from tools.user_store import get_user_store
+from tools.utils import replace_braces, calculate_difference, location_url, HISTORY_WINDOW
+
+# Load environment variables
+load_dotenv()
+
+# Sessions that have not been used for this many seconds are dropped
+SESSION_TTL_SECONDS = int(os.getenv("BILL_ANALYZER_SESSION_TTL", "3600"))
+
+CYCLE_FIELDS = ["id", "start_date", "end_date", "consumption", "cost", "vacation_days", "rate_plan", "itemization"]
+
+
+class AnalysisSession:
+    """
+    The chat history of one analyst working on one user, and its reference to the user data shared by all
+    sessions (see tools/user_store.py). The reference is released when the session is closed or expires.
+    """
+    def __init__(self, session_id, uuid, env, user_data):
+        self.session_id = session_id
+        self.uuid = uuid
+        self.env = env
+        self.user_data = user_data
+        processed_data = user_data.value
+        self.cycles = processed_data.get("usageChartDataList", [])[-15:-2]  #Fetching last 13 BCs excluding the 2 recent ones
+        self.location = processed_data["location"]
+        self.history = InMemoryChatMessageHistory()
+        self.comparison = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+    def trace_tags(self):
+        return {"uuid": self.uuid, "env": self.env, "session": self.session_id}
+
+
+class UserLoadError(Exception):
+    """
+    Raised while loading a user, with the status and message of the error response.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def json_error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+
+async def read_json(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+def get_session(request):
+    session = request.app["sessions"].get(request.match_info["session_id"])
+    if session is not None:
+        session.last_used = time.monotonic()
+    return session
+
+
+async def load_user(request):
+    """
+    POST /sessions
+
+    Loads a user either from the Bidgely API ({"env", "access_token", "uuid"}) or from uploaded
+    payloads ({"itemization", "metadata", "vacation"}) and opens an analysis session for it.
+    """
+    body = await read_json(request)
+    if body is None:
+        return json_error(400, "Expected a JSON object.")
+
+    session_id = uuid_lib.uuid4().hex
+    uuid, env, access_token = body.get("uuid"), body.get("env"), body.get("access_token")
+    trace_tags = {"uuid": uuid, "env": env, "session": session_id}
+
+    async def load(payloads):
+        # preprocess is CPU bound, so keep it off the event loop
+        with span("preprocess", **trace_tags):
+            processed_data = await asyncio.get_running_loop().run_in_executor(None, preprocess, *payloads, True)
+        if isinstance(processed_data, str):
+            raise UserLoadError(422, f"Error in preprocessing data: {processed_data}")
+        return processed_data
+
+    async def fetch_and_load():
+        with span("fetch", **trace_tags):
+            # Sent to the faster healthy host of the environment, hedged to the other one (see tools/endpoints.py)
+            payloads = await get_endpoint_selector(env).acall(
+                lambda env_url: fetch_user_data_async(request.app["http"], uuid, env_url, access_token, raise_host_errors=True)
+            )
+        if payloads is None or any(payload is None for payload in payloads):
+            raise UserLoadError(502, "Failed to fetch the user data.")
+        return await load(payloads)
+
+    async def authorize():
+        # A user loaded with another access token is only shared once this token can read it too
+        location = await get_endpoint_selector(env).acall(
+            lambda env_url: fetch_json_async(request.app["http"], location_url(uuid, env_url, access_token), raise_host_errors=True)
+        )
+        return location is not None
+
+    # Sessions opening the same user share one copy of its data, and one fetch while it is being loaded
+    try:
+        if uuid:
+            if env not in env_properties_dict or not access_token:
+                return json_error(400, "'env' must be a known environment and 'access_token' is required.")
+            user_data = await get_user_store().aacquire(("api", env, uuid, HISTORY_WINDOW), fetch_and_load, access_token, authorize)
+        elif all(body.get(name) for name in ("itemization", "metadata", "vacation")):
+            payloads = (body["itemization"], body["metadata"], body["vacation"])
+            upload_key = hashlib.sha1(json.dumps(payloads, sort_keys=True).encode("utf-8")).hexdigest()
+            user_data = await get_user_store().aacquire(("upload", upload_key), lambda: load(payloads))
+        else:
+            return json_error(400, "Provide either 'env', 'access_token' and 'uuid', or the 'itemization', 'metadata' and 'vacation' payloads.")
+    except UserLoadError as e:
+        return json_error(e.status, e.message)
+
+    session = AnalysisSession(session_id, uuid, env, user_data)
+    request.app["sessions"][session_id] = session
+    return web.json_response({
+        "session_id": session_id,
+        "uuid": uuid,
+        "location": session.location,
+        "cycles": [dict(zip(CYCLE_FIELDS, row)) for row in billing_cycle_rows(session.cycles)],
+    }, status=201)
+
+
+async def list_cycles(request):
+    """
+    GET /sessions/{session_id}/cycles
+
+    Returns the billing cycle summary of the loaded user.
+    """
+    session = get_session(request)
+    if session is None:
+        return json_error(404, "Unknown session.")
+    return web.json_response({"cycles": [dict(zip(CYCLE_FIELDS, row)) for row in billing_cycle_rows(session.cycles)]})
+
+
+async def compare_cycles(request):
+    """
+    POST /sessions/{session_id}/compare
+
+    Compares two billing cycles ({"cycle1": id, "cycle2": id}, using the ids of the cycle summary)
+    and returns the difference and the first explanation. Starts a new chat history once the explanation is
+    generated: if it fails, the error is returned and the previous comparison and its history are kept.
+    With BILL_ANALYZER_STRUCTURED_OUTPUT, the checked reasons behind the explanation are returned as well.
+    """
+    session = get_session(request)
+    if session is None:
+        return json_error(404, "Unknown session.")
+    body = await read_json(request)
+    try:
+        idx1, idx2 = int(body["cycle1"]) - 1, int(body["cycle2"]) - 1
+    except (TypeError, KeyError, ValueError):
+        return json_error(400, "'cycle1' and 'cycle2' must be cycle ids.")
+    if idx1 == idx2 or not (0 <= idx1 < len(session.cycles) and 0 <= idx2 < len(session.cycles)):
+        return json_error(400, f"Select two different cycles between 1 and {len(session.cycles)}.")
+
+    async with session.lock:
+        with span("diff", **session.trace_tags()):
+            difference = calculate_difference(session.cycles[idx1], session.cycles[idx2])
+            cycle1 = replace_braces(session.cycles[idx1])
+            cycle2 = replace_braces(session.cycles[idx2])
+            diff = replace_braces(difference)
+            peers = peer_comparison(session.location, [session.cycles[idx1], session.cycles[idx2]])
+
+        reasons = None
+        first_query = build_first_query(cycle1, cycle2, diff, session.location, peers)
+        with span("drivers", **session.trace_tags()):
+            local_answer, drivers_query = driver_fast_path(session.cycles[idx1], session.cycles[idx2], session.location, peers)
+        # A refused comparison leaves the session as it was
+        if local_answer is None and (refusal := check_budget(session.session_id, prompt_tokens=first_prompt_tokens(drivers_query or first_query))) is not None:
+            return json_error(429, refusal)
+
+        if local_answer is not None:
+            answer = local_answer
+        else:
+            try:
+                with span("llm_first", **session.trace_tags()) as llm_span:
+                    if structured_output_enabled():
+                        # Terse JSON reasons, checked against the data and rendered locally (see tools/structured.py)
+                        answer, reasons, response = await astructured_first_answer(
+                            request.app["llm"], drivers_query or first_query, session.cycles[idx1], session.cycles[idx2]
+                        )
+                    else:
+                        response = await request.app["first_chain"].ainvoke([HumanMessage(content=drivers_query or first_query)])
+                        answer = response.content
+                    record_llm_usage(llm_span, response)
+            except Exception as e:
+                print(f"Error in the first LLM call: {e}")
+                return json_error(502, "The comparison could not be explained. The previous comparison is kept.")
+
+        # Only an explained comparison replaces the previous one and its follow-up questions. The history keeps
+        # the full cycles, also when the LLM was sent the compact drivers query, so that follow-up questions can use them
+        session.history.clear()
+        session.history.add_user_message(first_query)
+        session.history.add_ai_message(answer)
+        session.comparison = (idx1, idx2)
+
+    return web.json_response({
+        "cycle1": idx1 + 1,
+        "cycle2": idx2 + 1,
+        "difference": difference,
+        "response": answer,
+        "reasons": reasons,
+    })
+
+
+async def explain_window_trend(request):
+    """
+    POST /sessions/{session_id}/trend
+
+    Explains how the cost changed from every billing cycle of the window to the next one, in a single LLM call.
+    Returns the rendered explanation and, if the model answered with the requested JSON, the summary and the
+    explanation of every cycle.
+    """
+    session = get_session(request)
+    if session is None:
+        return json_error(404, "Unknown session.")
+    if len(session.cycles) < 2:
+        return json_error(409, "At least two billing cycles are needed to explain a trend.")
+    refusal = check_budget(session.session_id, prompt_tokens=estimate_prompt_tokens(trend_prompt, build_trend_query(session.cycles, session.location)))
+    if refusal is not None:
+        return json_error(429, refusal)
+
+    with span("llm_trend", **session.trace_tags()) as llm_span:
+        text, trend, response = await aexplain_trend(request.app["llm"], session.cycles, session.location)
+        record_llm_usage(llm_span, response)
+    return web.json_response({
+        "response": text,
+        "summary": trend["summary"] if trend else None,
+        "cycles": [{"cycle": cycle, "explanation": explanation} for cycle, explanation in sorted(trend["cycles"].items())] if trend else None,
+    })
+
+
+async def chat(request):
+    """
+    POST /sessions/{session_id}/chat
+
+    Answers a follow-up question ({"message": text}) about the current comparison, streaming the
+    answer as plain text while it is generated.
+    """
+    session = get_session(request)
+    if session is None:
+        return json_error(404, "Unknown session.")
+    if session.comparison is None:
+        return json_error(409, "Compare two cycles before asking follow-up questions.")
+    body = await read_json(request)
+    message = (body or {}).get("message")
+    if not message:
+        return json_error(400, "'message' is required.")
+
+    async with session.lock:
+        stream = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8"})
+        await stream.prepare(request)
+        # Common questions about the same cycle pair are answered from the follow-up cache
+        followup_cache = get_followup_cache()
+        idx1, idx2 = session.comparison
+        pair = pair_key(session.cycles[idx1], session.cycles[idx2])
+        cached = followup_cache.lookup(pair, message) if followup_cache is not None else None
+        if cached is not None:
+            session.history.add_user_message(message)
+            session.history.add_ai_message(cached)
+            await stream.write(cached.encode("utf-8"))
+            await stream.write_eof()
+            return stream
+        # Trims the oldest follow-ups, or refuses, when the session would exceed its token budget
+        refusal = check_budget(session.session_id, session.history, estimate_prompt_tokens(second_prompt, message))
+        if refusal is not None:
+            await stream.write(refusal.encode("utf-8"))
+            await stream.write_eof()
+            return stream
+        with span("llm_followup", **session.trace_tags()) as llm_span:
+            full_response = None
+            async for chunk in request.app["second_with_history"].astream(
+                {"input": message},
+                config={"configurable": {"session_id": session.session_id}}
+            ):
+                full_response = chunk if full_response is None else full_response + chunk
+                if chunk.content:
+                    await stream.write(chunk.content.encode("utf-8"))
+            if full_response is not None:
+                record_llm_usage(llm_span, full_response)
+        if followup_cache is not None and full_response is not None:
+            followup_cache.store(pair, message, full_response.content)
+        await stream.write_eof()
+    return stream
+
+
+async def close_session(request):
+    """
+    DELETE /sessions/{session_id}
+    """
+    session = request.app["sessions"].pop(request.match_info["session_id"], None)
+    if session is None:
+        return json_error(404, "Unknown session.")
+    session.user_data.release()
+    return web.Response(status=204)
+
+
+async def health(request):
+    return web.json_response({"status": "ok", "sessions": len(request.app["sessions"]), "user_store": get_user_store().stats()})
+
+
+async def expire_sessions(app):
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        for session_id, session in list(app["sessions"].items()):
+            if now - session.last_used > SESSION_TTL_SECONDS and not session.lock.locked():
+                app["sessions"].pop(session_id, None)
+                session.user_data.release()
+
+
+async def on_startup(app):
+    app["http"] = ClientSession(timeout=ClientTimeout(total=60))
+    app["expiry_task"] = asyncio.create_task(expire_sessions(app))
+
+
+async def on_cleanup(app):
+    app["expiry_task"].cancel()
+    await app["http"].close()
+
+
+def create_app(llm=None):
+    """
+    Builds the Bill Analyzer HTTP API.
+
+    Args:
+        llm (BaseChatModel, optional): The chat model to use. Defaults to the configured backend, see tools.llm.get_chat_model.
+
+    Returns:
+        web.Application: The application, to be served with web.run_app.
+    """
+    app = web.Application()
+    app["sessions"] = {}
+
+    def get_session_history(session_id: str):
+        session = app["sessions"].get(session_id)
+        return session.history if session is not None else InMemoryChatMessageHistory()
+
+    llm = llm or get_chat_model(stream_usage=True)  #gpt-4o, or the record/replay backend configured by BILL_ANALYZER_LLM_BACKEND
+    app["llm"] = llm
+    app["first_chain"] = route_chain(first_prompt, llm, "first")
+    app["second_with_history"] = RunnableWithMessageHistory(route_chain(second_prompt, llm, "followup"), get_session_history)
+
+    app.router.add_get("/health", health)
+    app.router.add_post("/sessions", load_user)
+    app.router.add_get("/sessions/{session_id}/cycles", list_cycles)
+    app.router.add_post("/sessions/{session_id}/compare", compare_cycles)
+    app.router.add_post("/sessions/{session_id}/trend", explain_window_trend)
+    app.router.add_post("/sessions/{session_id}/chat", chat)
+    app.router.add_delete("/sessions/{session_id}", close_session)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless HTTP API of the Bill Analyzer.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    configure_metrics_from_env()
+    web.run_app(create_app(), host=args.host, port=args.port)
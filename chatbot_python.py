@@ -1,20 +1,31 @@
 import json
 from PIL import Image
-import os
 from tools.utils import replace_braces, calculate_difference, fetch_vacation_data, fetch_itemization_data, fetch_location
-from tools.chat import display_billing_cycles, plot_itemization_comparison
-from dataset import first_prompt, second_prompt
+from tools.accounting import check_budget, estimate_prompt_tokens
+from tools.chat import display_billing_cycles, plot_itemization_comparison, build_first_query
+from dataset import first_prompt, second_prompt, trend_prompt
 from tools.preprocessing import preprocess
+from tools.endpoints import get_endpoint_selector
+from tools.env_config import env_properties_dict
+from tools.cohort import peer_comparison
+from tools.drivers import driver_fast_path
+from tools.followup_cache import get_followup_cache, pair_key
+from tools.llm import get_chat_model
+from tools.metrics import span, record_llm_usage, configure_metrics_from_env
+from tools.profiling import profile_request, pause_profiling
+from tools.routing import route_chain
+from tools.structured import structured_output_enabled, structured_first_answer, first_prompt_tokens
+from tools.trend import build_trend_query, explain_trend
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
 from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.messages import HumanMessage
 from langchain_core.chat_history import InMemoryChatMessageHistory
 
 # Load environment variables
 load_dotenv()
-key = os.getenv("OPENAI_API_KEY")
+configure_metrics_from_env()
 
-def load_json_data(uuid=None):
+def load_json_data(env_name=None, access_token=None, uuid=None, session_id=None, file_paths=None):
     """
     Load JSON data either from files or using a UUID to fetch the user data.
 
@@ -22,7 +33,11 @@ def load_json_data(uuid=None):
     then it takes files paths as inputs directly from the user.
 
     Args:
+        env_name (str) : The environment to fetch the user data from, a key of env_properties_dict.
+        access_token (str) : The access token for the environment.
         uuid (str) : The uuid of the user we are interested in.
+        session_id (str) : The chat session id, used to tag tracing spans.
+        file_paths (tuple) : The itemization, metadata and vacation data file paths. Asked from the user if not given.
 
     Returns:
         processed_data (dict) : The processed JSON data.
@@ -30,19 +45,24 @@ def load_json_data(uuid=None):
     Raises:
         Exception: Raised when JSON file could not be loaded.
     """
-    if uuid:
+    if env_name and access_token and uuid:
+        # Requests go to the faster healthy host of the environment and are hedged to the other one (see tools/endpoints.py)
+        endpoints = get_endpoint_selector(env_name)
+        trace_tags = {"uuid": uuid, "env": env_name, "session": session_id}
         try:
-            itemization_data = fetch_itemization_data(uuid)
-            metadata = fetch_location(uuid)
-            vacation_data = fetch_vacation_data(uuid)
-            processed_data = preprocess(itemization_data, metadata, vacation_data, True)
+            with span("fetch", **trace_tags):
+                itemization_data = endpoints.call(lambda env_url: fetch_itemization_data(uuid, env_url, access_token, raise_host_errors=True))
+                metadata = endpoints.call(lambda env_url: fetch_location(uuid, env_url, access_token, raise_host_errors=True))
+                vacation_data = endpoints.call(lambda env_url: fetch_vacation_data(uuid, env_url, access_token, raise_host_errors=True))
+            with span("preprocess", **trace_tags):
+                processed_data = preprocess(itemization_data, metadata, vacation_data, True)
             return processed_data
         except Exception as e:
             print(f"Error in preprocessing data: {e}")
     else:
-        itemization_file_path = input("Please enter the path to the Itemization JSON file: ")
-        metadata_file_path = input("Please enter the path to the Metadata JSON file: ")
-        vacationdata_file_path = input("Please enter the path to the Vacation Data JSON file: ")
+        if file_paths is None:
+            file_paths = prompt_for_file_paths()
+        itemization_file_path, metadata_file_path, vacationdata_file_path = file_paths
 
         try:
             with open(itemization_file_path, 'r') as itemization_file:
@@ -52,7 +72,8 @@ def load_json_data(uuid=None):
             with open(vacationdata_file_path, 'r') as vacationdata_file:
                 vacationdata = json.load(vacationdata_file)
 
-            processed_data = preprocess(itemization_data, metadata, vacationdata, True)
+            with span("preprocess", session=session_id):
+                processed_data = preprocess(itemization_data, metadata, vacationdata, True)
             print("Files successfully processed.")
             return processed_data
 
@@ -61,6 +82,21 @@ def load_json_data(uuid=None):
 
     return None
 
+def prompt_for_file_paths():
+    """
+    Asks the user for the paths of the three JSON files using terminal input.
+
+    Args:
+        None
+
+    Returns:
+        file_paths (tuple) : The itemization, metadata and vacation data file paths.
+    """
+    itemization_file_path = input("Please enter the path to the Itemization JSON file: ")
+    metadata_file_path = input("Please enter the path to the Metadata JSON file: ")
+    vacationdata_file_path = input("Please enter the path to the Vacation Data JSON file: ")
+    return itemization_file_path, metadata_file_path, vacationdata_file_path
+
 def get_valid_cycle_choice(length, question_text):
     """
     Asks user to enter a valid cycle index choice using terminal input. 
@@ -103,6 +139,23 @@ def prompt_for_plot():
         else:
             print("Invalid choice. Please enter 'yes' or 'no'.")
 
+def prompt_for_trend():
+    """
+    Asks the user if they want an explanation of the trend across all billing cycles using terminal input.
+
+    Args:
+        None
+
+    Returns:
+        show_trend (str) : Can be 'yes' or 'no' depending on whether the user wants the trend explanation.
+    """
+    while True:
+        show_trend = input("Do you want an explanation of the trend across all cycles? (yes/no): ").strip().lower()
+        if show_trend in ['yes', 'no']:
+            return show_trend
+        else:
+            print("Invalid choice. Please enter 'yes' or 'no'.")
+
 def select_billing_cycles(json_file):
     """
     Allow the user to select two billing cycles for comparison. 
@@ -158,65 +211,120 @@ def run_bill_analyzer(flag=False):
     store = {}
 
     if flag:
-        uuid = input("Enter the UUID to fetch the data: ")
-        if uuid:
-            processed_data = load_json_data(uuid)
-        else:
-            print("Please enter a UUID to fetch data.")
+        env = input(f"Enter the env ({', '.join(env_properties_dict)}): ").strip()
+        if env not in env_properties_dict:
+            print(f"Unknown env '{env}'.")
             return
+        access_token = input("Enter the access token for the env: ").strip()
+        uuid = input("Enter the UUID to fetch the data: ").strip()
+        if not access_token or not uuid:
+            print("Please enter an access token and a UUID to fetch data.")
+            return
+        file_paths = None
     else:
-        processed_data = load_json_data()
-
-    if processed_data is None:
-        return
+        env = access_token = uuid = None
+        file_paths = prompt_for_file_paths()
 
-    json_file = processed_data.get("usageChartDataList", [])
-    json_file = json_file[-15:-2]
-    loc = processed_data["location"]
+    # Opt-in profiling of data loading, preprocessing and chat setup (see tools/profiling.py)
+    with profile_request(uuid, env=env) as profiler:
+        processed_data = load_json_data(env, access_token, uuid, session_id, file_paths)
 
-    print("Billing Cycles Summary")
-    table = display_billing_cycles(json_file)
-    print(table)
+        if processed_data is None:
+            return
 
-    cycle1, cycle2, idx1, idx2, show_plot = select_billing_cycles(json_file)
-    if not cycle1 or not cycle2 or show_plot is None:
-        return
+        trace_tags = {"uuid": uuid, "env": env, "session": session_id}
+
+        json_file = processed_data.get("usageChartDataList", [])
+        json_file = json_file[-15:-2]
+        loc = processed_data["location"]
+
+        print("Billing Cycles Summary")
+        with span("table", **trace_tags):
+            table = display_billing_cycles(json_file)
+        print(table)
+
+        if len(json_file) >= 2:
+            with pause_profiling(profiler):
+                show_trend = prompt_for_trend()
+            refusal = check_budget(session_id, prompt_tokens=estimate_prompt_tokens(trend_prompt, build_trend_query(json_file, loc))) if show_trend == 'yes' else None
+            if refusal is not None:
+                print(refusal)
+            elif show_trend == 'yes':
+                with span("llm_trend", **trace_tags) as llm_span:
+                    trend_text, _, response = explain_trend(get_chat_model(), json_file, loc)
+                    record_llm_usage(llm_span, response)
+                print(f"\nTrend across all cycles:\n{trend_text}\n")
+
+        # Waiting for the cycle selection is not part of the request time
+        with pause_profiling(profiler):
+            cycle1, cycle2, idx1, idx2, show_plot = select_billing_cycles(json_file)
+        if not cycle1 or not cycle2 or show_plot is None:
+            return
 
-    if show_plot == 'yes':
-        image_buffer = plot_itemization_comparison(json_file[idx1], json_file[idx2])
-        image = Image.open(image_buffer)
-        image.show()
+        if show_plot == 'yes':
+            with span("plot", **trace_tags):
+                image_buffer = plot_itemization_comparison(json_file[idx1], json_file[idx2])
+                image = Image.open(image_buffer)
+            image.show()
 
-    diff = replace_braces(calculate_difference(json_file[idx1], json_file[idx2]))
-    print('\nBill Analyzer is running! Please Wait...\n')
+        with span("diff", **trace_tags):
+            diff = replace_braces(calculate_difference(json_file[idx1], json_file[idx2]))
+        print('\nBill Analyzer is running! Please Wait...\n')
 
-    store = {}
+        store = {}
 
-    def get_session_history(session_id: str):
-        if session_id not in store:
-            store[session_id] = InMemoryChatMessageHistory()
-        return store[session_id]
+        def get_session_history(session_id: str):
+            if session_id not in store:
+                store[session_id] = InMemoryChatMessageHistory()
+            return store[session_id]
 
-    llm = ChatOpenAI(model="gpt-4o", openai_api_key=key, temperature=1.0)
-    first_chain = first_prompt | llm
-    second_chain = second_prompt | llm
+        llm = get_chat_model()
+        first_chain = route_chain(first_prompt, llm, "first")
+        second_chain = route_chain(second_prompt, llm, "followup")
 
-    first_with_history = RunnableWithMessageHistory(first_chain, get_session_history)
-    second_with_history = RunnableWithMessageHistory(second_chain, get_session_history)
+        second_with_history = RunnableWithMessageHistory(second_chain, get_session_history)
 
-    def chatbot_response(session_id: str, user_input: str):
+    def chatbot_response(session_id: str, user_input: str, history_query=None):
+        # history_query is the question kept in the history instead of user_input, e.g. the full first query
+        # when the LLM is sent the compact drivers query
         history = get_session_history(session_id)
         if not history.messages:
-            response = first_with_history.invoke(
-                {"input": user_input},
-                config={"configurable": {"session_id": session_id}}
-            )
+            refusal = check_budget(trace_tags["session"], prompt_tokens=first_prompt_tokens(user_input))
+            if refusal is not None:
+                return refusal
+            with span("llm_first", **trace_tags) as llm_span:
+                if structured_output_enabled():
+                    # Terse JSON reasons, checked against the data and rendered locally (see tools/structured.py)
+                    answer, _, response = structured_first_answer(llm, user_input, json_file[idx1], json_file[idx2])
+                else:
+                    response = first_chain.invoke([HumanMessage(content=user_input)])
+                    answer = response.content
+                record_llm_usage(llm_span, response)
+            history.add_user_message(history_query or user_input)
+            history.add_ai_message(answer)
         else:
-            response = second_with_history.invoke(
-                {"input": user_input},
-                config={"configurable": {"session_id": session_id}}
-            )
-        return response.content
+            # Common questions about the same cycle pair are answered from the follow-up cache
+            followup_cache = get_followup_cache()
+            pair = pair_key(json_file[idx1], json_file[idx2])
+            cached = followup_cache.lookup(pair, user_input) if followup_cache is not None else None
+            if cached is not None:
+                history.add_user_message(user_input)
+                history.add_ai_message(cached)
+                return cached
+            # Trims the oldest follow-ups, or refuses, when the session would exceed its token budget
+            refusal = check_budget(trace_tags["session"], history, estimate_prompt_tokens(second_prompt, user_input))
+            if refusal is not None:
+                return refusal
+            with span("llm_followup", **trace_tags) as llm_span:
+                response = second_with_history.invoke(
+                    {"input": user_input},
+                    config={"configurable": {"session_id": session_id}}
+                )
+                record_llm_usage(llm_span, response)
+            if followup_cache is not None:
+                followup_cache.store(pair, user_input, response.content)
+            answer = response.content
+        return answer
 
     def interactive_chatbot(session_id: str, cycle1, cycle2, diff):
         messages = []
@@ -224,8 +332,18 @@ def run_bill_analyzer(flag=False):
         initial_response = None
 
         if not messages:
-            first_query = f"Compare the following billing cycles: one= {cycle1} and two= {cycle2}. The difference in values between the billing cycles one and two is difference={diff}. This can help you understand the variations between the billing cycles. This user belongs to the location:{loc}"
-            initial_response = chatbot_response(session_id, first_query)
+            peers = peer_comparison(loc, [json_file[idx1], json_file[idx2]])
+            first_query = build_first_query(cycle1, cycle2, diff, loc, peers)
+            with span("drivers", **trace_tags):
+                local_answer, drivers_query = driver_fast_path(json_file[idx1], json_file[idx2], loc, peers)
+            if local_answer is not None:
+                # Keep the full cycles in the history so that follow-up questions can still use them
+                initial_response = local_answer
+                get_session_history(session_id).add_user_message(first_query)
+                get_session_history(session_id).add_ai_message(local_answer)
+            else:
+                # The LLM gets the compact drivers query, while the history keeps the full cycles for follow-up questions
+                initial_response = chatbot_response(session_id, drivers_query or first_query, first_query)
             messages.append({"role": "assistant", "content": initial_response})
 
         print("Assistant:", initial_response.replace("$", r"\$"))
@@ -1,120 +1,43 @@
 import streamlit as st
+import asyncio
+import copy
+import threading
 import json
-from PIL import Image
-from tools.utils import replace_braces, calculate_difference, fetch_itemization_data, fetch_location, fetch_vacation_data
-from tools.chat import display_billing_cycles, plot_itemization_comparison
-from dataset import first_prompt, second_prompt
+import time
+import hashlib
+import uuid as uuid_lib
+from tools.utils import replace_braces, calculate_difference, location_url, HISTORY_WINDOW
+from tools.async_utils import fetch_json_async, fetch_user_data_async
+from tools.cancellation import SelectionTaskRunner, TASK_POLL_SECONDS
+from tools.accounting import check_budget, estimate_prompt_tokens, within_budget
+from tools.chat import display_billing_cycles, plot_itemization_comparison, build_first_query
+from dataset import first_prompt, second_prompt, trend_prompt
 from tools.preprocessing import preprocess
+from tools.endpoints import get_endpoint_selector
+from tools.env_config import env_properties_dict
+from tools.cohort import peer_comparison
+from tools.drivers import driver_fast_path
+from tools.followup_cache import get_followup_cache, pair_key
+from tools.llm import get_chat_model
+from tools.metrics import registry, span, record_llm_usage, configure_metrics_from_env
+from tools.profiling import profile_request
+from tools.routing import route_chain
+from tools.speculation import SpeculativeRunner, predicted_pairs, speculation_result
+from tools.structured import structured_output_enabled, astructured_first_answer, first_prompt_tokens
+from tools.trend import build_trend_query, explain_trend
+from tools.user_store import get_user_store
 from dotenv import load_dotenv
 import os
-from langchain_openai import ChatOpenAI
-from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.messages import HumanMessage
+from streamlit.runtime.scriptrunner import get_script_run_ctx, add_script_run_ctx
+from streamlit.runtime.scriptrunner.exceptions import ScriptControlException
 
 
 user_avatar_url = 'https://m.media-amazon.com/images/I/31x+q3aNVKL._AC_UF1000,1000_QL80_.jpg'
 assistant_avatar_user = 'https://cdn.theorg.com/8ad2e869-5595-4b23-bbff-6a7a8d511d15_thumb.jpg'
 favicon_url = 'https://cdn.theorg.com/8ad2e869-5595-4b23-bbff-6a7a8d511d15_thumb.jpg'
 
-env_properties_dict = {
-    'dev': dict({
-        'protocol': 'https://',
-        'primary': 'devapi.bidgely.com',
-        'secondary': 'devapi.bidgely.com',
-        'aws_region': 'us-west-2'
-    }),
-
-    'ds': dict({
-        'protocol': 'http://',
-        'primary': 'dspyapi.bidgely.com',
-        'secondary': 'dsapi.bidgely.com',
-        'aws_region': 'us-east-1'
-    }),
-
-    'nonprodqa': dict({
-        'protocol': 'https://',
-        'primary': 'nonprodqaapi.bidgely.com',
-        'secondary': 'nonprodqaapi.bidgely.com',
-        'aws_region': 'us-west-2'
-    }),
-    'prod-na': dict({
-        'protocol': 'https://',
-        'primary': 'napyapi.bidgely.com',
-        'secondary': 'naapi.bidgely.com',
-        'aws_region': 'us-east-1'
-    }),
-    'prod-eu': dict({
-        'protocol': 'https://',
-        'primary': 'eupyapi.bidgely.com',
-        'secondary': 'euapi.bidgely.com',
-        'aws_region': 'eu-central-1'
-    }),
-    'prod-jp': dict({
-        'protocol': 'https://',
-        'primary': 'jppyapi.bidgely.com',
-        'secondary': 'jpapi.bidgely.com',
-        'aws_region': 'ap-northeast-1'
-    }),
-    'prod-ca': dict({
-        'protocol': 'https://',
-        'primary': 'capyapi.bidgely.com',
-        'secondary': 'caapi.bidgely.com',
-        'aws_region': 'ca-central-1'
-    }),
-    'prod-na-2': dict({
-        'protocol': 'https://',
-        'primary': 'na2pyapi.bidgely.com',
-        'secondary': 'naapi2.bidgely.com',
-        'aws_region': 'us-east-1'
-    }),
-    'preprod-na': dict({
-        'protocol': 'https://',
-        'primary': 'napreprodapi.bidgely.com',
-        'secondary': 'napreprodapi.bidgely.com',
-        'aws_region': 'us-east-1'
-    }),
-    'qaperfenv': dict({
-        'protocol': 'http://',
-        'primary': 'awseb-e-i-awsebloa-1jk42nlshi8yb-2130246765.us-west-2.elb.amazonaws.com',
-        'secondary': 'awseb-e-i-awsebloa-1jk42nlshi8yb-2130246765.us-west-2.elb.amazonaws.com',
-        'aws_region': 'us-west-2'
-    }),
-    'uat': dict({
-        'protocol': 'https://',
-        'primary': 'uatapi.bidgely.com',
-        'secondary': 'uatapi.bidgely.com',
-        'aws_region': 'us-west-2'
-    }),
-
-    'productqa': dict({
-        'protocol': 'https://',
-        'primary': 'productqaapi.bidgely.com',
-        'secondary': 'productqaapi.bidgely.com',
-        'aws_region': 'us-west-2'
-    }),
-
-    'dewa-dev': dict({
-        'protocol': 'http://',
-        'primary': 'api.mslpdev.dewaaws.local',
-        'secondary': 'api.mslpdev.dewaaws.local',
-        'aws_region': 'me-central-1'
-    }),
-
-    'dewa-qa': dict({
-        'protocol': 'http://',
-        'primary': 'api.mslpqa.dewaaws.local',
-        'secondary': 'api.mslpqa.dewaaws.local',
-        'aws_region': 'me-central-1'
-    }),
-
-    'dewa-prod': dict({
-        'protocol': 'http://',
-        'primary': 'api-pyami.mslpprod.dewaaws.local',
-        'secondary': 'api-pyami.mslpprod.dewaaws.local',
-        'aws_region': 'me-central-1'
-    }),
-}
-
 # Set the page configuration with the custom icon URL
 st.set_page_config(page_title="Bill Analyzer", page_icon=favicon_url, layout="centered", initial_sidebar_state="auto", menu_items=None)
 html_content = """
@@ -138,7 +61,7 @@ st.markdown("<br>", unsafe_allow_html=True)
 
 # Load environment variables
 load_dotenv()
-key = os.getenv("OPENAI_API_KEY")
+configure_metrics_from_env()
 
 
 def initialize_session_state():
@@ -165,22 +88,333 @@ def reset_session():
 
 initialize_session_state()
 
+def get_trace_session():
+    """
+    Returns the id of the browser session running this script, used to tag tracing spans.
+    """
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+# Memoised steps keep their results for CACHE_TTL_SECONDS and at most CACHE_MAX_ENTRIES inputs each
+CACHE_TTL_SECONDS = int(os.getenv("BILL_ANALYZER_CACHE_TTL", "3600"))
+CACHE_MAX_ENTRIES = int(os.getenv("BILL_ANALYZER_CACHE_ENTRIES", "64"))
+
+# Memoised steps that actually ran during the current rerun, logged with the rerun duration
+recomputed_steps = []
+
+# Chat turns (a question and its answer) shown on every rerun; older turns are only rendered on demand
+TRANSCRIPT_RECENT_TURNS = int(os.getenv("BILL_ANALYZER_TRANSCRIPT_TURNS", "5"))
+
+def fingerprint(processed_data):
+    """
+    Returns a content hash of preprocessed data, used as the cache key of every step derived from it.
+    """
+    return hashlib.sha1(json.dumps(processed_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+@st.cache_resource
+def get_task_runner():
+    return SelectionTaskRunner()
+
+def task_owner():
+    """
+    Returns the id under which the background work of this session runs, unique per session.
+    """
+    if "task_owner" not in st.session_state:
+        st.session_state["task_owner"] = uuid_lib.uuid4().hex
+    return st.session_state["task_owner"]
+
+def selection_generation(scope, selection):
+    """
+    Returns the generation of the current selection of a scope, starting a new generation when the selection changed.
+    """
+    generations = st.session_state.setdefault("generations", {})
+    current = generations.get(scope)
+    if current is None or current[0] != selection:
+        st.session_state["generation"] = st.session_state.get("generation", 0) + 1
+        current = generations[scope] = (selection, st.session_state["generation"])
+    return current[1]
+
+def selection_task_running(scope, selection):
+    """
+    Returns True if work for this selection of the scope was started and has not been collected yet.
+    """
+    current = st.session_state.get("generations", {}).get(scope)
+    return current is not None and current[0] == selection and get_task_runner().has_task(task_owner(), scope, current[1])
+
+def await_selection_task(scope, selection, coroutine_factory, message):
+    """
+    Runs the slow work of the current selection of a scope (a fetch or an LLM call) in the background and returns
+    its result once it is done, raising its exception if it failed (see tools/cancellation.py).
+
+    The script does not block on the work. In a fragment rerun, only the fragment waiting for it is rerun every
+    TASK_POLL_SECONDS until it is done. A full-app run cannot rerun a single fragment, so it stops and leaves
+    task_poller to rerun the page once the work is done. When the analyst changes the selection meanwhile, the next
+    rerun starts a new generation and the work of the old one is cancelled in flight. Only the work of the current
+    generation is collected, so stale results never reach the session state.
+    """
+    runner = get_task_runner()
+    owner = task_owner()
+    generation = selection_generation(scope, selection)
+    task = runner.run(owner, scope, generation, coroutine_factory)
+    pending = st.session_state.setdefault("pending_tasks", {})
+    if not task.done():
+        pending[scope] = generation
+        st.caption(f"{message} ({time.monotonic() - task.started:.0f} s)")
+        if is_fragment_rerun():
+            time.sleep(TASK_POLL_SECONDS)
+            st.rerun(scope="fragment")
+        task_poller(scope, generation)
+        st.stop()
+    pending.pop(scope, None)
+    runner.collect(owner, scope, generation)
+    return task.result()
+
+@st.fragment(run_every=TASK_POLL_SECONDS)
+def task_poller(scope, generation):
+    """
+    Reruns the page once the background work of a generation is done. Work of a superseded generation is ignored.
+    """
+    if st.session_state.get("pending_tasks", {}).get(scope) == generation and get_task_runner().finished(task_owner(), scope, generation):
+        st.rerun()
+
+def cancel_selection_tasks(*scopes):
+    """
+    Cancels the running work of the session, of the given scopes or of all of them.
+    """
+    runner = get_task_runner()
+    pending = st.session_state.get("pending_tasks", {})
+    for scope in scopes or (None,):
+        runner.cancel(task_owner(), scope)
+        if scope is None:
+            pending.clear()
+        else:
+            pending.pop(scope, None)
+
+def shared_user_data(key, acquire, access_token=None):
+    """
+    Returns the processed JSON data and fingerprint stored under key in the user store shared by all sessions
+    (see tools/user_store.py). acquire() returns the session's reference to them, loading them if no session has them yet.
+    The session keeps its reference to the shared data until it loads another user or ends.
+    """
+    ref = st.session_state.get("user_data")
+    if ref is not None and ref.key == key and st.session_state.get("user_data_token") == access_token and not ref.expired:
+        return ref.value
+    new_ref = acquire()
+    if ref is not None:
+        ref.release()
+    st.session_state["user_data"] = new_ref
+    st.session_state["user_data_token"] = access_token
+    return new_ref.value
+
+def preprocess_payloads(payloads, uuid, env_name, fetch_seconds):
+    """
+    Preprocess fetched payloads and fingerprint the result on the thread it runs on, profiled as a request of the
+    user when profiling is enabled (see tools/profiling.py). The profile records how long the fetch took.
+    Returns the processed JSON data and its fingerprint, or the preprocessing error message and None.
+    """
+    with profile_request(uuid, env=env_name, fetch_s=round(fetch_seconds, 6)):
+        processed_data = preprocess(*payloads, True)
+        if isinstance(processed_data, str):
+            return processed_data, None
+        return processed_data, fingerprint(processed_data)
+
+async def fetch_and_preprocess(env_name, access_token, uuid, http, trace_session=None):
+    """
+    Fetch and preprocess the data of a user. Failures raise, so nothing is stored.
+    Returns the processed JSON data and its fingerprint.
+    """
+    recomputed_steps.append("fetch_and_preprocess")
+    trace_tags = {"uuid": uuid, "env": env_name, "session": trace_session}
+    started = time.perf_counter()
+    with span("fetch", **trace_tags):
+        # Sent to the faster healthy host of the environment, hedged to the other one (see tools/endpoints.py)
+        payloads = await get_endpoint_selector(env_name).acall(
+            lambda env_url: fetch_user_data_async(http, uuid, env_url, access_token, raise_host_errors=True)
+        )
+    if payloads is None or any(payload is None for payload in payloads):
+        raise ValueError("failed to fetch the user data")
+    # preprocess is CPU bound, so keep it off the event loop of the background tasks
+    with span("preprocess", **trace_tags):
+        processed_data, data_key = await asyncio.get_running_loop().run_in_executor(
+            None, preprocess_payloads, payloads, uuid, env_name, time.perf_counter() - started
+        )
+    if data_key is None:
+        raise ValueError(processed_data)
+    return processed_data, data_key
+
+def parse_and_preprocess(itemization_bytes, metadata_bytes, vacation_bytes, env_name=None, trace_session=None):
+    """
+    Parse and preprocess the contents of the three uploaded files. Failures raise, so nothing is stored.
+    Returns the processed JSON data and its fingerprint.
+    """
+    recomputed_steps.append("parse_and_preprocess")
+    # Opt-in profiling of the reruns that load data (see tools/profiling.py)
+    with profile_request(None, env=env_name):
+        itemization_data = json.loads(itemization_bytes)
+        metadata = json.loads(metadata_bytes)
+        vacationdata = json.loads(vacation_bytes)
+        with span("preprocess", env=env_name, session=trace_session):
+            processed_data = preprocess(itemization_data, metadata, vacationdata, True)
+        if isinstance(processed_data, str):
+            raise ValueError(processed_data)
+        return processed_data, fingerprint(processed_data)
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def billing_cycles_table(data_key, _json_file):
+    """
+    Memoised display_billing_cycles for the analysis window of the data identified by data_key.
+    """
+    recomputed_steps.append("billing_cycles_table")
+    return display_billing_cycles(_json_file)
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def comparison_inputs(data_key, idx1, idx2, _json_file):
+    """
+    Memoised replace_braces and calculate_difference for a pair of cycles of the analysis window.
+    Returns the escaped cycles and the escaped difference.
+    """
+    recomputed_steps.append("comparison_inputs")
+    cycle1 = replace_braces(_json_file[idx1])
+    cycle2 = replace_braces(_json_file[idx2])
+    diff = replace_braces(calculate_difference(_json_file[idx1], _json_file[idx2]))
+    return cycle1, cycle2, diff
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def comparison_plot(data_key, idx1, idx2, _json_file):
+    """
+    Memoised plot_itemization_comparison for a pair of cycles of the analysis window.
+    Returns the PNG image as bytes.
+    """
+    recomputed_steps.append("comparison_plot")
+    return plot_itemization_comparison(_json_file[idx1], _json_file[idx2]).getvalue()
+
+@st.cache_resource
+def get_llm():
+    return get_chat_model()  #gpt-4o, or the record/replay backend configured by BILL_ANALYZER_LLM_BACKEND
+
+@st.cache_resource
+def get_speculative_runner():
+    return SpeculativeRunner()
+
+def first_question(json_file, idx1, idx2, cycle1, cycle2, diff, loc):
+    """
+    Build the first comparison question of a pair of cycles.
+    Returns the full query kept in the history, the local answer if the driver mode answers without
+    the LLM, and the query to send to the LLM otherwise.
+    """
+    peers = peer_comparison(loc, [json_file[idx1], json_file[idx2]])
+    first_query = build_first_query(cycle1, cycle2, diff, loc, peers)
+    local_answer, drivers_query = driver_fast_path(json_file[idx1], json_file[idx2], loc, peers)
+    return first_query, local_answer, (drivers_query or first_query) if local_answer is None else None
+
+def start_speculation(data_key, json_file, loc, trace_tags):
+    """
+    Precompute the diff, the chart and the first explanation of the most likely comparisons in the background,
+    so that they are ready if the analyst picks one of them (see tools/speculation.py).
+    """
+    runner = get_speculative_runner()
+    group = (trace_tags["session"], data_key)
+    llm = get_llm()
+    chain = first_prompt | llm
+    ctx = get_script_run_ctx()
+
+    def in_session(step, *args):
+        # Memoised steps expect the script context of the session they are computed for. A copy is attached, as
+        # memoised steps flag their context while they run and the session's own script thread must not see that flag
+        add_script_run_ctx(threading.current_thread(), copy.copy(ctx))
+        return step(*args)
+
+    async def speculate(idx1, idx2):
+        loop = asyncio.get_running_loop()
+        cycle1, cycle2, diff = await loop.run_in_executor(None, in_session, comparison_inputs, data_key, idx1, idx2, json_file)
+        if all(isinstance(json_file[i].get("itemizationDetailsList"), dict) for i in (idx1, idx2)):
+            await loop.run_in_executor(None, in_session, comparison_plot, data_key, idx1, idx2, json_file)
+        _, _, llm_query = first_question(json_file, idx1, idx2, cycle1, cycle2, diff, loc)
+        if llm_query is None:
+            return None
+        # Speculative calls are charged to the session: only make them while its budget covers all of them
+        if not within_budget(trace_tags["session"], first_prompt_tokens(llm_query), len(pairs)):
+            registry.increment("bill_analyzer_speculation_total", {"outcome": "over_budget"})
+            return None
+        with span("llm_speculative", **trace_tags) as llm_span:
+            if structured_output_enabled():
+                answer, _, response = await runner.limit(astructured_first_answer(llm, llm_query, json_file[idx1], json_file[idx2]))
+            else:
+                response = await runner.limit(chain.ainvoke({"input": llm_query}))
+                answer = response.content
+            record_llm_usage(llm_span, response)
+        return llm_query, answer
+
+    pairs = predicted_pairs(json_file)
+    for idx1, idx2 in pairs:
+        runner.submit(group, group + (idx1, idx2), lambda idx1=idx1, idx2=idx2: speculate(idx1, idx2))
+
+def show_trend(data_key, json_file, loc, trace_tags):
+    """
+    On request, explain how the cost changed across the whole analysis window with a single LLM call
+    (see tools/trend.py). The explanation is kept until other data is loaded.
+    """
+    trend = st.session_state.get("trend")
+    if trend is None or trend[0] != data_key:
+        if len(json_file) < 2 or not st.button("Explain the trend across all cycles"):
+            return
+        refusal = check_budget(trace_tags["session"], prompt_tokens=estimate_prompt_tokens(trend_prompt, build_trend_query(json_file, loc)))
+        if refusal is not None:
+            st.warning(refusal)
+            return
+        with st.spinner("Explaining the trend..."), span("llm_trend", **trace_tags) as llm_span:
+            text, _, response = explain_trend(get_llm(), json_file, loc)
+            record_llm_usage(llm_span, response)
+        trend = st.session_state["trend"] = (data_key, text)
+    with st.expander("Trend across all cycles", expanded=True):
+        st.markdown(trend[1].replace("$", r"\$"))
+
+def take_speculation(analysis):
+    """
+    Claim the speculative work of the selected comparison if it was predicted, without waiting for it, and cancel
+    the speculation of the other pairs. Returns the claimed work (see speculation_result) or None.
+    """
+    runner = get_speculative_runner()
+    group = (analysis["trace_tags"]["session"], analysis["data_key"])
+    speculation = runner.claim(group + (analysis["idx1"], analysis["idx2"]))
+    runner.cancel_group(group)
+    return speculation
+
 def disable_file_uploader():
     st.session_state["file_uploader_disabled"] = True
 
 def load_json_data(env_name, access_token, uuid=None):
     """
     Load JSON data either from files or using a UUID to fetch the user data.
-    Returns the processed JSON data.
+    Returns the processed JSON data and its fingerprint, or (None, None).
     """
     if env_name and access_token and uuid:
-        env_url = env_properties_dict[env_name]['protocol']+env_properties_dict[env_name]['primary']
+        # Analysts opening the same user share one copy of its data; another access token is first checked
+        # against the API before it may read data loaded with a different one
+        key = ("api", env_name, uuid, HISTORY_WINDOW)
+        runner = get_task_runner()
+        trace_session = get_trace_session()
+
+        async def acquire():
+            http = await runner.http()
+
+            async def authorize():
+                location = await get_endpoint_selector(env_name).acall(
+                    lambda env_url: fetch_json_async(http, location_url(uuid, env_url, access_token), raise_host_errors=True)
+                )
+                return location is not None
+
+            return await get_user_store().aacquire(
+                key, lambda: fetch_and_preprocess(env_name, access_token, uuid, http, trace_session), access_token, authorize
+            )
+
         try:
-            itemization_data = fetch_itemization_data(uuid, env_url, access_token)
-            metadata = fetch_location(uuid, env_url, access_token)
-            vacation_data = fetch_vacation_data(uuid, env_url, access_token)
-            processed_data = preprocess(itemization_data, metadata, vacation_data, True)
-            return processed_data
+            # Changing the environment, token or UUID while this runs cancels the fetch
+            return shared_user_data(
+                key, lambda: await_selection_task("load", (key, access_token), acquire, "Fetching the user data..."), access_token
+            )
+        except ScriptControlException:
+            raise
         except Exception as e:
             st.error(f"Error in preprocessing data: {e}")
     else:
@@ -209,22 +443,23 @@ def load_json_data(env_name, access_token, uuid=None):
         # Process the uploaded files
         if itemization_file and metadata_file and vacationdata_file:
             try:
-                itemization_data = json.load(itemization_file)
-                metadata = json.load(metadata_file)
-                vacationdata = json.load(vacationdata_file)
-                
-                processed_data = preprocess(itemization_data, metadata, vacationdata, True)
+                payloads = (itemization_file.getvalue(), metadata_file.getvalue(), vacationdata_file.getvalue())
+                upload_key = hashlib.sha1(b"\0".join(payloads)).hexdigest()
+                key = ("upload", env_name, upload_key)
+                processed_data, data_key = shared_user_data(
+                    key, lambda: get_user_store().acquire(key, lambda: parse_and_preprocess(*payloads, env_name, get_trace_session()))
+                )
                 disable_file_uploader()  # Disable the uploader after successful upload and processing
                 
                 st.success("Files successfully processed.")
-                return processed_data
+                return processed_data, data_key
 
             except Exception as e:
                 st.error(f"Invalid JSON file or content: {e}")
         else:
             st.info("Please upload all three JSON files.")
 
-    return None
+    return None, None
 
 def disable_first_cycle():
     st.session_state["first_cycle_disabled"] = True
@@ -300,7 +535,7 @@ def prompt_for_plot():
 
     return show_plot.lower()
 
-def select_billing_cycles(json_file):
+def select_billing_cycles(json_file, data_key):
     """
     Allow the user to select two billing cycles for comparison.
     Returns the selected cycles, indices, and whether to show the plot.
@@ -320,8 +555,7 @@ def select_billing_cycles(json_file):
     if idx2 is None:
         return None, None, None, None, None
 
-    cycle1 = replace_braces(json_file[idx1])
-    cycle2 = replace_braces(json_file[idx2])
+    cycle1, cycle2, _ = comparison_inputs(data_key, idx1, idx2, json_file)
 
     # Check if itemization details are available
     itemization1 = json_file[idx1].get('itemizationDetailsList', 'unavailable')
@@ -340,123 +574,318 @@ def select_billing_cycles(json_file):
     return cycle1, cycle2, idx1, idx2, show_plot
 
 
-def run_bill_analyzer(flag=False):
+def is_fragment_rerun():
+    """
+    Returns True if the current script run only re-executes fragments, not the whole page.
+    """
+    ctx = get_script_run_ctx()
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+def build_chat_chains():
+    """
+    Build the first and follow-up chains and the accessor of the chat histories kept in the session state.
+    The chains run in the background (see await_selection_task), so the script adds their answers to the history
+    itself, once it knows they belong to the current selection.
+    """
+    if 'store' not in st.session_state:
+        st.session_state['store'] = {}
+    store = st.session_state['store']
+
+    def get_session_history(session_id: str):
+        if session_id not in store:
+            store[session_id] = InMemoryChatMessageHistory()
+        return store[session_id]
+
+    llm = get_llm()
+    first_chain = route_chain(first_prompt, llm, "first")
+    second_chain = route_chain(second_prompt, llm, "followup")
+    return get_session_history, first_chain, second_chain
+
+def select_analysis(flag):
+    """
+    Show the env/token/UUID inputs, load the data, show the billing cycles summary and the cycle selection.
+    Returns everything the chart and chat need once a comparison is fully selected, otherwise None.
+    """
     session_id = "abc2"
-    store = {}
 
-    env = st.selectbox('Select the env.',('dev', 'ds', 'nonprodqa', 'prod-na', 'prod-eu', 'prod-jp', 'prod-ca', 'prod-na-2', 'preprod-na', 'qaperfenv', 'uat', 'productqa', 'dewa-dev', 'dewa-qa', 'dewa-prod'))
+    env = st.selectbox('Select the env.', tuple(env_properties_dict))
 
     access_token = st.text_input("Enter the access token for the env.")
+    uuid = None
 
-    if access_token:
-        if flag:
-            uuid = st.text_input("Enter the UUID to fetch the data:")
-            if uuid:
-                processed_data = load_json_data(env,access_token,uuid)
-            else:
-                st.info("Please enter a UUID to fetch data.")
-                return
-        else:
-            processed_data = load_json_data()
+    if not access_token:
+        cancel_selection_tasks("load")
+        return None
 
-        if processed_data is None:
-            return
+    if flag:
+        uuid = st.text_input("Enter the UUID to fetch the data:")
+        if not uuid:
+            cancel_selection_tasks("load")
+            st.info("Please enter a UUID to fetch data.")
+            return None
 
-        json_file = processed_data.get("usageChartDataList", [])
-        json_file = json_file[-15:-2] #Fetching last 13 BCs excluding the 2 recent ones
-        loc = processed_data["location"]
+    processed_data, data_key = load_json_data(env, access_token, uuid)
 
-        st.markdown("<h3 style='text-align: center;'>Billing Cycles Summary</h1>", unsafe_allow_html=True)
-        table = display_billing_cycles(json_file)
-        st.text(table)
+    if processed_data is None:
+        return None
 
-        cycle1, cycle2, idx1, idx2, show_plot = select_billing_cycles(json_file)
-        if not cycle1 or not cycle2 or show_plot is None:
-            return
+    trace_tags = {"uuid": uuid, "env": env, "session": get_trace_session()}
 
-        if show_plot == 'yes':
-            image_buffer = plot_itemization_comparison(json_file[idx1], json_file[idx2])
-            image = Image.open(image_buffer)
-            st.image(image, caption='\n\n', use_column_width=True)
-
-        diff = replace_braces(calculate_difference(json_file[idx1], json_file[idx2]))
-        st.write('\nBill Analyzer is running! Please Wait...\n')
-
-        st.session_state['session_id'] = session_id
-        st.session_state['cycle1'] = cycle1
-        st.session_state['cycle2'] = cycle2
-        st.session_state['diff'] = diff
-        if 'store' not in st.session_state:
-            st.session_state['store'] = {}
-        store = st.session_state['store']
-
-        def get_session_history(session_id: str):
-            if session_id not in store:
-                store[session_id] = InMemoryChatMessageHistory()
-            return store[session_id]
-
-        llm = ChatOpenAI(model="gpt-4o", openai_api_key=key, temperature=1.0)  #Using gpt-4o as a base model
-        first_chain = first_prompt | llm
-        second_chain = second_prompt | llm
-
-        first_with_history = RunnableWithMessageHistory(first_chain, get_session_history)
-        second_with_history = RunnableWithMessageHistory(second_chain, get_session_history)
-
-        def chatbot_response(session_id: str, user_input: str):
-            history = get_session_history(session_id)
-            if not history.messages:
-                response = first_with_history.invoke(
-                    {"input": user_input},
-                    config={"configurable": {"session_id": session_id}}
-                )
-            else:
-                response = second_with_history.invoke(
-                    {"input": user_input},
-                    config={"configurable": {"session_id": session_id}}
-                )
-            return response.content
+    json_file = processed_data.get("usageChartDataList", [])
+    json_file = json_file[-15:-2] #Fetching last 13 BCs excluding the 2 recent ones
+    loc = processed_data["location"]
 
-        def interactive_chatbot(session_id: str, cycle1, cycle2, diff):
-            if "messages" not in st.session_state:
-                st.session_state.messages = []
+    st.markdown("<h3 style='text-align: center;'>Billing Cycles Summary</h1>", unsafe_allow_html=True)
+    with span("table", **trace_tags):
+        table = billing_cycles_table(data_key, json_file)
+        st.text(table)
+    show_trend(data_key, json_file, loc, trace_tags)
 
-            initial_response = None
+    if st.session_state.get("speculated_key") != data_key:
+        st.session_state["speculated_key"] = data_key
+        start_speculation(data_key, json_file, loc, trace_tags)
 
-            if not st.session_state.messages:
-                first_query = f"Compare the following billing cycles: one= {cycle1} and two= {cycle2}. The difference in values between the billing cycles one and two is difference={diff}. This can help you understand the variations between the billing cycles. This user belongs to the location:{loc}"
-                initial_response = chatbot_response(session_id, first_query)
-                st.session_state.messages.append({"role": "assistant", "content": initial_response})
+    cycle1, cycle2, idx1, idx2, show_plot = select_billing_cycles(json_file, data_key)
+    if not cycle1 or not cycle2 or show_plot is None:
+        return None
 
-            displayed_initial_message = False
-            for message in st.session_state.messages:
-                if message["role"] == "assistant":
-                    avatar_url = assistant_avatar_user
-                else:
-                    avatar_url = None
+    with span("diff", **trace_tags):
+        _, _, diff = comparison_inputs(data_key, idx1, idx2, json_file)
+
+    st.session_state['session_id'] = session_id
+    st.session_state['cycle1'] = cycle1
+    st.session_state['cycle2'] = cycle2
+    st.session_state['diff'] = diff
+
+    return {
+        "key": (data_key, idx1, idx2, show_plot),
+        "session_id": session_id,
+        "trace_tags": trace_tags,
+        "json_file": json_file,
+        "data_key": data_key,
+        "loc": loc,
+        "idx1": idx1,
+        "idx2": idx2,
+        "cycle1": cycle1,
+        "cycle2": cycle2,
+        "diff": diff,
+        "show_plot": show_plot,
+        "chains": build_chat_chains(),
+    }
+
+@st.fragment
+def data_selection_fragment(flag):
+    """
+    Inputs, data loading, summary table and cycle selection. Interacting with these widgets only reruns
+    this fragment; the page is rerun only when the selected comparison changes.
+    """
+    analysis = select_analysis(flag)
+    analysis_key = analysis["key"] if analysis else None
+    if analysis_key != st.session_state.get("analysis_key"):
+        # The answer being generated for the previous comparison is no longer needed
+        cancel_selection_tasks("chat")
+        st.session_state["analysis_key"] = analysis_key
+        st.session_state["analysis"] = analysis
+        if is_fragment_rerun():
+            st.rerun()
+
+@st.fragment
+def chart_fragment():
+    """
+    The itemization comparison chart of the selected cycles.
+    """
+    analysis = st.session_state.get("analysis")
+    if analysis is None or analysis["show_plot"] != 'yes':
+        return
 
-                with st.chat_message(message["role"], avatar=avatar_url):
-                    st.markdown(message["content"])
+    with span("plot", **analysis["trace_tags"]):
+        image = comparison_plot(analysis["data_key"], analysis["idx1"], analysis["idx2"], analysis["json_file"])
+        st.image(image, caption='\n\n', use_column_width=True)
 
-                if initial_response is not None and message["content"] == initial_response:
-                    displayed_initial_message = True
+@st.fragment
+def chat_fragment():
+    """
+    The chat with the Bill Analyzer. Submitting a message only reruns this fragment.
+    """
+    analysis = st.session_state.get("analysis")
+    if analysis is None:
+        return
+
+    cpu_started = time.thread_time()
+    session_id = analysis["session_id"]
+    trace_tags = analysis["trace_tags"]
+    loc = analysis["loc"]
+    get_session_history, first_chain, second_chain = analysis["chains"]
+
+    st.write('\nBill Analyzer is running! Please Wait...\n')
+
+    def chatbot_response(session_id: str, user_input: str, speculation=None, history_query=None):
+        # history_query is the question kept in the history instead of user_input, e.g. the full first query
+        # when the LLM is sent the compact drivers query
+        history = get_session_history(session_id)
+        # The LLM call is cancelled if the comparison changes before it answers (see await_selection_task)
+        selection = (analysis["key"], len(st.session_state.messages), user_input)
+        running = selection_task_running("chat", selection)
+        if not history.messages:
+            if not running and (refusal := check_budget(trace_tags["session"], prompt_tokens=first_prompt_tokens(user_input))) is not None:
+                return refusal
+
+            async def first_call():
+                if speculation is not None:
+                    # The comparison was predicted: its speculative answer is used unless it was for another question
+                    speculated = await speculation_result(speculation)
+                    if speculated is not None and speculated[0] == user_input:
+                        return speculated[1]
+                with span("llm_first", **trace_tags) as llm_span:
+                    if structured_output_enabled():
+                        # Terse JSON reasons, checked against the data and rendered locally (see tools/structured.py)
+                        answer, _, response = await astructured_first_answer(
+                            get_llm(), user_input, analysis["json_file"][analysis["idx1"]], analysis["json_file"][analysis["idx2"]]
+                        )
+                    else:
+                        response = await first_chain.ainvoke([HumanMessage(content=user_input)])
+                        answer = response.content
+                    record_llm_usage(llm_span, response)
+                return answer
+
+            answer = await_selection_task("chat", selection, first_call, "Bill Analyzer is explaining the comparison...")
+        else:
+            # Common questions about the same cycle pair are answered from the follow-up cache
+            followup_cache = get_followup_cache()
+            pair = pair_key(analysis["json_file"][analysis["idx1"]], analysis["json_file"][analysis["idx2"]])
+            if not running:
+                cached = followup_cache.lookup(pair, user_input) if followup_cache is not None else None
+                if cached is not None:
+                    history.add_user_message(user_input)
+                    history.add_ai_message(cached)
+                    return cached
+                # Trims the oldest follow-ups, or refuses, when the session would exceed its token budget
+                refusal = check_budget(trace_tags["session"], history, estimate_prompt_tokens(second_prompt, user_input))
+                if refusal is not None:
+                    return refusal
+            messages = history.messages + [HumanMessage(content=user_input)]
+
+            async def followup_call():
+                with span("llm_followup", **trace_tags) as llm_span:
+                    response = await second_chain.ainvoke(messages)
+                    record_llm_usage(llm_span, response)
+                return response.content
+
+            answer = await_selection_task("chat", selection, followup_call, "Bill Analyzer is answering...")
+            if followup_cache is not None:
+                followup_cache.store(pair, user_input, answer)
+        history.add_user_message(history_query or user_input)
+        history.add_ai_message(answer)
+        return answer
+
+    def interactive_chatbot(session_id: str, cycle1, cycle2, diff):
+        if "messages" not in st.session_state:
+            st.session_state.messages = []
+
+        initial_response = None
+
+        if not st.session_state.messages:
+            # The question sent to the LLM is kept while its answer is awaited over several reruns
+            pending = st.session_state.get("pending_first")
+            if pending is None or pending[0] != analysis["key"]:
+                pending = None
+                with span("drivers", **trace_tags):
+                    first_query, local_answer, llm_query = first_question(
+                        analysis["json_file"], analysis["idx1"], analysis["idx2"], cycle1, cycle2, diff, loc
+                    )
+                speculation = take_speculation(analysis)
+                if local_answer is not None:
+                    if speculation is not None:
+                        speculation.cancel()
+                    # Keep the full cycles in the history so that follow-up questions can still use them
+                    initial_response = local_answer
+                    get_session_history(session_id).add_user_message(first_query)
+                    get_session_history(session_id).add_ai_message(local_answer)
+                else:
+                    # A speculative answer is awaited like the LLM call it replaces (see chatbot_response).
+                    # The LLM gets the compact drivers query, while the history keeps the full cycles for follow-up questions
+                    pending = st.session_state["pending_first"] = (analysis["key"], llm_query, speculation, first_query)
+            if pending is not None:
+                initial_response = chatbot_response(session_id, pending[1], pending[2], pending[3])
+                del st.session_state["pending_first"]
+            st.session_state.messages.append(chat_entry("assistant", initial_response))
+
+        show_transcript(st.session_state.messages)
+
+        if prompt := st.chat_input("You:"):
+            st.session_state["pending_question"] = chat_entry("user", prompt)
+        # Shown until it is answered, and asked again if the comparison changes before that
+        if (question := st.session_state.get("pending_question")) is not None:
+            show_chat_entry(question)
+            answer = chat_entry("assistant", chatbot_response(session_id, question["content"]))
+            show_chat_entry(answer)
+            st.session_state.messages += [question, answer]
+            del st.session_state["pending_question"]
+
+    interactive_chatbot(session_id, analysis["cycle1"], analysis["cycle2"], analysis["diff"])
+    registry.observe("bill_analyzer_streamlit_cpu_seconds", {"run": "chat_fragment"}, time.thread_time() - cpu_started)
+
+def chat_entry(role, content):
+    """
+    Builds a transcript entry, with its markdown escaped once so that reruns do not prepare it again.
+    """
+    return {"role": role, "content": content, "markdown": content.replace("$", r"\$")}
 
-            if not displayed_initial_message and initial_response is not None:
-                with st.chat_message("assistant", avatar=assistant_avatar_user):
-                    st.markdown(initial_response.replace("$", r"\$"))
+def entry_markdown(message):
+    # Entries saved before the markdown was cached only have their content
+    return message.get("markdown") or message["content"].replace("$", r"\$")
 
-            if prompt := st.chat_input("You:"):
-                st.session_state.messages.append({"role": "user", "content": prompt})
-                with st.chat_message("user"):
-                    st.markdown(prompt.replace("$", "\$"))
+def show_chat_entry(message):
+    with st.chat_message(message["role"], avatar=assistant_avatar_user if message["role"] == "assistant" else None):
+        st.markdown(entry_markdown(message))
 
-                response = chatbot_response(session_id, prompt)
-                with st.chat_message("assistant", avatar=assistant_avatar_user):
-                    st.markdown(response.replace("$", r"\$"))
-                st.session_state.messages.append({"role": "assistant", "content": response})
+def earlier_transcript(messages, end):
+    """
+    Returns the markdown of messages[:end] as a single block. The transcript only grows, so the block is kept
+    in the session state and only the messages added since are appended to it.
+    """
+    count, text = st.session_state.get("earlier_transcript") or (0, "")
+    if count > end:
+        # A new transcript was started
+        count, text = 0, ""
+    if count < end:
+        lines = [f"**{'Bill Analyzer' if message['role'] == 'assistant' else 'You'}:** {entry_markdown(message)}"
+                 for message in messages[count:end]]
+        text = "\n\n---\n\n".join(([text] if text else []) + lines)
+        st.session_state["earlier_transcript"] = (end, text)
+    return text
+
+def show_transcript(messages):
+    """
+    Shows the last TRANSCRIPT_RECENT_TURNS turns of the chat. Older messages are rendered only when the analyst
+    asks for them, as one cached markdown block, so a rerun costs the same however long the session is.
+    """
+    start = max(len(messages) - 2 * TRANSCRIPT_RECENT_TURNS, 0)
+    # Start on a question, never between a question and its answer
+    if 0 < start and messages[start]["role"] == "assistant" and messages[start - 1]["role"] == "user":
+        start -= 1
+    if start:
+        # A fixed label keeps the toggle on while the transcript grows
+        if st.toggle("Show earlier messages", key="show_earlier_messages"):
+            with st.container(border=True):
+                st.markdown(earlier_transcript(messages, start))
+    for message in messages[start:]:
+        show_chat_entry(message)
 
-        interactive_chatbot(session_id, cycle1, cycle2, diff)
+def run_bill_analyzer(flag=False):
+    data_selection_fragment(flag)
+    chart_fragment()
+    chat_fragment()
 
 if __name__ == "__main__":
 
     st.write('\n\n\n\n\n')
-    run_bill_analyzer(flag=True)  # Pass flag=True to prompt for UUID, set to False for file upload
\ No newline at end of file
+    rerun_started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        run_bill_analyzer(flag=True)  # Pass flag=True to prompt for UUID, set to False for file upload
+    finally:
+        registry.observe("bill_analyzer_streamlit_rerun_seconds", {}, time.perf_counter() - rerun_started)
+        registry.observe("bill_analyzer_streamlit_cpu_seconds", {"run": "full"}, time.thread_time() - cpu_started)
+        for step in recomputed_steps:
+            registry.increment("bill_analyzer_streamlit_recomputed_total", {"step": step})
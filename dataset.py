@@ -140,4 +140,29 @@ second_prompt = ChatPromptTemplate.from_messages([
     If the user asks based on incorrect information or assumptions, gently correct them with accurate information in a respectful and informative manner. Address all aspects of the user's query comprehensively but concisely to ensure a satisfactory answer. Always maintain a respectful and professional tone, focusing on educating the user, even when correcting inaccuracies.
     The chatbot's name is 'Bill Analyzer'. Respond only to questions related to bill analysis, electricity, or energy as observed from the conversation memory. Respectfully decline questions not pertinent to these topics. By following these guidelines, your responses will be effective, informative, user-friendly, and concise, providing a positive interaction experience."""),
     ("human", "{input}"),
-])
\ No newline at end of file
+])
+trend_prompt = ChatPromptTemplate.from_messages([
+    ("system", """As a JSON Bill Analyzer, akin to an energy efficiency auditor for residential premises, you explain how the utility bills of a home changed over a window of consecutive billing cycles, in short, clear sentences that homeowners can easily understand.
+How to interpret the input:
+"cycles" is a table with one row per billing cycle, oldest first, with the columns given in "columns": the cycle id, start and end dates, consumption in kWh, usage cost in $, number of days, number of holidays, number of vacation days, the average temperature in Fahrenheit degrees, the rate plan ('tou' for Time of Use, 'tier' for tiered rates, 'unavailable' if unknown) and the usage cost in $ per appliance category ('unavailable' when the itemization is missing).
+"differences" lists, for every cycle after the first, the difference from the previous cycle ("from" and "to" are cycle ids). Values are the later cycle minus the earlier one; the itemization differences are [consumption in kWh, usage cost in $]. 'electricity_rates' tells whether the rates changed, where cycle1 is the earlier cycle and cycle2 the later one.
+The 'location' can be used to relate changes to the local weather and holidays.
+How to build the explanations:
+For every cycle after the first, explain in one to three sentences why its cost went up or down compared with the previous cycle, using the differences in days, temperature, holidays, vacation days, electricity rates and, when the itemization is available for both cycles, the appliance categories with the largest cost changes. Always mention the cost changes. Do not make assumptions about appliance categories when the itemization is unavailable.
+In the summary, describe the overall trend of the window in two or three sentences, such as seasonal patterns or a steady increase, and name the most expensive cycle.
+Output format:
+Respond with a JSON object only, without any other text, of the form {{"summary": "<overall trend>", "cycles": [{{"cycle": <cycle id>, "explanation": "<why the cost changed from the previous cycle>"}}]}}, with one entry per cycle after the first, in order.
+"""),
+    ("human", "{input}"),
+])
+structured_prompt = ChatPromptTemplate.from_messages([
+    first_prompt.messages[0],
+    ("system", """Output format:
+Instead of sentences, respond with a JSON object only, without any other text, of the form {{"reasons": [{{"driver": "<driver key>", "amount": <cost change in $ caused by this driver>, "direction": "<up or down>", "detail": "<the cause>"}}]}}.
+"driver" is one of the appliance categories of the itemization (such as "airConditioning" or "alwaysOn") or one of "days", "holidays", "vacation", "temperature", "rates" and "consumption".
+"direction" is "up" if the driver made cycle two more expensive than cycle one and "down" if it made cycle two cheaper. "amount" is the size of that effect in whole dollars and is never negative.
+"detail" states the cause in at most 12 words without repeating the amount, for example "the average temperature dropped from 72°F to 62°F".
+Provide 3 to 6 reasons in decreasing order of amount. The sentences, the summary of the cost change and the wording for the homeowner are added afterwards from your reasons.
+"""),
+    ("human", "{input}"),
+])
@@ -0,0 +1,313 @@
+import argparse
+import atexit
+import csv
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from tabulate import tabulate
+
+from tools.llm import MODEL_NAME
+from tools.metrics import registry, usage_listeners
+from tools.routing import SMALL_MODEL_NAME, estimate_tokens
+
+# Price in dollars per million prompt and completion tokens of the models the analyzer uses
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+# Prompt plus completion tokens an analysis session may use (0 means no budget)
+SESSION_TOKEN_BUDGET = int(os.getenv("BILL_ANALYZER_SESSION_TOKEN_BUDGET", "0"))
+
+# What happens when the next LLM call of a session would exceed its budget:
+#   'trim'   - drop the oldest follow-up exchanges from the chat history, refuse only if that is not enough (default)
+#   'refuse' - refuse the call
+BUDGET_ACTION = os.getenv("BILL_ANALYZER_BUDGET_ACTION", "trim").strip().lower()
+
+# Tokens kept free for the completion when checking whether a call fits in the budget
+RESERVED_COMPLETION_TOKENS = 600
+
+REFUSAL_MESSAGE = ("This analysis session has used its LLM token budget. "
+                   "Please start a new session to continue the analysis.")
+
+# File every LLM call is appended to, as CSV if it ends with '.csv' and as JSONL otherwise (unset: no report)
+USAGE_REPORT = os.getenv("BILL_ANALYZER_USAGE_REPORT")
+
+# Seconds between two writes of the buffered LLM calls to the usage report
+USAGE_REPORT_FLUSH_SECONDS = float(os.getenv("BILL_ANALYZER_USAGE_REPORT_FLUSH_SECONDS", "1"))
+
+# Sessions and users whose totals are kept, least recently used first out
+LEDGER_MAX_KEYS = 10000
+
+REPORT_FIELDS = ["time", "session", "uuid", "env", "stage", "model", "prompt_tokens", "completion_tokens", "cost_usd"]
+
+
+#Function to price the tokens of an LLM call
+def token_cost(model, prompt_tokens, completion_tokens):
+    """
+    Returns the price in dollars of an LLM call, using the gpt-4o prices for unknown models.
+    """
+    prompt_price, completion_price = MODEL_PRICES.get(model, MODEL_PRICES[MODEL_NAME])
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def _model(current, response):
+    model = (getattr(response, "response_metadata", None) or {}).get("model_name")
+    if model:
+        # e.g. 'gpt-4o-2024-05-13'
+        return next((name for name in sorted(MODEL_PRICES, key=len, reverse=True) if model.startswith(name)), model)
+    return SMALL_MODEL_NAME if current.tags.get("route") == "small" else MODEL_NAME
+
+
+class TokenLedger:
+    """
+    Token and cost totals of the LLM calls of the process, per session, UUID and environment.
+
+    Every call is also appended to the usage report, if one is configured (see USAGE_REPORT). Calls are buffered
+    and written by a background thread every USAGE_REPORT_FLUSH_SECONDS, as calls are recorded on the event loop
+    of the async handlers.
+
+    Args:
+        report_path (str, optional): The usage report file.
+    """
+    def __init__(self, report_path=USAGE_REPORT):
+        self.report_path = report_path
+        self._lock = threading.Lock()
+        self._totals = {"session": OrderedDict(), "uuid": OrderedDict(), "env": OrderedDict()}
+        # Rows not written yet. _write_lock keeps concurrent flushes in order.
+        self._buffer = []
+        self._write_lock = threading.Lock()
+        self._writer = None
+
+    def record(self, stage, session, uuid, env, model, prompt_tokens, completion_tokens):
+        """
+        Adds one LLM call to the totals and to the usage report.
+        """
+        cost = token_cost(model, prompt_tokens, completion_tokens)
+        row = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "session": session, "uuid": uuid, "env": env, "stage": stage,
+               "model": model, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cost_usd": round(cost, 6)}
+        with self._lock:
+            for kind, totals in self._totals.items():
+                key = row[kind]
+                if key is None:
+                    continue
+                total = totals.setdefault(key, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+                totals.move_to_end(key)
+                total["calls"] += 1
+                total["prompt_tokens"] += prompt_tokens
+                total["completion_tokens"] += completion_tokens
+                total["cost_usd"] += cost
+                while len(totals) > LEDGER_MAX_KEYS:
+                    totals.popitem(last=False)
+            if self.report_path:
+                self._buffer.append(row)
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_forever, daemon=True, name="usage-report-writer")
+                    self._writer.start()
+        registry.increment("bill_analyzer_llm_cost_usd_total", {"env": env or "none"}, cost)
+
+    def _write_forever(self):
+        while True:
+            time.sleep(USAGE_REPORT_FLUSH_SECONDS)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered calls to the usage report now, e.g. before reading it.
+        """
+        with self._write_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return
+            try:
+                write_rows(self.report_path, rows, append=True)
+            except OSError as e:
+                print(f"Could not write {len(rows)} LLM calls to '{self.report_path}': {e}")
+
+    def record_usage(self, current, prompt_tokens, completion_tokens, response):
+        """
+        Usage listener of tools.metrics: records the call of an LLM span with its uuid, env and session tags.
+        """
+        self.record(current.name, current.tags.get("session"), current.tags.get("uuid"), current.tags.get("env"),
+                    _model(current, response), prompt_tokens, completion_tokens)
+
+    def totals(self, kind, key):
+        """
+        Returns the totals of a session, UUID or environment (kind 'session', 'uuid' or 'env').
+        """
+        with self._lock:
+            return dict(self._totals[kind].get(key) or {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+
+    def session_tokens(self, session):
+        total = self.totals("session", session)
+        return total["prompt_tokens"] + total["completion_tokens"]
+
+
+ledger = TokenLedger()
+usage_listeners.append(ledger.record_usage)
+atexit.register(ledger.flush)
+
+
+#Function to shorten a chat history
+def trim_history(history, max_tokens):
+    """
+    Drops the oldest follow-up exchanges of a chat history until it fits in max_tokens (see estimate_tokens).
+    The first comparison and its answer are always kept, as the follow-up questions refer to them.
+
+    Args:
+        history (BaseChatMessageHistory): The chat history.
+        max_tokens (int): The tokens the history may use.
+
+    Returns:
+        int: The number of messages dropped.
+    """
+    messages = history.messages
+    head, tail = messages[:2], messages[2:]
+    while tail and estimate_tokens(head + tail) > max_tokens:
+        tail = tail[2:]
+    dropped = len(messages) - len(head) - len(tail)
+    if dropped:
+        history.clear()
+        history.add_messages(head + tail)
+    return dropped
+
+
+#Function to estimate the prompt tokens of a call
+def estimate_prompt_tokens(prompt, query):
+    """
+    Estimates the tokens of a prompt template filled with a question, including its system message and
+    few-shot examples (see estimate_tokens). The chat history sent with the call is not included.
+
+    Args:
+        prompt (ChatPromptTemplate): The prompt, e.g. first_prompt.
+        query (str): The question, the 'input' of the prompt.
+
+    Returns:
+        int: The estimated tokens.
+    """
+    return estimate_tokens(prompt.format_messages(input=query))
+
+
+#Function to check whether optional LLM calls fit in the budget of a session
+def within_budget(session, prompt_tokens, calls=1):
+    """
+    Returns True if a number of calls of the given prompt tokens, each with RESERVED_COMPLETION_TOKENS, fit in
+    what is left of SESSION_TOKEN_BUDGET. Unlike check_budget, nothing is trimmed or counted as refused, so it suits
+    calls the analyst did not ask for, e.g. speculative ones. Always True without a budget.
+    """
+    if SESSION_TOKEN_BUDGET <= 0:
+        return True
+    return ledger.session_tokens(session) + calls * (prompt_tokens + RESERVED_COMPLETION_TOKENS) <= SESSION_TOKEN_BUDGET
+
+
+#Function to enforce the token budget of a session before an LLM call
+def check_budget(session, history=None, prompt_tokens=0):
+    """
+    Checks that the next LLM call of a session fits in SESSION_TOKEN_BUDGET, counting its prompt, the chat history
+    it sends and RESERVED_COMPLETION_TOKENS. With BUDGET_ACTION 'trim', the history is trimmed to fit if needed.
+
+    Args:
+        session (str): The session, as in the 'session' tag of the LLM spans.
+        history (BaseChatMessageHistory, optional): The chat history sent with the call.
+        prompt_tokens (int, optional): The tokens of the prompt besides the history, see estimate_prompt_tokens.
+
+    Returns:
+        str or None: The message to answer with instead of calling the LLM, or None if the call may proceed.
+    """
+    if SESSION_TOKEN_BUDGET <= 0:
+        return None
+    remaining = SESSION_TOKEN_BUDGET - ledger.session_tokens(session) - prompt_tokens - RESERVED_COMPLETION_TOKENS
+    history_tokens = estimate_tokens(history.messages) if history is not None else 0
+    if history_tokens <= remaining:
+        return None
+    # Only trim if keeping just the first comparison is enough, so a refused session keeps its history
+    if history is not None and BUDGET_ACTION == "trim" and estimate_tokens(history.messages[:2]) <= remaining:
+        trim_history(history, remaining)
+        registry.increment("bill_analyzer_budget_total", {"outcome": "trimmed"})
+        return None
+    registry.increment("bill_analyzer_budget_total", {"outcome": "refused"})
+    return REFUSAL_MESSAGE
+
+
+#Function to write report rows as CSV or JSONL
+def write_rows(path, rows, append=False):
+    """
+    Writes rows to a CSV file if the path ends with '.csv', and to a JSONL file otherwise.
+    A CSV header is written unless rows are appended to an existing file.
+    """
+    exists = append and os.path.exists(path) and os.path.getsize(path) > 0
+    with open(path, "a" if append else "w", newline="") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else REPORT_FIELDS)
+            if not exists:
+                writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+#Function to read a usage report
+def read_rows(path):
+    """
+    Reads the LLM calls of a CSV or JSONL usage report.
+    """
+    with open(path, "r", newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for row in rows:
+        row["prompt_tokens"], row["completion_tokens"] = int(row["prompt_tokens"]), int(row["completion_tokens"])
+        row["cost_usd"] = float(row["cost_usd"])
+    return rows
+
+
+#Function to aggregate a usage report
+def summarise(rows, by):
+    """
+    Aggregates LLM calls by one or more report fields, e.g. ['env'] or ['uuid', 'stage'].
+
+    Returns:
+        list of dict: One row per group with its calls, tokens and cost, most expensive first.
+    """
+    groups = {}
+    for row in rows:
+        key = tuple(row.get(field) or "none" for field in by)
+        group = groups.setdefault(key, dict(zip(by, key), calls=0, prompt_tokens=0, completion_tokens=0, cost_usd=0.0))
+        group["calls"] += 1
+        group["prompt_tokens"] += row["prompt_tokens"]
+        group["completion_tokens"] += row["completion_tokens"]
+        group["cost_usd"] += row["cost_usd"]
+    summary = sorted(groups.values(), key=lambda group: group["cost_usd"], reverse=True)
+    for group in summary:
+        group["cost_usd"] = round(group["cost_usd"], 6)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise the LLM usage report (BILL_ANALYZER_USAGE_REPORT).")
+    parser.add_argument("report", help="The CSV or JSONL usage report.")
+    parser.add_argument("--by", default="session", help="Comma-separated fields to group by, among "
+                                                         f"{', '.join(REPORT_FIELDS[1:6])}.")
+    parser.add_argument("--output", help="Write the summary to this CSV or JSONL file.")
+    args = parser.parse_args()
+
+    by = [field.strip() for field in args.by.split(",") if field.strip()]
+    unknown = [field for field in by if field not in REPORT_FIELDS[1:6]]
+    if unknown:
+        parser.error(f"Unknown fields: {', '.join(unknown)}")
+    summary = summarise(read_rows(args.report), by)
+    print(tabulate([list(group.values()) for group in summary], headers=by + ["Calls", "Prompt tokens", "Completion tokens", "Cost ($)"],
+                   tablefmt="grid"))
+    if args.output:
+        write_rows(args.output, summary)
+        print(f"\nSummary written to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import gzip
+import json
+import os
+import threading
+import time
+
+ARCHIVE_SUFFIX = ".archive"
+INDEX_FILE = "index.jsonl"
+
+# Start a new segment once the current one is larger than this
+SEGMENT_MAX_BYTES = int(os.getenv("BILL_ANALYZER_ARCHIVE_SEGMENT_MB", "64")) * 1024 * 1024
+
+
+def _segment_name(number):
+    return f"segment-{number:05d}.jsonl.gz"
+
+
+class PayloadArchive:
+    """
+    Append-only archive of raw API payloads of one type, keyed by UUID.
+
+    Payloads are stored as JSON lines in gzip segments. Every record is compressed as its own gzip member,
+    so a record can be read on its own with a single seek, while a whole segment is still a valid gzip
+    file that can be scanned sequentially. 'index.jsonl' maps every UUID to (segment, offset, length);
+    when a UUID is appended again, its latest record wins.
+
+    Args:
+        path (str): The archive directory. It is created on the first append.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self._lock = threading.Lock()
+        self._index_mtime = None
+        self._load_index()
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        try:
+            mtime = os.path.getmtime(index_path)
+        except FileNotFoundError:
+            return
+        index = {}
+        with open(index_path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                index[entry["uuid"]] = (entry["segment"], entry["offset"], entry["length"])
+        self.index = index
+        self._index_mtime = mtime
+
+    def refresh(self):
+        """
+        Reloads the index if another process appended to the archive since it was loaded.
+        """
+        try:
+            mtime = os.path.getmtime(os.path.join(self.path, INDEX_FILE))
+        except FileNotFoundError:
+            return
+        if mtime != self._index_mtime:
+            with self._lock:
+                self._load_index()
+
+    def __contains__(self, uuid):
+        return uuid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def uuids(self):
+        return sorted(self.index)
+
+    def get(self, uuid):
+        """
+        Reads the payload of a user.
+
+        Args:
+            uuid (str): The unique identifier of the user.
+
+        Returns:
+            dict or None: The payload, or None if the user is not archived.
+        """
+        location = self.index.get(uuid)
+        if location is None:
+            return None
+        segment, offset, length = location
+        with open(os.path.join(self.path, segment), "rb") as f:
+            f.seek(offset)
+            record = json.loads(gzip.decompress(f.read(length)))
+        return record["data"]
+
+    def append(self, uuid, data):
+        """
+        Appends the payload of a user, replacing any earlier payload of the same user.
+
+        Args:
+            uuid (str): The unique identifier of the user.
+            data (dict): The raw API payload.
+        """
+        member = gzip.compress((json.dumps({"uuid": uuid, "data": data}, separators=(",", ":")) + "\n").encode("utf-8"))
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            segments = sorted(name for name in os.listdir(self.path) if name.startswith("segment-"))
+            segment = segments[-1] if segments else _segment_name(0)
+            segment_path = os.path.join(self.path, segment)
+            if os.path.exists(segment_path) and os.path.getsize(segment_path) + len(member) > SEGMENT_MAX_BYTES:
+                segment = _segment_name(len(segments))
+                segment_path = os.path.join(self.path, segment)
+
+            with open(segment_path, "ab") as f:
+                offset = f.tell()
+                f.write(member)
+            with open(os.path.join(self.path, INDEX_FILE), "a") as f:
+                f.write(json.dumps({"uuid": uuid, "segment": segment, "offset": offset, "length": len(member)}) + "\n")
+            self.index[uuid] = (segment, offset, len(member))
+
+    def scan(self):
+        """
+        Reads every payload in file order, one segment at a time, so the segments are read sequentially.
+        Superseded records of re-appended users are skipped.
+
+        Yields:
+            tuple: (uuid, data) for every archived user.
+        """
+        by_segment = {}
+        for uuid, (segment, offset, length) in self.index.items():
+            by_segment.setdefault(segment, []).append((offset, length, uuid))
+        for segment in sorted(by_segment):
+            with open(os.path.join(self.path, segment), "rb") as f:
+                for offset, length, uuid in sorted(by_segment[segment]):
+                    f.seek(offset)
+                    yield uuid, json.loads(gzip.decompress(f.read(length)))["data"]
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+#Function to open an archive once per process
+def open_archive(path):
+    """
+    Returns the archive at the given path, sharing one loaded index per process.
+
+    Args:
+        path (str): The archive directory.
+
+    Returns:
+        PayloadArchive or None: The archive, or None if the directory does not exist.
+    """
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        return None
+    with _archives_lock:
+        if path not in _archives:
+            _archives[path] = PayloadArchive(path)
+    archive = _archives[path]
+    archive.refresh()
+    return archive
+
+
+#Function to find the archive that replaces a json_datas style file
+def archive_for_file(file_path):
+    """
+    Maps '<root>/<payload_dir>/<uuid>.json' to the archive '<root>/<payload_dir>.archive' and the UUID.
+
+    Args:
+        file_path (str): The path of the JSON payload file.
+
+    Returns:
+        tuple: (PayloadArchive or None, uuid).
+    """
+    directory, name = os.path.split(os.path.abspath(file_path))
+    uuid = name[:-len(".json")] if name.endswith(".json") else name
+    return open_archive(directory + ARCHIVE_SUFFIX), uuid
+
+
+#Function to convert a json_datas style directory into archives
+def convert_directory(data_dir, out_dir=None, payload_dirs=None):
+    """
+    Converts the payload sub-directories of a json_datas style directory into archives.
+
+    Every '<data_dir>/<payload_dir>/<uuid>.json' is appended to '<out_dir>/<payload_dir>.archive'.
+
+    Args:
+        data_dir (str): The directory holding the payload sub-directories.
+        out_dir (str, optional): Where to write the archives. Defaults to data_dir.
+        payload_dirs (list of str, optional): The sub-directories to convert. Defaults to every sub-directory.
+
+    Returns:
+        dict: The number of payloads converted per sub-directory.
+    """
+    out_dir = out_dir or data_dir
+    if payload_dirs is None:
+        payload_dirs = sorted(name for name in os.listdir(data_dir)
+                              if os.path.isdir(os.path.join(data_dir, name)) and not name.endswith(ARCHIVE_SUFFIX))
+    converted = {}
+    for directory in payload_dirs:
+        source = os.path.join(data_dir, directory)
+        if not os.path.isdir(source):
+            continue
+        archive = PayloadArchive(os.path.join(out_dir, directory + ARCHIVE_SUFFIX))
+        count = 0
+        for name in sorted(os.listdir(source)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(source, name), "r") as f:
+                    data = json.load(f)
+            except json.JSONDecodeError:
+                print(f"Skipping '{os.path.join(source, name)}': invalid JSON.")
+                continue
+            archive.append(name[:-len(".json")], data)
+            count += 1
+        converted[directory] = count
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compressed, indexed archives of raw API payloads.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="Convert a json_datas style directory into archives.")
+    convert_parser.add_argument("--data-dir", required=True)
+    convert_parser.add_argument("--out", default=None, help="Output directory. Defaults to --data-dir.")
+    scan_parser = subparsers.add_parser("scan", help="Read every payload of an archive sequentially.")
+    scan_parser.add_argument("path")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "convert":
+        for directory, count in convert_directory(args.data_dir, args.out).items():
+            print(f"{directory}: {count} payloads archived.")
+    else:
+        count = sum(1 for _ in PayloadArchive(args.path).scan())
+        print(f"Scanned {count} payloads.")
+    print(f"Done in {time.perf_counter() - started:.2f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import asyncio
+
+import aiohttp
+
+from tools.utils import HostError, location_url, itemization_url, vacation_url
+
+
+#Async API call to fetch one JSON payload
+async def fetch_json_async(session, api_url, raise_host_errors=False):
+    """
+    Fetches a JSON payload without blocking the event loop.
+
+    Args:
+        session (aiohttp.ClientSession): The HTTP session to use.
+        api_url (str): The url to fetch.
+        raise_host_errors (bool, optional): Raise HostError for transport errors and 5xx responses instead of returning None.
+
+    Returns:
+        dict or None: The parsed JSON data if the request is successful, or None if an error occurs.
+    """
+    try:
+        async with session.get(api_url) as response:
+            if response.status == 200:
+                return await response.json(content_type=None)
+            print(f"Failed to fetch data: {response.status}")
+            if raise_host_errors and response.status >= 500:
+                raise HostError(f"HTTP {response.status}")
+            return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error fetching data: {e}")
+        if raise_host_errors:
+            raise HostError(str(e)) from e
+        return None
+
+
+#Async API call to fetch the three payloads of a user concurrently
+async def fetch_user_data_async(session, uuid, env_url, access_token, raise_host_errors=False):
+    """
+    Fetches a user's consumption, location and vacation data concurrently.
+
+    Args:
+        session (aiohttp.ClientSession): The HTTP session to use.
+        uuid (str): The unique identifier of the user.
+        env_url (str): The base url of the environment.
+        access_token (str): The access token for the environment.
+        raise_host_errors (bool, optional): Raise HostError if any request failed because of the host, see fetch_json_async.
+
+    Returns:
+        tuple: The (itemization_data, metadata, vacation_data) dictionaries. An entry is None if its request failed.
+    """
+    return tuple(await asyncio.gather(
+        fetch_json_async(session, itemization_url(uuid, env_url, access_token), raise_host_errors),
+        fetch_json_async(session, location_url(uuid, env_url, access_token), raise_host_errors),
+        fetch_json_async(session, vacation_url(uuid, env_url, access_token), raise_host_errors),
+    ))
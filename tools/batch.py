@@ -0,0 +1,119 @@
+import os
+
+from tools.archive import ARCHIVE_SUFFIX, open_archive
+from tools.utils import load_json_file
+from tools.preprocessing import preprocess
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "json_datas")
+
+# Sub-directories of a json_datas style directory, one per API payload type
+PAYLOAD_DIRS = {
+    "itemization": "itemization_output",
+    "metadata": "metadata_output",
+    "vacation": "vacation_output",
+}
+
+
+#Function to list all users available in a json_datas style directory
+def list_uuids(data_dir=DEFAULT_DATA_DIR):
+    """
+    Lists the UUIDs of all users that have an itemization, metadata and vacation payload.
+    A payload sub-directory that has been converted to an archive (see tools.archive) is read from the archive index.
+
+    Args:
+        data_dir (str, optional): The directory holding the payload sub-directories. Defaults to json_datas.
+
+    Returns:
+        list of str: The sorted UUIDs.
+    """
+    uuid_sets = []
+    for directory in PAYLOAD_DIRS.values():
+        path = os.path.join(data_dir, directory)
+        if os.path.isdir(path):
+            uuid_sets.append({name[:-len(".json")] for name in os.listdir(path) if name.endswith(".json")})
+            continue
+        archive = open_archive(path + ARCHIVE_SUFFIX)
+        if archive is None:
+            return []
+        uuid_sets.append(set(archive.uuids()))
+    return sorted(set.intersection(*uuid_sets))
+
+
+#Function to build the path of a user's payload file
+def payload_path(data_dir, payload_type, uuid):
+    """
+    Builds the path of a payload file of a user.
+
+    Args:
+        data_dir (str): The directory holding the payload sub-directories.
+        payload_type (str): One of 'itemization', 'metadata' or 'vacation'.
+        uuid (str): The unique identifier of the user.
+
+    Returns:
+        str: The path of the JSON file.
+    """
+    return os.path.join(data_dir, PAYLOAD_DIRS[payload_type], f"{uuid}.json")
+
+
+#Function to check that a user has all three payloads
+def has_user_payloads(uuid, data_dir=DEFAULT_DATA_DIR):
+    """
+    Checks that the itemization, metadata and vacation payloads of a user exist, either as files or in an archive.
+
+    Args:
+        uuid (str): The unique identifier of the user.
+        data_dir (str, optional): The directory holding the payload sub-directories. Defaults to json_datas.
+
+    Returns:
+        bool: True if all three payloads can be loaded.
+    """
+    for payload_type in PAYLOAD_DIRS:
+        if os.path.exists(payload_path(data_dir, payload_type, uuid)):
+            continue
+        archive = open_archive(os.path.join(data_dir, PAYLOAD_DIRS[payload_type]) + ARCHIVE_SUFFIX)
+        if archive is None or uuid not in archive:
+            return False
+    return True
+
+
+#Function to load the three raw payloads of a user
+def load_user_payloads(uuid, data_dir=DEFAULT_DATA_DIR):
+    """
+    Loads the raw itemization, metadata and vacation payloads of a user.
+
+    Args:
+        uuid (str): The unique identifier of the user.
+        data_dir (str, optional): The directory holding the payload sub-directories. Defaults to json_datas.
+
+    Returns:
+        tuple: The (itemization_data, metadata, vacation_data) dictionaries. An entry is None if its file could not be loaded.
+    """
+    return tuple(load_json_file(payload_path(data_dir, payload_type, uuid)) for payload_type in PAYLOAD_DIRS)
+
+
+#Function to load and preprocess every user of a json_datas style directory
+def iter_preprocessed_users(data_dir=DEFAULT_DATA_DIR, uuids=None):
+    """
+    Loads and preprocesses users one at a time.
+
+    Users whose payloads are missing or cannot be preprocessed are reported and skipped.
+
+    Args:
+        data_dir (str, optional): The directory holding the payload sub-directories. Defaults to json_datas.
+        uuids (list of str, optional): The users to process. Defaults to every user in data_dir.
+
+    Yields:
+        tuple: (uuid, processed_data) for every user that was preprocessed successfully.
+    """
+    for uuid in uuids if uuids is not None else list_uuids(data_dir):
+        itemization_data, metadata, vacation_data = load_user_payloads(uuid, data_dir)
+        if itemization_data is None or metadata is None or vacation_data is None:
+            print(f"Skipping '{uuid}': missing payloads.")
+            continue
+
+        processed_data = preprocess(itemization_data, metadata, vacation_data, True)
+        if isinstance(processed_data, str):
+            print(f"Skipping '{uuid}': {processed_data}")
+            continue
+
+        yield uuid, processed_data
@@ -0,0 +1,326 @@
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import matplotlib
+matplotlib.use("Agg")  # Render charts off-screen while benchmarking
+
+from tabulate import tabulate
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.runnables.history import RunnableWithMessageHistory
+
+from dataset import first_prompt
+from tools.batch import DEFAULT_DATA_DIR, PAYLOAD_DIRS, list_uuids, load_user_payloads, payload_path
+from tools.chat import display_billing_cycles, plot_itemization_comparison, build_first_query
+from tools.llm import LLM_BACKENDS, get_chat_model
+from tools.preprocessing import preprocess
+from tools.synthetic import amplify_user_payloads
+from tools.utils import load_json_file, calculate_difference, replace_braces
+
+# Stages of the analyzer pipeline, in the order they run
+STAGES = [
+    "load_json_file",
+    "preprocess",
+    "calculate_difference",
+    "replace_braces",
+    "display_billing_cycles",
+    "plot_itemization_comparison",
+    "llm_stub",
+]
+
+
+class StageRecorder:
+    """
+    Collects the wall-clock duration or the peak traced memory of every pipeline stage.
+
+    Timing and memory are recorded in separate passes, because tracemalloc slows down the code it traces.
+
+    Args:
+        trace_memory (bool): Whether to record peak memory instead of durations.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.timings = defaultdict(list)
+        self.peaks = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                self.peaks[name] = max(self.peaks[name], peak)
+            else:
+                self.timings[name].append(elapsed)
+
+
+#Function to build a first_prompt chain backed by a canned LLM
+def build_stub_chain(backend="stub"):
+    """
+    Builds the first comparison chain with the LLM replaced by a canned response, so the prompt
+    assembly and history handling are measured without network calls.
+
+    Args:
+        backend (str, optional): 'stub' for a canned response, or one of tools.llm.LLM_BACKENDS, e.g. 'replay'
+            to answer from a recorded cassette with its configured latency.
+
+    Returns:
+        RunnableWithMessageHistory: The stubbed chain.
+    """
+    if backend == "stub":
+        llm = FakeListChatModel(responses=["The cost changed because of the number of days and the itemization changes."])
+    else:
+        llm = get_chat_model(backend)
+    store = {}
+
+    def get_session_history(session_id: str):
+        if session_id not in store:
+            store[session_id] = InMemoryChatMessageHistory()
+        return store[session_id]
+
+    return RunnableWithMessageHistory(first_prompt | llm, get_session_history)
+
+
+#Function to run the analyzer pipeline for one user
+def run_user_pipeline(data_dir, uuid, recorder, chain):
+    """
+    Runs the analyzer pipeline for one user, comparing the latest cycle of the analysis window with the previous one.
+
+    Args:
+        data_dir (str): The directory holding the payload sub-directories.
+        uuid (str): The unique identifier of the user.
+        recorder (StageRecorder): The recorder the stages are measured with.
+        chain (RunnableWithMessageHistory): The stubbed first comparison chain.
+    """
+    with recorder.stage("load_json_file"):
+        itemization_data = load_json_file(payload_path(data_dir, "itemization", uuid))
+        metadata = load_json_file(payload_path(data_dir, "metadata", uuid))
+        vacation_data = load_json_file(payload_path(data_dir, "vacation", uuid))
+
+    with recorder.stage("preprocess"):
+        processed_data = preprocess(itemization_data, metadata, vacation_data, True)
+    if isinstance(processed_data, str):
+        print(f"Skipping '{uuid}': {processed_data}")
+        return
+
+    json_file = processed_data.get("usageChartDataList", [])[-15:-2]
+    if len(json_file) < 2:
+        return
+    idx1, idx2 = len(json_file) - 2, len(json_file) - 1
+
+    with recorder.stage("calculate_difference"):
+        difference = calculate_difference(json_file[idx1], json_file[idx2])
+
+    with recorder.stage("replace_braces"):
+        cycle1 = replace_braces(json_file[idx1])
+        cycle2 = replace_braces(json_file[idx2])
+        diff = replace_braces(difference)
+
+    with recorder.stage("display_billing_cycles"):
+        display_billing_cycles(json_file)
+
+    if json_file[idx1]["itemizationDetailsList"] != "unavailable" and json_file[idx2]["itemizationDetailsList"] != "unavailable":
+        with recorder.stage("plot_itemization_comparison"):
+            plot_itemization_comparison(json_file[idx1], json_file[idx2])
+
+    with recorder.stage("llm_stub"):
+        first_query = build_first_query(cycle1, cycle2, diff, processed_data['location'])
+        chain.invoke({"input": first_query}, config={"configurable": {"session_id": uuid}})
+
+
+#Function to write amplified copies of the sample users
+def write_amplified_users(data_dir, uuids, factor, out_dir):
+    """
+    Writes synthetic users with a history `factor` times longer than the originals, in the json_datas layout.
+
+    Args:
+        data_dir (str): The directory holding the original payloads.
+        uuids (list of str): The users to amplify.
+        factor (int): How many times longer the synthetic histories should be.
+        out_dir (str): The directory to write the synthetic payloads to.
+    """
+    for directory in PAYLOAD_DIRS.values():
+        os.makedirs(os.path.join(out_dir, directory), exist_ok=True)
+    for uuid in uuids:
+        payloads = amplify_user_payloads(*load_user_payloads(uuid, data_dir), factor)
+        for payload_type, payload in zip(PAYLOAD_DIRS, payloads):
+            with open(payload_path(out_dir, payload_type, uuid), "w") as f:
+                json.dump(payload, f)
+
+
+#Function to compute a percentile of a list of durations
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a list of numbers.
+
+    Args:
+        values (list of float): The values.
+        pct (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, or 0.0 for an empty list.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+#Function to benchmark the pipeline over a set of users
+def benchmark_users(data_dir, uuids, repeat, backend="stub"):
+    """
+    Benchmarks every pipeline stage over a set of users.
+
+    Args:
+        data_dir (str): The directory holding the payload sub-directories.
+        uuids (list of str): The users to run the pipeline for.
+        repeat (int): How many timed passes to run over all users.
+        backend (str, optional): The LLM backend, see build_stub_chain.
+
+    Returns:
+        dict: Per-stage statistics with durations in milliseconds and peak memory in KiB.
+    """
+    chain = build_stub_chain(backend)
+
+    # Warm-up pass, so imports, font caches and holiday tables are not attributed to the first user
+    run_user_pipeline(data_dir, uuids[0], StageRecorder(), chain)
+
+    timer = StageRecorder()
+    for _ in range(repeat):
+        for uuid in uuids:
+            run_user_pipeline(data_dir, uuid, timer, chain)
+
+    memory = StageRecorder(trace_memory=True)
+    tracemalloc.start()
+    try:
+        for uuid in uuids:
+            run_user_pipeline(data_dir, uuid, memory, chain)
+    finally:
+        tracemalloc.stop()
+
+    stages = {}
+    for name in STAGES:
+        durations = [duration * 1000 for duration in timer.timings.get(name, [])]
+        if not durations:
+            continue
+        stages[name] = {
+            "count": len(durations),
+            "total_ms": round(sum(durations), 3),
+            "mean_ms": round(sum(durations) / len(durations), 3),
+            "p50_ms": round(percentile(durations, 50), 3),
+            "p95_ms": round(percentile(durations, 95), 3),
+            "max_ms": round(max(durations), 3),
+            "peak_kib": round(memory.peaks.get(name, 0) / 1024, 1),
+        }
+    return stages
+
+
+#Function to identify the code that was benchmarked
+def git_revision():
+    """
+    Returns the current git commit of the repository, or None outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#Function to print a results table, optionally against an earlier run
+def print_results(results, baseline=None):
+    """
+    Prints the per-stage results of every scale, with the change of the mean duration versus a baseline run if given.
+
+    Args:
+        results (dict): The benchmark results.
+        baseline (dict, optional): The results of an earlier run loaded from its results file.
+    """
+    for scale, scale_results in results["scales"].items():
+        print(f"\nScale {scale} ({scale_results['users']} users, {scale_results['cycles']} billing cycles)")
+        rows = []
+        for name, stats in scale_results["stages"].items():
+            row = [name, stats["count"], stats["mean_ms"], stats["p50_ms"], stats["p95_ms"], stats["max_ms"], stats["peak_kib"]]
+            if baseline:
+                old = baseline.get("scales", {}).get(scale, {}).get("stages", {}).get(name)
+                row.append(f"{(stats['mean_ms'] / old['mean_ms'] - 1) * 100:+.1f}%" if old and old["mean_ms"] else "n/a")
+            rows.append(row)
+        headers = ["Stage", "Runs", "Mean (ms)", "p50 (ms)", "p95 (ms)", "Max (ms)", "Peak (KiB)"]
+        if baseline:
+            headers.append("Mean vs baseline")
+        print(tabulate(rows, headers=headers, tablefmt="grid"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Bill Analyzer pipeline over the sample users, with the LLM stubbed out.")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--scales", default="1,10,100", help="Comma separated history amplification factors.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes over all users per scale.")
+    parser.add_argument("--limit", type=int, default=None, help="Only benchmark the first N users.")
+    parser.add_argument("--output", default="bench_output.json", help="Machine-readable results file.")
+    parser.add_argument("--compare", default=None, help="Results file of an earlier run to compare against.")
+    parser.add_argument("--llm", default="stub", choices=("stub",) + LLM_BACKENDS,
+                        help="LLM of the llm_stub stage: a canned response, or a tools.llm backend, e.g. 'replay'.")
+    args = parser.parse_args()
+
+    uuids = list_uuids(args.data_dir)[:args.limit]
+    if not uuids:
+        print(f"No users found in '{args.data_dir}'.")
+        return
+
+    results = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "llm": args.llm,
+        "scales": {},
+    }
+
+    for factor in [int(scale) for scale in args.scales.split(",")]:
+        data_dir = args.data_dir
+        temp_dir = None
+        if factor > 1:
+            temp_dir = tempfile.mkdtemp(prefix=f"bill_analyzer_{factor}x_")
+            write_amplified_users(args.data_dir, uuids, factor, temp_dir)
+            data_dir = temp_dir
+        try:
+            print(f"Benchmarking {len(uuids)} users at {factor}x history...")
+            cycles = sum(len(load_user_payloads(uuid, data_dir)[0]["payload"]["usageChartDataList"]) for uuid in uuids)
+            results["scales"][f"{factor}x"] = {
+                "users": len(uuids),
+                "cycles": cycles,
+                "stages": benchmark_users(data_dir, uuids, args.repeat, args.llm),
+            }
+        finally:
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = load_json_file(args.compare) if args.compare else None
+    print_results(results, baseline)
+    print(f"\nResults written to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
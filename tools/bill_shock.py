@@ -0,0 +1,188 @@
+import argparse
+import json
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from tools.cohort_store import CohortStore
+
+# Scale of the median absolute deviation to a standard deviation for normally distributed data
+MAD_SCALE = 1.4826
+
+# Number of previous cycles a latest cycle is compared with
+TRAILING_CYCLES = 6
+
+# Same-month cycles of up to this many earlier years are used as the seasonal baseline
+SEASON_YEARS = 5
+
+# The two most recent cycles are left out of the analysis window of the apps (usageChartDataList[-15:-2])
+SKIP_RECENT = 2
+
+
+def _nanmedian(values):
+    """
+    Row-wise median ignoring NaN. Rows without any value give NaN, without a warning.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmedian(values, axis=1) if len(values) else np.empty(0)
+
+
+def _robust_z(values, baseline, floor_ratio=0.05, min_scale=0.5):
+    """
+    Robust z-score of values against the rows of baseline: (value - median) / (1.4826 * MAD).
+    The scale is floored to a share of the median so that very flat histories do not produce huge scores.
+    Returns the z-scores, the baseline medians and the scales.
+    """
+    median = _nanmedian(baseline)
+    mad = _nanmedian(np.abs(baseline - median[:, None]))
+    scale = np.fmax(MAD_SCALE * mad, np.fmax(floor_ratio * np.abs(median), min_scale))
+    return (values - median) / scale, median, scale
+
+
+#Function to rank users by how unusual their latest bill is
+def detect_bill_shock(store, trailing_cycles=TRAILING_CYCLES, season_years=SEASON_YEARS, skip_recent=SKIP_RECENT, min_increase=10):
+    """
+    Scores the latest analysed billing cycle of every user of a cohort store against the user's own history.
+
+    All users are scored at once with NumPy: the cycles of interest and their baselines are gathered into
+    (users x cycles) matrices through the store's offset index. Costs and consumptions are compared per day
+    so that longer cycles do not look like jumps. For cost per day and consumption per day, the latest cycle gets
+    a robust z-score against the trailing_cycles previous cycles, and against the cycles ending in the same month of
+    up to season_years earlier years (using the trailing spread, as a user has few same-month cycles). The shock score is
+    the smaller of the two cost z-scores, so a bill has to be unusual for the user and for the season.
+
+    Args:
+        store (CohortStore): The preprocessed cohort (see tools.cohort_store).
+        trailing_cycles (int, optional): The number of previous cycles of the trailing baseline.
+        season_years (int, optional): The number of earlier years of the seasonal baseline.
+        skip_recent (int, optional): The number of most recent cycles to leave out, matching the analysis window.
+        min_increase (int, optional): The minimum cost increase over the trailing median for a cycle to be ranked.
+
+    Returns:
+        pd.DataFrame: One row per user with enough history, sorted by decreasing shock score.
+    """
+    offsets = np.asarray(store.offsets)
+    latest = offsets[1:] - 1 - skip_recent
+    users = np.flatnonzero(latest - offsets[:-1] >= trailing_cycles)
+    latest = latest[users]
+    first = offsets[:-1][users]
+
+    has_cost = np.asarray(store.column("has_cost"))
+    has_consumption = np.asarray(store.column("has_consumption"))
+    num_days = np.asarray(store.column("num_days")).astype("float32")
+    num_days[num_days <= 0] = np.nan
+    per_day = {
+        "cost": np.where(has_cost, store.column("cost"), np.nan) / num_days,
+        "consumption": np.where(has_consumption, store.column("consumption"), np.nan) / num_days,
+    }
+    cost = np.where(has_cost, store.column("cost"), np.nan)
+    end_dates = np.asarray(store.column("end_date"))
+    months = end_dates.astype("datetime64[D]").astype("datetime64[M]").astype("int64") % 12
+
+    # (users x trailing_cycles) rows of the previous cycles
+    trailing_rows = latest[:, None] - np.arange(1, trailing_cycles + 1)
+    # (users x season_years * 12 + 1) rows to search for same-month cycles of earlier years
+    lookback = season_years * 12 + 1
+    season_rows = latest[:, None] - np.arange(trailing_cycles + 1, trailing_cycles + 1 + lookback)
+    season_valid = season_rows >= first[:, None]
+    season_rows = np.where(season_valid, season_rows, 0)
+    same_month = season_valid & (months[season_rows] == months[latest][:, None]) & \
+        (end_dates[latest][:, None] - end_dates[season_rows] > 300)
+
+    result = {
+        "user": users,
+        "row": latest,
+        "cycles_used": latest - first + 1,
+        "season_samples": same_month.sum(axis=1),
+    }
+    for metric, values in per_day.items():
+        trailing_z, trailing_median, scale = _robust_z(values[latest], values[trailing_rows])
+        season_median = _nanmedian(np.where(same_month, values[season_rows], np.nan))
+        season_z = (values[latest] - season_median) / scale
+        result[f"{metric}_per_day"] = values[latest]
+        result[f"{metric}_trailing_median"] = trailing_median
+        result[f"{metric}_trailing_z"] = trailing_z
+        result[f"{metric}_season_median"] = season_median
+        result[f"{metric}_season_z"] = season_z
+
+    frame = pd.DataFrame(result)
+    frame["cost"] = cost[latest]
+    frame["cost_increase"] = (frame["cost_per_day"] - frame["cost_trailing_median"]) * num_days[latest]
+    # Without same-month history the trailing score is all we have
+    frame["shock_score"] = np.where(frame["season_samples"] > 0,
+                                    np.fmin(frame["cost_trailing_z"], frame["cost_season_z"]),
+                                    frame["cost_trailing_z"])
+    frame = frame[frame["cost_increase"] >= min_increase].dropna(subset=["shock_score"])
+    frame.insert(0, "uuid", np.asarray(store.uuids)[frame["user"].to_numpy()])
+    frame["start_date"] = np.asarray(store.column("start_date"))[frame["row"].to_numpy()].astype("datetime64[D]").astype(str)
+    frame["end_date"] = end_dates[frame["row"].to_numpy()].astype("datetime64[D]").astype(str)
+    return frame.sort_values("shock_score", ascending=False, kind="stable").reset_index(drop=True)
+
+
+def _json_number(value, digits):
+    """
+    Rounds a score for JSON output, NaN becoming null.
+    """
+    if np.isnan(value):
+        return None
+    return int(round(float(value))) if digits == 0 else round(float(value), digits)
+
+
+#Function to write the top of the bill shock ranking as a work queue
+def write_queue(frame, path, top=100):
+    """
+    Writes the top ranked users as JSON lines, one pre-generation job per line.
+
+    Every job names the user and the cycle pair to explain: the latest analysed cycle against the one before it,
+    as positions in the apps' analysis window (usageChartDataList[-15:-2]).
+
+    Args:
+        frame (pd.DataFrame): The ranking returned by detect_bill_shock.
+        path (str): The output file path.
+        top (int, optional): The number of users to write.
+
+    Returns:
+        int: The number of jobs written.
+    """
+    rows = frame.head(top)
+    with open(path, "w") as f:
+        for rank, row in enumerate(rows.itertuples(index=False), start=1):
+            f.write(json.dumps({
+                "rank": rank,
+                "uuid": row.uuid,
+                "start_date": row.start_date,
+                "end_date": row.end_date,
+                "cycle1": -2,
+                "cycle2": -1,
+                "cost": _json_number(row.cost, 0),
+                "cost_increase": _json_number(row.cost_increase, 2),
+                "shock_score": _json_number(row.shock_score, 3),
+                "cost_trailing_z": _json_number(row.cost_trailing_z, 3),
+                "cost_season_z": _json_number(row.cost_season_z, 3),
+                "consumption_trailing_z": _json_number(row.consumption_trailing_z, 3),
+                "season_samples": int(row.season_samples),
+            }) + "\n")
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank the users of a cohort store by how unusual their latest bill is.")
+    parser.add_argument("store", help="A cohort store written by 'python -m tools.cohort_store export'.")
+    parser.add_argument("--top", type=int, default=100, help="Number of users to queue.")
+    parser.add_argument("--trailing", type=int, default=TRAILING_CYCLES, help="Number of previous cycles to compare with.")
+    parser.add_argument("--min-increase", type=int, default=10, help="Minimum cost increase over the trailing median.")
+    parser.add_argument("--out", default="bill_shock_queue.jsonl")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    store = CohortStore(args.store)
+    frame = detect_bill_shock(store, trailing_cycles=args.trailing, min_increase=args.min_increase)
+    count = write_queue(frame, args.out, args.top)
+    print(f"Scored {len(store)} users in {time.perf_counter() - started:.2f}s, queued {count} to '{args.out}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import threading
+import time
+
+import aiohttp
+
+from tools.metrics import registry
+
+# Seconds between two checks of a running task by the session that started it
+TASK_POLL_SECONDS = float(os.getenv("BILL_ANALYZER_TASK_POLL_SECONDS", "0.25"))
+
+# Finished tasks that were never collected, e.g. because their session was closed, are dropped after this many seconds
+TASK_RETENTION_SECONDS = 600
+
+
+class SelectionTask:
+    """
+    Work started for one selection of a session (the user to load, the comparison to explain, a question...),
+    tagged with the generation of that selection.
+    """
+    def __init__(self, scope, generation, future):
+        self.scope = scope
+        self.generation = generation
+        self.future = future
+        self.started = time.monotonic()
+        self.finished = None
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        """
+        Returns the result of a finished task, or raises its exception.
+        """
+        return self.future.result(0)
+
+
+class SelectionTaskRunner:
+    """
+    Runs the slow work of the sessions (fetches and LLM calls) on a private event loop thread, one task per
+    session and scope, so that work for a selection the analyst already changed is cancelled while in flight.
+
+    Every task is tagged with the generation of the selection it was started for. Starting a task with a newer
+    generation cancels the task of the previous one, aborting its HTTP or LLM request, and the session only ever
+    collects the task of its current generation, so results of superseded selections are never used.
+    """
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._http = None
+        threading.Thread(target=self._loop.run_forever, daemon=True, name="selection-tasks").start()
+
+    async def http(self):
+        """
+        Returns the aiohttp session of the runner, for the requests of its tasks.
+        """
+        if self._http is None:
+            self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        return self._http
+
+    async def _run(self, task, coroutine):
+        try:
+            return await coroutine
+        except Exception:
+            registry.increment("bill_analyzer_selection_tasks_total", {"scope": task.scope, "outcome": "failed"})
+            raise
+        finally:
+            task.finished = time.monotonic()
+            registry.observe("bill_analyzer_selection_task_seconds", {"scope": task.scope}, task.finished - task.started)
+
+    def run(self, owner, scope, generation, coroutine_factory):
+        """
+        Returns the task of a session and scope for the given generation, starting it if needed.
+        A task of another generation is cancelled first.
+
+        Args:
+            owner (hashable): The session, e.g. the id of the browser session.
+            scope (str): What the task computes, e.g. 'load' or 'chat'. A session runs one task per scope.
+            generation (int): The generation of the selection the task is for.
+            coroutine_factory (callable): Returns the coroutine to run. Only called if the task is started.
+
+        Returns:
+            SelectionTask: The task.
+        """
+        with self._lock:
+            task = self._tasks.get((owner, scope))
+            if task is not None and task.generation == generation:
+                return task
+            self._prune()
+            task = SelectionTask(scope, generation, None)
+            task.future = asyncio.run_coroutine_threadsafe(self._run(task, coroutine_factory()), self._loop)
+            stale, self._tasks[(owner, scope)] = self._tasks.get((owner, scope)), task
+        if stale is not None:
+            self._supersede(stale)
+        registry.increment("bill_analyzer_selection_tasks_total", {"scope": scope, "outcome": "started"})
+        return task
+
+    def has_task(self, owner, scope, generation):
+        """
+        Returns True if the session has a task of the given generation in the scope that was not collected yet.
+        """
+        with self._lock:
+            task = self._tasks.get((owner, scope))
+            return task is not None and task.generation == generation
+
+    def finished(self, owner, scope, generation):
+        """
+        Returns True if the session's task of the given generation in the scope is done and was not collected yet.
+        """
+        with self._lock:
+            task = self._tasks.get((owner, scope))
+            return task is not None and task.generation == generation and task.done()
+
+    def collect(self, owner, scope, generation):
+        """
+        Removes the finished task of a session and scope if it belongs to the given generation, and returns it.
+
+        Returns:
+            SelectionTask or None: The task, or None if it is still running or belongs to another generation.
+        """
+        with self._lock:
+            task = self._tasks.get((owner, scope))
+            if task is None or task.generation != generation or not task.done():
+                return None
+            del self._tasks[(owner, scope)]
+        registry.increment("bill_analyzer_selection_tasks_total", {"scope": scope, "outcome": "collected"})
+        return task
+
+    def cancel(self, owner, scope=None):
+        """
+        Cancels the tasks of a session, or only its task of one scope.
+
+        Returns:
+            int: The number of tasks that were cancelled before they finished.
+        """
+        with self._lock:
+            keys = [key for key in self._tasks if key[0] == owner and scope in (None, key[1])]
+            tasks = [self._tasks.pop(key) for key in keys]
+        return sum(self._supersede(task) for task in tasks)
+
+    def _supersede(self, task):
+        if task.future.cancel():
+            registry.increment("bill_analyzer_selection_tasks_total", {"scope": task.scope, "outcome": "cancelled"})
+            return True
+        # Already finished: its result is dropped
+        registry.increment("bill_analyzer_selection_tasks_total", {"scope": task.scope, "outcome": "discarded"})
+        return False
+
+    def _prune(self):
+        # The lock must be held
+        now = time.monotonic()
+        for key, task in list(self._tasks.items()):
+            if task.finished is not None and now - task.finished > TASK_RETENTION_SECONDS:
+                del self._tasks[key]
@@ -1,5 +1,5 @@
 from tabulate import tabulate
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import io
 
 #Function to plot a bar chart comparing two billing cycles
@@ -34,60 +34,50 @@ def plot_itemization_comparison(cycle1, cycle2):
     bar_width = 0.35
     index = range(len(categories))
 
-    plt.figure(figsize=(12, 7))  # Increased figure size for better spacing
-    bars1 = plt.bar(index, values_cycle1, bar_width, label='Cycle 1', color='b', alpha=0.6)
-    bars2 = plt.bar([i + bar_width for i in index], values_cycle2, bar_width, label='Cycle 2', color='g', alpha=0.6)
+    # A figure of its own rather than the global pyplot state, as plots are also drawn on background threads
+    # (see start_speculation in chatbot_streamlit.py). It is freed with the last reference, without plt.close()
+    fig = Figure(figsize=(12, 7))  # Increased figure size for better spacing
+    ax = fig.subplots()
+    bars1 = ax.bar(index, values_cycle1, bar_width, label='Cycle 1', color='b', alpha=0.6)
+    bars2 = ax.bar([i + bar_width for i in index], values_cycle2, bar_width, label='Cycle 2', color='g', alpha=0.6)
 
-    plt.xlabel('Categories')
-    plt.ylabel('Usage Cost ($)')
-    plt.title('Comparison Plot')
-    plt.xticks([i + bar_width / 2 for i in index], categories, rotation=45)
-    plt.legend()
-    plt.ylim(0, y_max)  # Set y-axis limit
+    ax.set_xlabel('Categories')
+    ax.set_ylabel('Usage Cost ($)')
+    ax.set_title('Comparison Plot')
+    ax.set_xticks([i + bar_width / 2 for i in index], categories, rotation=45)
+    ax.legend()
+    ax.set_ylim(0, y_max)  # Set y-axis limit
 
     # Adjust layout to make room for text annotations
-    plt.tight_layout(rect=[0, 0, 1, 0.90])  # Increased top margin
+    fig.tight_layout(rect=[0, 0, 1, 0.90])  # Increased top margin
 
     # Adding text for total usage cost
-    plt.text(0.95, 0.95, f'Total Cost in Cycle 1: ${total_cost_cycle1}', horizontalalignment='right', verticalalignment='top', transform=plt.gca().transAxes, fontsize=10, bbox=dict(facecolor='white', alpha=0.5))
-    plt.text(0.95, 0.90, f'Total Cost in Cycle 2: ${total_cost_cycle2}', horizontalalignment='right', verticalalignment='top', transform=plt.gca().transAxes, fontsize=10, bbox=dict(facecolor='white', alpha=0.5))
+    ax.text(0.95, 0.95, f'Total Cost in Cycle 1: ${total_cost_cycle1}', horizontalalignment='right', verticalalignment='top', transform=ax.transAxes, fontsize=10, bbox=dict(facecolor='white', alpha=0.5))
+    ax.text(0.95, 0.90, f'Total Cost in Cycle 2: ${total_cost_cycle2}', horizontalalignment='right', verticalalignment='top', transform=ax.transAxes, fontsize=10, bbox=dict(facecolor='white', alpha=0.5))
 
     # Adding values on top of each bar
     for i, (v1, v2) in enumerate(zip(values_cycle1, values_cycle2)):
-        plt.text(i, v1 + 0.02 * y_max, f'${v1}', ha='center', va='bottom', fontsize=9)
-        plt.text(i + bar_width, v2 + 0.02 * y_max, f'${v2}', ha='center', va='bottom', fontsize=9)
+        ax.text(i, v1 + 0.02 * y_max, f'${v1}', ha='center', va='bottom', fontsize=9)
+        ax.text(i + bar_width, v2 + 0.02 * y_max, f'${v2}', ha='center', va='bottom', fontsize=9)
 
     # Save plot to BytesIO buffer
     buffer = io.BytesIO()
-    plt.savefig(buffer, format='png')
+    fig.savefig(buffer, format='png')
     buffer.seek(0)
-    plt.close()
 
     return buffer
 
-# Function to display billing cycles in a table
-def display_billing_cycles(cycles):
+# Function to summarise billing cycles as table rows
+def billing_cycle_rows(cycles):
     """
-    Displays billing cycles in a table format.
-
-    This function takes a list of billing cycles and displays their details in a formatted table. It includes columns for ID, start date, end date, consumption, usage cost, vacation days, rate plan, and itemization status.
+    Summarises billing cycles as rows of ID, start date, end date, consumption, usage cost, vacation days, rate plan and itemization status.
 
     Args:
         cycles (list of dict): A list of billing cycle dictionaries.
 
     Returns:
-        str: A formatted table as a string.
+        list of list: One row per billing cycle, with 1-based IDs.
     """
-    headers = [
-        "ID",
-        "Start Date",
-        "End Date",
-        "Consumption\n (in KWh)",
-        "Usage Cost\n  (in $)",
-        "Vacation Days",
-        "Rate Plan",
-        "Itemization"
-    ]
     rows = []
     for i, cycle in enumerate(cycles):
         itemization_status = "Unavailable" if cycle.get("itemizationDetailsList") == "unavailable" else "Available"
@@ -110,7 +100,53 @@ def display_billing_cycles(cycles):
             rate_plan,
             itemization_status
         ])
+    return rows
+
+# Function to display billing cycles in a table
+def display_billing_cycles(cycles):
+    """
+    Displays billing cycles in a table format.
+
+    This function takes a list of billing cycles and displays their details in a formatted table. It includes columns for ID, start date, end date, consumption, usage cost, vacation days, rate plan, and itemization status.
+
+    Args:
+        cycles (list of dict): A list of billing cycle dictionaries.
+
+    Returns:
+        str: A formatted table as a string.
+    """
+    headers = [
+        "ID",
+        "Start Date",
+        "End Date",
+        "Consumption\n (in KWh)",
+        "Usage Cost\n  (in $)",
+        "Vacation Days",
+        "Rate Plan",
+        "Itemization"
+    ]
+    rows = billing_cycle_rows(cycles)
 
     # Print the table
     table = tabulate(rows, headers=headers, tablefmt="grid")
-    return table
\ No newline at end of file
+    return table
+
+# Function to build the first question sent to the LLM for a comparison
+def build_first_query(cycle1, cycle2, diff, loc, peers=None):
+    """
+    Builds the first comparison question for the first_prompt chain.
+
+    Args:
+        cycle1 (str): The first billing cycle, with braces escaped by replace_braces.
+        cycle2 (str): The second billing cycle, with braces escaped by replace_braces.
+        diff (str): The difference between the cycles, with braces escaped by replace_braces.
+        loc (dict): The location of the user.
+        peers (str, optional): How the cycles compare with similar homes, see tools.cohort.peer_comparison.
+
+    Returns:
+        str: The question.
+    """
+    query = f"Compare the following billing cycles: one= {cycle1} and two= {cycle2}. The difference in values between the billing cycles one and two is difference={diff}. This can help you understand the variations between the billing cycles. This user belongs to the location:{loc}"
+    if peers:
+        query += f". Comparison with similar homes nearby: {peers}"
+    return query
@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from tools.cohort_store import CohortStore
+
+# Quantiles kept per peer group
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+# Peer groups, from the most to the least specific. The first group with enough peers is used.
+LEVELS = ("zip", "state")
+
+# A zip code with fewer peers than this falls back to the state
+MIN_PEERS = int(os.getenv("BILL_ANALYZER_COHORT_MIN_PEERS", "20"))
+
+# Only the most recent billing cycles of every home are aggregated, matching the analysis window of the apps
+RECENT_CYCLES = 15
+
+
+class PeerAggregates:
+    """
+    Quantiles of the cycle cost, consumption and itemization category costs of peer homes,
+    grouped by zip code or state and by the calendar month in which the billing cycle ends.
+
+    Args:
+        metrics (list of str): The metric names, e.g. 'cost', 'consumption', 'cost_per_day' and one per category.
+        groups (list of tuple): (level, region, month) of every peer group.
+        quantiles (np.ndarray): Array of shape (groups, metrics, QUANTILES), NaN where a group has no value.
+        peers (np.ndarray): The number of distinct homes in every group.
+    """
+    def __init__(self, metrics, groups, quantiles, peers):
+        self.metrics = list(metrics)
+        self.groups = [tuple(group) for group in groups]
+        self.quantiles = quantiles
+        self.peers = peers
+        self._positions = {group: i for i, group in enumerate(self.groups)}
+
+    def lookup(self, level, region, month):
+        """
+        Returns the peer group position of a region and month, or None if no home of the cohort falls in it.
+        """
+        return self._positions.get((level, str(region), int(month)))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, "peers.npz"), quantiles=self.quantiles, peers=self.peers)
+        with open(os.path.join(path, "peers.json"), "w") as f:
+            json.dump({"metrics": self.metrics, "quantiles": list(QUANTILES), "groups": self.groups}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "peers.json"), "r") as f:
+            meta = json.load(f)
+        if tuple(meta["quantiles"]) != QUANTILES:
+            raise ValueError(f"Peer aggregates in '{path}' were built with different quantiles.")
+        arrays = np.load(os.path.join(path, "peers.npz"))
+        return cls(meta["metrics"], meta["groups"], arrays["quantiles"], arrays["peers"])
+
+
+#Function to build the peer aggregates of a whole cohort
+def build_peer_aggregates(store, recent_cycles=RECENT_CYCLES):
+    """
+    Builds the peer quantiles of every zip code and state and cycle month in one vectorised pass over a cohort store.
+
+    Every one of the recent_cycles most recent billing cycles of a home is a sample of the month its cycle ends in.
+    Metrics are computed in float32 so that a cohort of a million homes fits in memory.
+
+    Args:
+        store (CohortStore): The preprocessed cohort (see tools.cohort_store).
+        recent_cycles (int, optional): The number of most recent cycles of every home to aggregate.
+
+    Returns:
+        PeerAggregates: The aggregates.
+    """
+    user_index = store.user_index()
+    offsets = np.asarray(store.offsets)
+    cycles_from_end = offsets[user_index + 1] - np.arange(len(user_index))
+    rows = np.flatnonzero(cycles_from_end <= recent_cycles)
+    user_index = user_index[rows]
+
+    def column(name):
+        return np.asarray(store.column(name)[rows])
+
+    end_dates = column("end_date").astype("datetime64[D]")
+    months = end_dates.astype("datetime64[M]").astype("int64") % 12 + 1
+
+    cost = np.where(column("has_cost"), column("cost"), np.nan).astype("float32")
+    num_days = column("num_days").astype("float32")
+    metrics = {
+        "cost": cost,
+        "consumption": np.where(column("has_consumption"), column("consumption"), np.nan).astype("float32"),
+        "cost_per_day": np.divide(cost, num_days, out=np.full_like(cost, np.nan), where=num_days > 0),
+    }
+    has_itemization = column("has_itemization")
+    itemization = column("itemization")
+    for j, category in enumerate(store.categories):
+        metrics[category] = np.where(has_itemization, itemization[:, j, 1], np.nan).astype("float32")
+    frame = pd.DataFrame(metrics)
+    frame["month"] = months
+    frame["user"] = user_index
+
+    groups, quantiles, peers = [], [], []
+    for level in LEVELS:
+        regions = np.asarray(store.column(level))
+        frame["region"] = regions[user_index]
+        known = frame[frame["region"] != ""]
+        grouped = known.groupby(["region", "month"], sort=True)
+        # quantile() returns one row per (region, month, quantile); reshape it to (groups, quantiles, metrics)
+        level_quantiles = grouped[list(metrics)].quantile(list(QUANTILES))
+        level_peers = grouped["user"].nunique()
+        level_groups = level_peers.index
+        values = level_quantiles.to_numpy(dtype="float32").reshape(len(level_groups), len(QUANTILES), len(metrics))
+        groups.extend((level, region, int(month)) for region, month in level_groups)
+        quantiles.append(values.transpose(0, 2, 1))
+        peers.append(level_peers.to_numpy(dtype="int32"))
+
+    return PeerAggregates(
+        list(metrics),
+        groups,
+        np.concatenate(quantiles) if quantiles else np.empty((0, len(metrics), len(QUANTILES)), dtype="float32"),
+        np.concatenate(peers) if peers else np.empty(0, dtype="int32"),
+    )
+
+
+def _percentile(value, quantiles):
+    """
+    Interpolates the percentile of a value between the stored quantiles. Returns None if the group has no data.
+    """
+    if np.isnan(quantiles).any():
+        return None
+    # Values equal to one or more quantiles, e.g. 0 in a category most peers do not have, sit in the middle of them
+    low, high = np.searchsorted(quantiles, value, "left"), np.searchsorted(quantiles, value, "right")
+    if low < high:
+        return int(round(float(np.mean(QUANTILES[low:high])) * 100))
+    if value <= quantiles[0]:
+        return int(QUANTILES[0] * 100)
+    if value >= quantiles[-1]:
+        return int(QUANTILES[-1] * 100)
+    return int(round(float(np.interp(value, quantiles, QUANTILES)) * 100))
+
+
+#Function to compare one billing cycle with the peer homes of a user
+def peer_summary(aggregates, loc, cycle, min_peers=MIN_PEERS):
+    """
+    Compares the cost, consumption and itemization of a billing cycle with peer homes in the same zip code,
+    or in the same state when the zip code has fewer than min_peers homes.
+
+    Args:
+        aggregates (PeerAggregates): The peer aggregates.
+        loc (dict): The location of the user, as returned by preprocess.
+        cycle (dict): The billing cycle, as returned by preprocess.
+        min_peers (int, optional): The minimum number of homes of a zip code peer group.
+
+    Returns:
+        dict or None: The level, region, month, number of peers and, per metric, the value, median and
+        approximate percentile of the user. None if no peer group matches.
+    """
+    month = int(cycle["IntervalEndDate"][5:7])
+    position = None
+    for level in LEVELS:
+        region = (loc or {}).get(level)
+        if not region:
+            continue
+        candidate = aggregates.lookup(level, region, month)
+        if candidate is not None and (aggregates.peers[candidate] >= min_peers or level == LEVELS[-1]):
+            position = candidate
+            break
+    if position is None:
+        return None
+
+    values = {"cost": cycle["cost"], "consumption": cycle["consumption"]}
+    if isinstance(cycle["cost"], (int, float)) and cycle["num_days"]:
+        values["cost_per_day"] = cycle["cost"] / cycle["num_days"]
+    if isinstance(cycle["itemizationDetailsList"], dict):
+        values.update({category: value[1] for category, value in cycle["itemizationDetailsList"].items()})
+
+    comparison = {}
+    for i, metric in enumerate(aggregates.metrics):
+        value = values.get(metric)
+        if not isinstance(value, (int, float)):
+            continue
+        percentile = _percentile(value, aggregates.quantiles[position, i])
+        median = round(float(aggregates.quantiles[position, i, QUANTILES.index(0.5)]), 2)
+        if percentile is None or (value == 0 and median == 0):
+            continue
+        comparison[metric] = {"value": round(value, 2), "median": median, "percentile": percentile}
+
+    level, region, month = aggregates.groups[position]
+    return {"level": level, "region": region, "month": month, "peers": int(aggregates.peers[position]), "metrics": comparison}
+
+
+#Function to describe a peer summary for the comparison prompt
+def format_peer_summary(summary, label=None):
+    """
+    Formats a peer summary as one sentence that can be added to the comparison prompt.
+
+    Args:
+        summary (dict): The summary returned by peer_summary.
+        label (str, optional): The name of the billing cycle, e.g. 'one'.
+
+    Returns:
+        str: The description.
+    """
+    parts = [f"{metric} {values['value']} vs median {values['median']} (percentile {values['percentile']})"
+             for metric, values in summary["metrics"].items()]
+    subject = f"Billing cycle {label}" if label else "This billing cycle"
+    return (f"{subject} compared with {summary['peers']} homes in {summary['level']} {summary['region']} "
+            f"for cycles ending in month {summary['month']}: " + "; ".join(parts) + ".")
+
+
+_aggregates = None
+_aggregates_lock = threading.Lock()
+
+
+#Function to load the peer aggregates configured for the apps
+def get_peer_aggregates():
+    """
+    Loads the peer aggregates saved in BILL_ANALYZER_COHORT_DIR once per process.
+
+    Returns:
+        PeerAggregates or None: The aggregates, or None if peer comparison is not configured.
+    """
+    global _aggregates
+    path = os.getenv("BILL_ANALYZER_COHORT_DIR")
+    if not path:
+        return None
+    with _aggregates_lock:
+        if _aggregates is None:
+            try:
+                _aggregates = PeerAggregates.load(path)
+            except (FileNotFoundError, ValueError) as e:
+                print(f"Peer comparison disabled: {e}")
+                return None
+    return _aggregates
+
+
+#Function to describe how the compared cycles rank among peer homes
+def peer_comparison(loc, cycles, labels=("one", "two")):
+    """
+    Describes the compared billing cycles against peer homes, for the comparison prompt.
+
+    Args:
+        loc (dict): The location of the user.
+        cycles (list of dict): The compared billing cycles.
+        labels (tuple of str, optional): The names of the cycles in the prompt.
+
+    Returns:
+        str or None: The description, or None if peer comparison is not configured or no peers match.
+    """
+    aggregates = get_peer_aggregates()
+    if aggregates is None:
+        return None
+    sentences = []
+    for label, cycle in zip(labels, cycles):
+        summary = peer_summary(aggregates, loc, cycle)
+        if summary is not None and summary["metrics"]:
+            sentences.append(format_peer_summary(summary, label))
+    return " ".join(sentences) or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build peer comparison aggregates from a cohort store.")
+    parser.add_argument("store", help="A cohort store written by 'python -m tools.cohort_store export'.")
+    parser.add_argument("--out", default="cohort_peers", help="Where to save the aggregates (BILL_ANALYZER_COHORT_DIR).")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    aggregates = build_peer_aggregates(CohortStore(args.store))
+    aggregates.save(args.out)
+    print(f"Built {len(aggregates.groups)} peer groups in {time.perf_counter() - started:.2f}s, saved to '{args.out}'.")
+
+
+if __name__ == "__main__":
+    main()
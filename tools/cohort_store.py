@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from tools.batch import DEFAULT_DATA_DIR, iter_preprocessed_users
+
+STORE_VERSION = 1
+
+TOU_BANDS = ["on-peak", "mid-peak", "off-peak"]
+TIER_BANDS = ["0", "1", "2"]
+
+# Per-cycle columns: name -> (dtype, shape of one row after the cycle axis)
+CYCLE_COLUMNS = {
+    "start_date": ("int32", ()),      # days since 1970-01-01
+    "end_date": ("int32", ()),        # days since 1970-01-01
+    "consumption": ("int32", ()),
+    "cost": ("int32", ()),
+    "num_days": ("int16", ()),
+    "num_holidays": ("int16", ()),
+    "num_vacation": ("int16", ()),
+    "temperature": ("float32", ()),   # NaN when unavailable
+    "has_consumption": ("bool", ()),
+    "has_cost": ("bool", ()),
+    "has_itemization": ("bool", ()),
+    "has_tou": ("bool", ()),
+    "has_tier": ("bool", ()),
+    "tou": ("int32", (len(TOU_BANDS), 2)),   # [consumption, cost] per TOU band
+    "tier": ("int32", (len(TIER_BANDS), 2)), # [consumption, cost] per tier
+}
+
+# Per-user columns, stored as fixed-width strings
+USER_COLUMNS = {
+    "uuid": "U36",
+    "city": "U32",
+    "state": "U8",
+    "country": "U8",
+    "zip": "U10",
+}
+
+
+def _to_days(date_str):
+    return int(np.datetime64(date_str, "D").astype("int64"))
+
+
+def _from_days(days):
+    return str(np.datetime64(int(days), "D"))
+
+
+def _is_number(value):
+    return isinstance(value, (int, float))
+
+
+#Function to export preprocessed users to a memory-mappable store
+def export_cohort(users, out_dir):
+    """
+    Writes preprocessed users to a directory of fixed-width NumPy arrays that can be memory-mapped.
+
+    The store holds one .npy file per column. Cycle columns are concatenated over all users, sorted by UUID,
+    and 'offsets.npy' gives the rows of user i as offsets[i]:offsets[i + 1]. The itemization matrix has one
+    [consumption, cost] pair per category listed in 'index.json'. Holiday names are not stored, only their count.
+
+    Args:
+        users (iterable): (uuid, processed_data) pairs, with processed_data as returned by preprocess.
+        out_dir (str): The directory to write the store to.
+
+    Returns:
+        int: The number of users written.
+    """
+    users = sorted(users, key=lambda user: user[0])
+
+    categories = []
+    for _, processed_data in users:
+        for cycle in processed_data["usageChartDataList"]:
+            if isinstance(cycle["itemizationDetailsList"], dict):
+                for category in cycle["itemizationDetailsList"]:
+                    if category not in categories:
+                        categories.append(category)
+
+    columns = {name: [] for name in CYCLE_COLUMNS}
+    itemization = []
+    user_columns = {name: [] for name in USER_COLUMNS}
+    offsets = [0]
+
+    for uuid, processed_data in users:
+        location = processed_data["location"]
+        user_columns["uuid"].append(uuid)
+        for name in ("city", "state", "country", "zip"):
+            user_columns[name].append(location.get(name) or "")
+
+        for cycle in processed_data["usageChartDataList"]:
+            columns["start_date"].append(_to_days(cycle["IntervalStartDate"]))
+            columns["end_date"].append(_to_days(cycle["IntervalEndDate"]))
+            for name in ("consumption", "cost"):
+                columns[f"has_{name}"].append(_is_number(cycle[name]))
+                columns[name].append(int(cycle[name]) if _is_number(cycle[name]) else 0)
+            columns["num_days"].append(cycle["num_days"])
+            columns["num_holidays"].append(cycle["num_holidays"])
+            columns["num_vacation"].append(cycle["num_vacation"])
+            temperature = cycle["temperature"]
+            columns["temperature"].append(np.nan if temperature is None else temperature)
+
+            items = cycle["itemizationDetailsList"]
+            columns["has_itemization"].append(isinstance(items, dict))
+            itemization.append([items.get(category, [0, 0]) if isinstance(items, dict) else [0, 0] for category in categories])
+
+            tou = cycle["touDetails"]
+            columns["has_tou"].append(isinstance(tou, dict))
+            columns["tou"].append([tou.get(band, [0, 0]) if isinstance(tou, dict) else [0, 0] for band in TOU_BANDS])
+
+            tier = cycle["tierDetails"]
+            columns["has_tier"].append(isinstance(tier, dict))
+            columns["tier"].append([tier.get(band, [0, 0]) if isinstance(tier, dict) else [0, 0] for band in TIER_BANDS])
+
+        offsets.append(offsets[-1] + len(processed_data["usageChartDataList"]))
+
+    os.makedirs(out_dir, exist_ok=True)
+    num_cycles = offsets[-1]
+    for name, (dtype, shape) in CYCLE_COLUMNS.items():
+        array = np.asarray(columns[name], dtype=dtype).reshape((num_cycles,) + shape)
+        np.save(os.path.join(out_dir, f"{name}.npy"), array)
+    np.save(os.path.join(out_dir, "itemization.npy"),
+            np.asarray(itemization, dtype="int32").reshape((num_cycles, len(categories), 2)))
+    for name, dtype in USER_COLUMNS.items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), np.asarray(user_columns[name], dtype=dtype))
+    np.save(os.path.join(out_dir, "offsets.npy"), np.asarray(offsets, dtype="int64"))
+
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump({
+            "version": STORE_VERSION,
+            "num_users": len(users),
+            "num_cycles": num_cycles,
+            "categories": categories,
+            "tou_bands": TOU_BANDS,
+            "tier_bands": TIER_BANDS,
+        }, f, indent=2)
+    return len(users)
+
+
+class CohortStore:
+    """
+    Read-only, memory-mapped view of a store written by export_cohort.
+
+    Opening a store only reads 'index.json'. Every column is memory-mapped the first time it is used, so a
+    job only pages in the users and columns it actually touches.
+
+    Args:
+        path (str): The store directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as f:
+            self.index = json.load(f)
+        if self.index.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported cohort store version {self.index.get('version')} in '{path}'.")
+        self.categories = self.index["categories"]
+        self._columns = {}
+
+    def __len__(self):
+        return self.index["num_users"]
+
+    def column(self, name):
+        """
+        Returns a column as a read-only memory-mapped array: a cycle column (one row per cycle), 'itemization'
+        (cycles x categories x [consumption, cost]), 'offsets', or a user column ('uuid', 'city', 'state', 'country', 'zip').
+        """
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return self._columns[name]
+
+    @property
+    def uuids(self):
+        return self.column("uuid")
+
+    @property
+    def offsets(self):
+        return self.column("offsets")
+
+    def user_position(self, uuid):
+        """
+        Returns the position of a user in the store, or None if the user is not stored.
+        UUIDs are stored sorted, so this is a binary search over the memory-mapped UUID column.
+        """
+        uuids = self.uuids
+        position = int(np.searchsorted(uuids, uuid))
+        if position < len(uuids) and uuids[position] == uuid:
+            return position
+        return None
+
+    def user_rows(self, uuid):
+        """
+        Returns the slice of cycle rows of a user, or None if the user is not stored.
+        """
+        position = self.user_position(uuid)
+        if position is None:
+            return None
+        return slice(int(self.offsets[position]), int(self.offsets[position + 1]))
+
+    def user_cycles(self, uuid):
+        """
+        Rebuilds the billing cycles of a user in the preprocess format (without holiday names).
+
+        Args:
+            uuid (str): The unique identifier of the user.
+
+        Returns:
+            list of dict or None: The billing cycles, or None if the user is not stored.
+        """
+        rows = self.user_rows(uuid)
+        if rows is None:
+            return None
+
+        data = {name: np.asarray(self.column(name)[rows]) for name in CYCLE_COLUMNS}
+        itemization = np.asarray(self.column("itemization")[rows])
+        cycles = []
+        for i in range(rows.stop - rows.start):
+            temperature = float(data["temperature"][i])
+            cycles.append({
+                "IntervalStartDate": _from_days(data["start_date"][i]),
+                "IntervalEndDate": _from_days(data["end_date"][i]),
+                "consumption": int(data["consumption"][i]) if data["has_consumption"][i] else None,
+                "cost": int(data["cost"][i]) if data["has_cost"][i] else None,
+                "num_days": int(data["num_days"][i]),
+                "num_holidays": int(data["num_holidays"][i]),
+                "num_vacation": int(data["num_vacation"][i]),
+                "holidays": [],
+                "temperature": None if np.isnan(temperature) else int(temperature),
+                "touDetails": {band: data["tou"][i][j].tolist() for j, band in enumerate(TOU_BANDS)} if data["has_tou"][i] else "unavailable",
+                "tierDetails": {band: data["tier"][i][j].tolist() for j, band in enumerate(TIER_BANDS)} if data["has_tier"][i] else "unavailable",
+                "itemizationDetailsList": {category: itemization[i][j].tolist() for j, category in enumerate(self.categories)} if data["has_itemization"][i] else "unavailable",
+            })
+        return cycles
+
+    def user_location(self, uuid):
+        """
+        Returns the location of a user as stored by preprocess, or None if the user is not stored.
+        """
+        position = self.user_position(uuid)
+        if position is None:
+            return None
+        return {name: str(self.column(name)[position]) for name in ("city", "state", "country", "zip")}
+
+    def processed_data(self, uuid):
+        """
+        Rebuilds the preprocess output of a user, or None if the user is not stored.
+        """
+        cycles = self.user_cycles(uuid)
+        if cycles is None:
+            return None
+        return {"usageChartDataList": cycles, "location": self.user_location(uuid)}
+
+    def user_index(self):
+        """
+        Returns, for every cycle row, the position of the user it belongs to. Useful for vectorised grouping.
+        """
+        return np.repeat(np.arange(len(self), dtype="int64"), np.diff(self.offsets))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export preprocessed users to a memory-mapped cohort store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Preprocess every user of a json_datas directory and write a store.")
+    export_parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    export_parser.add_argument("--out", default="cohort_store")
+    info_parser = subparsers.add_parser("info", help="Open a store and print its size.")
+    info_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        started = time.perf_counter()
+        count = export_cohort(iter_preprocessed_users(args.data_dir), args.out)
+        print(f"Exported {count} users to '{args.out}' in {time.perf_counter() - started:.2f}s.")
+    else:
+        started = time.perf_counter()
+        store = CohortStore(args.path)
+        opened = time.perf_counter() - started
+        print(f"Opened '{args.path}' in {opened * 1000:.2f} ms: {len(store)} users, "
+              f"{store.index['num_cycles']} billing cycles, categories: {', '.join(store.categories)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import os
+import re
+
+# Itemization categories whose usage follows the outdoor temperature
+WEATHER_CATEGORIES = ("airConditioning", "spaceHeating")
+
+# Contributions smaller than this (in dollars) are not reported
+MIN_DRIVER_AMOUNT = 1
+
+# How the first comparison is answered:
+#   'off'     - send the full cycles to the LLM (default)
+#   'drivers' - send only the ranked drivers to the LLM
+#   'local'   - answer with the templated driver explanation and skip the LLM
+DRIVER_MODES = ("off", "drivers", "local")
+
+
+#Function to read the configured driver mode
+def drivers_mode():
+    """
+    Returns the configured driver mode, BILL_ANALYZER_DRIVERS, one of DRIVER_MODES. Defaults to 'off'.
+    """
+    mode = os.getenv("BILL_ANALYZER_DRIVERS", "off").strip().lower()
+    return mode if mode in DRIVER_MODES else "off"
+
+
+def _label(category):
+    """
+    Turns a camelCase itemization category into words, e.g. 'airConditioning' -> 'air conditioning'.
+    """
+    return re.sub(r"(?<!^)(?=[A-Z])", " ", category).lower()
+
+
+def _daily_consumption(itemization, category, num_days):
+    value = itemization.get(category)
+    if not isinstance(value, (list, tuple)) or not isinstance(value[0], (int, float)):
+        return None
+    return value[0] / num_days
+
+
+#Function to attribute the cost change between two cycles to its drivers
+def analyse_drivers(cycle1, cycle2):
+    """
+    Decomposes the cost change from cycle1 to cycle2 into additive contributions.
+
+    With cost = days x daily consumption x rate, the change splits exactly into
+      days:  (days2 - days1) x daily consumption1 x rate1
+      usage: (daily consumption2 - daily consumption1) x days2 x rate1
+      rate:  consumption2 x (rate2 - rate1)
+    The usage part is further split by itemization category when both cycles are itemized. Air conditioning and
+    space heating are reported together as weather when the temperature is known, and what the itemization
+    does not cover is reported as other usage.
+
+    Args:
+        cycle1 (dict): The first billing cycle, as returned by preprocess.
+        cycle2 (dict): The second billing cycle, as returned by preprocess.
+
+    Returns:
+        dict or None: The cost change, the drivers sorted by decreasing impact (each with driver, amount and detail)
+        and context notes. None if the cycles lack the consumption, cost or days needed for the decomposition.
+    """
+    values = [cycle.get(key) for cycle in (cycle1, cycle2) for key in ("consumption", "cost", "num_days")]
+    if not all(isinstance(value, (int, float)) and value > 0 for value in values):
+        return None
+    consumption1, cost1, days1, consumption2, cost2, days2 = values
+    rate1, rate2 = cost1 / consumption1, cost2 / consumption2
+    daily1, daily2 = consumption1 / days1, consumption2 / days2
+
+    drivers = [{
+        "driver": "days",
+        "amount": (days2 - days1) * daily1 * rate1,
+        "detail": f"cycle two has {days2} days and cycle one {days1}",
+    }, {
+        "driver": "rate",
+        "amount": consumption2 * (rate2 - rate1),
+        "detail": f"the average rate went from ${rate1:.3f} to ${rate2:.3f} per kWh",
+    }]
+
+    usage = (daily2 - daily1) * days2 * rate1
+    itemization1, itemization2 = cycle1.get("itemizationDetailsList"), cycle2.get("itemizationDetailsList")
+    if isinstance(itemization1, dict) and isinstance(itemization2, dict):
+        temperature1, temperature2 = cycle1.get("temperature"), cycle2.get("temperature")
+        weather_known = isinstance(temperature1, (int, float)) and isinstance(temperature2, (int, float))
+        weather = {"driver": "weather", "amount": 0.0, "detail": "", "categories": []}
+        explained = 0.0
+        for category in sorted(set(itemization1) & set(itemization2)):
+            category_daily1 = _daily_consumption(itemization1, category, days1)
+            category_daily2 = _daily_consumption(itemization2, category, days2)
+            if category_daily1 is None or category_daily2 is None:
+                continue
+            amount = (category_daily2 - category_daily1) * days2 * rate1
+            explained += amount
+            if weather_known and category in WEATHER_CATEGORIES:
+                weather["amount"] += amount
+                if abs(amount) >= MIN_DRIVER_AMOUNT:
+                    weather["categories"].append(_label(category))
+            else:
+                drivers.append({
+                    "driver": category,
+                    "amount": amount,
+                    "detail": f"{itemization1[category][0]} kWh in cycle one and {itemization2[category][0]} kWh in cycle two",
+                })
+        if weather["categories"]:
+            weather["detail"] = (f"the average temperature went from {temperature1}°F to {temperature2}°F, "
+                                 f"changing the {' and '.join(weather['categories'])} usage")
+            drivers.append(weather)
+        weather.pop("categories")
+        drivers.append({"driver": "other usage", "amount": usage - explained, "detail": "usage not covered by the itemization"})
+    else:
+        drivers.append({"driver": "usage", "amount": usage, "detail": f"daily consumption went from {daily1:.1f} to {daily2:.1f} kWh"})
+
+    drivers = [dict(driver, amount=round(driver["amount"])) for driver in drivers if abs(driver["amount"]) >= MIN_DRIVER_AMOUNT]
+    drivers.sort(key=lambda driver: abs(driver["amount"]), reverse=True)
+
+    notes = []
+    vacation1, vacation2 = cycle1.get("num_vacation") or 0, cycle2.get("num_vacation") or 0
+    if vacation1 != vacation2:
+        notes.append(f"The home was vacant for {vacation1} days in cycle one and {vacation2} days in cycle two.")
+    holidays1, holidays2 = cycle1.get("num_holidays") or 0, cycle2.get("num_holidays") or 0
+    if holidays1 != holidays2:
+        notes.append(f"Cycle one had {holidays1} holidays and cycle two {holidays2}.")
+
+    return {"cost_change": round(cost2 - cost1), "cost1": cost1, "cost2": cost2, "drivers": drivers, "notes": notes}
+
+
+#Function to explain the drivers without the LLM
+def render_drivers(analysis):
+    """
+    Renders a driver analysis as a short markdown explanation.
+
+    Args:
+        analysis (dict): The analysis returned by analyse_drivers.
+
+    Returns:
+        str: The explanation.
+    """
+    change = analysis["cost_change"]
+    if change == 0:
+        lines = [f"The cost was the same in both cycles (${analysis['cost2']}). The changes that offset each other are:"]
+    else:
+        direction = "higher" if change > 0 else "lower"
+        lines = [f"The cost was ${abs(change)} {direction} in cycle two (${analysis['cost2']}) than in cycle one (${analysis['cost1']}). The main reasons are:"]
+    lines.append("")
+    for i, driver in enumerate(analysis["drivers"], start=1):
+        effect = "added" if driver["amount"] > 0 else "saved"
+        lines.append(f"{i}. {_label(driver['driver']).capitalize()}: {driver['detail']}, which {effect} about ${abs(driver['amount'])}.")
+    if analysis["notes"]:
+        lines.append("")
+        lines.extend(analysis["notes"])
+    return "\n".join(lines)
+
+
+#Function to build a compact LLM question from the drivers
+def build_drivers_query(analysis, loc, peers=None):
+    """
+    Builds a first question that gives the LLM only the ranked drivers instead of the full cycles.
+
+    Args:
+        analysis (dict): The analysis returned by analyse_drivers.
+        loc (dict): The location of the user.
+        peers (str, optional): How the cycles compare with similar homes, see tools.cohort.peer_comparison.
+
+    Returns:
+        str: The question.
+    """
+    drivers = "; ".join(f"{_label(driver['driver'])}: {driver['amount']:+d}$ ({driver['detail']})" for driver in analysis["drivers"])
+    query = (f"Explain the cost difference between billing cycles one (${analysis['cost1']}) and two (${analysis['cost2']}), "
+             f"a change of {analysis['cost_change']:+d}$. The change is already attributed to these drivers, ranked by impact: {drivers}. "
+             f"{' '.join(analysis['notes'])} This user belongs to the location:{loc}")
+    if peers:
+        query += f". Comparison with similar homes nearby: {peers}"
+    return query
+
+
+#Function to answer the first comparison according to the driver mode
+def driver_fast_path(cycle1, cycle2, loc, peers=None):
+    """
+    Applies the configured driver mode (see drivers_mode) to the first comparison of two cycles.
+
+    Args:
+        cycle1 (dict): The first billing cycle, as returned by preprocess.
+        cycle2 (dict): The second billing cycle, as returned by preprocess.
+        loc (dict): The location of the user.
+        peers (str, optional): How the cycles compare with similar homes, see tools.cohort.peer_comparison.
+
+    Returns:
+        tuple: (local_answer, drivers_query). local_answer is the templated explanation in 'local' mode, to be used
+        instead of the LLM. drivers_query is the compact question to send instead of the full cycles in 'drivers' mode.
+        Both are None in 'off' mode, or when the cycles cannot be decomposed.
+    """
+    mode = drivers_mode()
+    if mode == "off":
+        return None, None
+    analysis = analyse_drivers(cycle1, cycle2)
+    if analysis is None:
+        return None, None
+    if mode == "local":
+        return render_drivers(analysis), None
+    return None, build_drivers_query(analysis, loc, peers)
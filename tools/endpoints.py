@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from tabulate import tabulate
+
+from tools.env_config import env_properties_dict, get_env_url
+from tools.metrics import registry
+
+# Path requested on both hosts of an environment to check their health. Any response below 500 counts as healthy.
+PROBE_PATH = os.getenv("BILL_ANALYZER_PROBE_PATH", "/health")
+
+# Seconds between two health probes of the hosts of an environment
+PROBE_INTERVAL_SECONDS = float(os.getenv("BILL_ANALYZER_PROBE_INTERVAL", "30"))
+
+PROBE_TIMEOUT_SECONDS = 2.0
+
+# Whether slow requests are duplicated to the other host of the environment ('off' only fails over on errors)
+HEDGING_ENABLED = os.getenv("BILL_ANALYZER_HEDGING", "on").strip().lower() not in ("0", "false", "no", "off")
+
+# Milliseconds after which a request is duplicated to the other host. By default twice the latency of the host,
+# between HEDGE_MIN_DELAY_SECONDS and HEDGE_MAX_DELAY_SECONDS
+HEDGE_DELAY_MS = os.getenv("BILL_ANALYZER_HEDGE_DELAY_MS")
+
+HEDGE_MIN_DELAY_SECONDS = 0.05
+HEDGE_MAX_DELAY_SECONDS = 2.0
+
+# Weight of the latest latency in the moving average of a host
+LATENCY_ALPHA = 0.3
+
+# Requests of all environments running at the same time, including the duplicates of hedged requests
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="endpoint")
+
+
+class HostState:
+    """
+    What is known about one host of an environment: its moving average latency and whether its last probe succeeded.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.name = url.split("://", 1)[-1]
+        self.latency = None
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.wins = 0
+
+
+class EndpointSelector:
+    """
+    Sends the API requests of an environment to the faster healthy one of its primary and secondary hosts.
+
+    Both hosts are probed every PROBE_INTERVAL_SECONDS in the background, and again as soon as a request fails.
+    Requests go to the healthy host with the lowest moving average latency, and fail over to the other host if they
+    fail. A request fails when it raises, e.g. HostError for a transport error or a 5xx response (see tools/utils.py):
+    a result such as None for an unknown user is the answer of a healthy host and is returned as is.
+    A request that is still running after the hedge delay is duplicated to the other host and the first
+    successful response is used. Environments whose primary and secondary are the same host are neither hedged nor
+    failed over.
+
+    Args:
+        env_name (str): The name of the environment, a key of env_properties_dict.
+    """
+    def __init__(self, env_name):
+        self.env_name = env_name
+        urls = dict.fromkeys([get_env_url(env_name, "primary"), get_env_url(env_name, "secondary")])
+        self.hosts = [HostState(url) for url in urls]
+        self._lock = threading.Lock()
+        self._last_probe = 0.0
+        self._probing = False
+
+    def _labels(self, host):
+        return {"env": self.env_name, "host": host.name}
+
+    def observe(self, host, seconds, ok):
+        """
+        Records the latency and outcome of a request or probe. Failures trigger a new probe of the hosts.
+        """
+        with self._lock:
+            host.requests += 1
+            if ok:
+                host.latency = seconds if host.latency is None else LATENCY_ALPHA * seconds + (1 - LATENCY_ALPHA) * host.latency
+            else:
+                host.failures += 1
+        registry.observe("bill_analyzer_endpoint_seconds", self._labels(host), seconds)
+        registry.increment("bill_analyzer_endpoint_requests_total", dict(self._labels(host), outcome="ok" if ok else "error"))
+        if host.latency is not None:
+            registry.set_gauge("bill_analyzer_endpoint_latency_seconds", self._labels(host), round(host.latency, 6))
+        if not ok:
+            self.maybe_probe(force=True)
+
+    def probe(self):
+        """
+        Requests PROBE_PATH on every host and updates their health and latency.
+        """
+        for host in self.hosts:
+            started = time.perf_counter()
+            try:
+                healthy = requests.get(host.url + PROBE_PATH, timeout=PROBE_TIMEOUT_SECONDS).status_code < 500
+            except requests.exceptions.RequestException:
+                healthy = False
+            seconds = time.perf_counter() - started
+            with self._lock:
+                host.healthy = healthy
+                if healthy:
+                    host.latency = seconds if host.latency is None else LATENCY_ALPHA * seconds + (1 - LATENCY_ALPHA) * host.latency
+            registry.set_gauge("bill_analyzer_endpoint_healthy", self._labels(host), int(healthy))
+            if host.latency is not None:
+                registry.set_gauge("bill_analyzer_endpoint_latency_seconds", self._labels(host), round(host.latency, 6))
+
+    def maybe_probe(self, force=False):
+        """
+        Starts a background probe if the last one is older than PROBE_INTERVAL_SECONDS, or if forced.
+        Only one probe runs at a time.
+        """
+        with self._lock:
+            if self._probing or (not force and time.monotonic() - self._last_probe < PROBE_INTERVAL_SECONDS):
+                return
+            self._probing = True
+            self._last_probe = time.monotonic()
+
+        def run():
+            try:
+                self.probe()
+            finally:
+                with self._lock:
+                    self._probing = False
+
+        threading.Thread(target=run, daemon=True, name=f"probe-{self.env_name}").start()
+
+    def ranked(self):
+        """
+        Returns the hosts in the order they should be tried: healthy before unhealthy, then fastest first.
+        Hosts without a measured latency keep the primary-then-secondary order.
+        """
+        self.maybe_probe()
+        with self._lock:
+            return sorted(self.hosts, key=lambda host: (not host.healthy, host.latency if host.latency is not None else float("inf"),
+                                                        self.hosts.index(host)))
+
+    def hedge_delay(self, host):
+        """
+        Returns the seconds after which a request to the given host is duplicated to the next one.
+        """
+        if HEDGE_DELAY_MS:
+            return float(HEDGE_DELAY_MS) / 1000
+        if host.latency is None:
+            return HEDGE_MAX_DELAY_SECONDS
+        return min(max(2 * host.latency, HEDGE_MIN_DELAY_SECONDS), HEDGE_MAX_DELAY_SECONDS)
+
+    def _won(self, host, first):
+        if host is not first:
+            with self._lock:
+                host.wins += 1
+            registry.increment("bill_analyzer_endpoint_hedges_total", {"env": self.env_name, "outcome": "won"})
+
+    def _attempt(self, host, request):
+        # Returns the result of the request and whether it failed
+        started = time.perf_counter()
+        try:
+            result, failed = request(host.url), False
+        except Exception as e:
+            print(f"Request to {host.name} failed: {e}")
+            result, failed = None, True
+        self.observe(host, time.perf_counter() - started, not failed)
+        return result, failed
+
+    def call(self, request):
+        """
+        Runs a request against the best host, hedging it and failing over to the other host as needed.
+
+        Args:
+            request (callable): Called with the base url of a host, e.g.
+                lambda env_url: fetch_location(uuid, env_url, token, raise_host_errors=True). Raises if the host failed.
+
+        Returns:
+            The result of the first host that did not fail, or None if all of them failed.
+        """
+        hosts = self.ranked()
+        pending = {_executor.submit(self._attempt, hosts[0], request): hosts[0]}
+        remaining = hosts[1:]
+        while pending:
+            hedge = HEDGING_ENABLED and remaining
+            done, _ = wait(pending, self.hedge_delay(hosts[0]) if hedge else None, FIRST_COMPLETED)
+            if not done:
+                # Still running after the hedge delay: duplicate the request
+                registry.increment("bill_analyzer_endpoint_hedges_total", {"env": self.env_name, "outcome": "sent"})
+                pending[_executor.submit(self._attempt, remaining[0], request)] = remaining[0]
+                remaining = remaining[1:]
+                continue
+            for future in done:
+                host = pending.pop(future)
+                result, failed = future.result()
+                if not failed:
+                    self._won(host, hosts[0])
+                    return result
+            if not pending and remaining:
+                registry.increment("bill_analyzer_endpoint_hedges_total", {"env": self.env_name, "outcome": "failover"})
+                pending[_executor.submit(self._attempt, remaining[0], request)] = remaining[0]
+                remaining = remaining[1:]
+        return None
+
+    async def _aattempt(self, host, request):
+        started = time.perf_counter()
+        try:
+            result, failed = await request(host.url), False
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Request to {host.name} failed: {e}")
+            result, failed = None, True
+        self.observe(host, time.perf_counter() - started, not failed)
+        return result, failed
+
+    async def acall(self, request):
+        """
+        Async version of call. The request is a coroutine function, and the slower duplicate of a hedged request
+        is cancelled once the other one succeeded.
+        """
+        hosts = self.ranked()
+        pending = {asyncio.ensure_future(self._aattempt(hosts[0], request)): hosts[0]}
+        remaining = hosts[1:]
+        try:
+            while pending:
+                hedge = HEDGING_ENABLED and remaining
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_delay(hosts[0]) if hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    registry.increment("bill_analyzer_endpoint_hedges_total", {"env": self.env_name, "outcome": "sent"})
+                    pending[asyncio.ensure_future(self._aattempt(remaining[0], request))] = remaining[0]
+                    remaining = remaining[1:]
+                    continue
+                for task in done:
+                    host = pending.pop(task)
+                    result, failed = task.result()
+                    if not failed:
+                        self._won(host, hosts[0])
+                        return result
+                if not pending and remaining:
+                    registry.increment("bill_analyzer_endpoint_hedges_total", {"env": self.env_name, "outcome": "failover"})
+                    pending[asyncio.ensure_future(self._aattempt(remaining[0], request))] = remaining[0]
+                    remaining = remaining[1:]
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+_selectors = {}
+_selectors_lock = threading.Lock()
+
+
+#Function to get the endpoint selector of an environment
+def get_endpoint_selector(env_name):
+    """
+    Returns the endpoint selector of an environment, shared by all sessions of the process.
+    """
+    with _selectors_lock:
+        if env_name not in _selectors:
+            _selectors[env_name] = EndpointSelector(env_name)
+        return _selectors[env_name]
+
+
+def print_hosts(selector):
+    rows = [[host.name, host.requests, host.failures, host.wins, f"{host.latency * 1000:.1f}" if host.latency is not None else "-",
+             "yes" if host.healthy else "no"] for host in selector.hosts]
+    print(tabulate(rows, headers=["Host", "Requests", "Failures", "Hedges won", "Latency (ms)", "Healthy"], tablefmt="grid"))
+
+
+def main():
+    from tools.mock_server import MockApiConfig, start_mock_server
+    from tools.utils import fetch_location
+
+    parser = argparse.ArgumentParser(description="Check primary/secondary failover and hedging against two local mock "
+                                                 "API servers: stop the primary, check that requests move to the "
+                                                 "secondary, restart it and check that they come back.")
+    parser.add_argument("--requests", type=int, default=40, help="Requests per phase.")
+    parser.add_argument("--uuid", default="0033b505-61a4-4c2a-91b0-da9c83d0f44a")
+    parser.add_argument("--primary-latency-ms", type=float, default=20.0)
+    parser.add_argument("--secondary-latency-ms", type=float, default=40.0)
+    parser.add_argument("--slow-primary-latency-ms", type=float, default=1000.0,
+                        help="Latency of the primary in the last phase, when it becomes slow.")
+    args = parser.parse_args()
+
+    primary = start_mock_server(MockApiConfig(latency_ms=args.primary_latency_ms, seed=1))
+    secondary = start_mock_server(MockApiConfig(latency_ms=args.secondary_latency_ms, seed=2))
+    primary_port = primary.server_port
+    env_properties_dict["local"]["primary"] = f"localhost:{primary_port}"
+    env_properties_dict["local"]["secondary"] = f"localhost:{secondary.server_port}"
+    selector = get_endpoint_selector("local")
+    primary_host, secondary_host = selector.hosts
+    selector.probe()
+    checks = []
+
+    def check(name, passed):
+        checks.append([name, "ok" if passed else "FAILED"])
+
+    def run_phase(name, uuid=None):
+        # Returns the requests served by each mock server, and the failures of each host, during the phase
+        before = [primary_host.failures, secondary_host.failures, primary.request_count, secondary.request_count]
+        latencies, results = [], []
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            results.append(selector.call(lambda env_url: fetch_location(uuid or args.uuid, env_url, "token", raise_host_errors=True)))
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        print(f"\n{name}: p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"max {latencies[-1] * 1000:.1f} ms over {len(latencies)} requests")
+        print_hosts(selector)
+        after = [primary_host.failures, secondary_host.failures, primary.request_count, secondary.request_count]
+        return results, latencies, [a - b for a, b in zip(after, before)]
+
+    results, _, (primary_failures, secondary_failures, served, _) = run_phase("Healthy primary")
+    check("Healthy primary: every request succeeds", all(result is not None for result in results))
+    check("Healthy primary: the primary serves the requests", served >= args.requests)
+
+    results, _, (primary_failures, secondary_failures, _, _) = run_phase("Unknown user", uuid="unknown-user")
+    check("Unknown user: the 404 is returned", all(result is None for result in results))
+    check("Unknown user: the 404 is not a host failure", primary_failures == secondary_failures == 0 and primary_host.healthy)
+
+    primary.shutdown()
+    primary.server_close()
+    results, _, (primary_failures, _, _, secondary_served) = run_phase("Primary down")
+    selector.probe()
+    check("Primary down: every request succeeds", all(result is not None for result in results))
+    check("Primary down: the secondary serves the requests", secondary_served >= args.requests)
+    check("Primary down: the primary failed and is unhealthy", primary_failures > 0 and not primary_host.healthy)
+    check("Primary down: the secondary is tried first", selector.ranked()[0] is secondary_host)
+
+    primary = start_mock_server(MockApiConfig(latency_ms=args.primary_latency_ms, seed=1), port=primary_port)
+    selector.probe()
+    check("Primary recovered: the primary is healthy and tried first", primary_host.healthy and selector.ranked()[0] is primary_host)
+    results, _, (_, _, served, _) = run_phase("Primary recovered")
+    check("Primary recovered: every request succeeds", all(result is not None for result in results))
+    check("Primary recovered: the primary serves the requests again", served >= args.requests)
+
+    primary.config.latency_ms = args.slow_primary_latency_ms
+    results, latencies, _ = run_phase("Slow primary")
+    check("Slow primary: every request succeeds", all(result is not None for result in results))
+    if HEDGING_ENABLED:
+        check("Slow primary: hedging keeps the median below half the primary latency",
+              latencies[len(latencies) // 2] * 1000 < args.slow_primary_latency_ms / 2)
+
+    primary.shutdown()
+    secondary.shutdown()
+    print()
+    print(tabulate(checks, headers=["Check", "Result"], tablefmt="grid"))
+    failed = sum(row[1] != "ok" for row in checks)
+    if failed:
+        parser.exit(1, f"{failed} of {len(checks)} checks failed.\n")
+
+
+if __name__ == "__main__":
+    main()
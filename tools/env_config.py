@@ -0,0 +1,127 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Bidgely API hosts per environment. The 'local' environment points at the mock API server
+# (python -m tools.mock_server) and its hosts can be overridden with MOCK_API_PRIMARY / MOCK_API_SECONDARY.
+env_properties_dict = {
+    'dev': dict({
+        'protocol': 'https://',
+        'primary': 'devapi.bidgely.com',
+        'secondary': 'devapi.bidgely.com',
+        'aws_region': 'us-west-2'
+    }),
+
+    'ds': dict({
+        'protocol': 'http://',
+        'primary': 'dspyapi.bidgely.com',
+        'secondary': 'dsapi.bidgely.com',
+        'aws_region': 'us-east-1'
+    }),
+
+    'nonprodqa': dict({
+        'protocol': 'https://',
+        'primary': 'nonprodqaapi.bidgely.com',
+        'secondary': 'nonprodqaapi.bidgely.com',
+        'aws_region': 'us-west-2'
+    }),
+    'prod-na': dict({
+        'protocol': 'https://',
+        'primary': 'napyapi.bidgely.com',
+        'secondary': 'naapi.bidgely.com',
+        'aws_region': 'us-east-1'
+    }),
+    'prod-eu': dict({
+        'protocol': 'https://',
+        'primary': 'eupyapi.bidgely.com',
+        'secondary': 'euapi.bidgely.com',
+        'aws_region': 'eu-central-1'
+    }),
+    'prod-jp': dict({
+        'protocol': 'https://',
+        'primary': 'jppyapi.bidgely.com',
+        'secondary': 'jpapi.bidgely.com',
+        'aws_region': 'ap-northeast-1'
+    }),
+    'prod-ca': dict({
+        'protocol': 'https://',
+        'primary': 'capyapi.bidgely.com',
+        'secondary': 'caapi.bidgely.com',
+        'aws_region': 'ca-central-1'
+    }),
+    'prod-na-2': dict({
+        'protocol': 'https://',
+        'primary': 'na2pyapi.bidgely.com',
+        'secondary': 'naapi2.bidgely.com',
+        'aws_region': 'us-east-1'
+    }),
+    'preprod-na': dict({
+        'protocol': 'https://',
+        'primary': 'napreprodapi.bidgely.com',
+        'secondary': 'napreprodapi.bidgely.com',
+        'aws_region': 'us-east-1'
+    }),
+    'qaperfenv': dict({
+        'protocol': 'http://',
+        'primary': 'awseb-e-i-awsebloa-1jk42nlshi8yb-2130246765.us-west-2.elb.amazonaws.com',
+        'secondary': 'awseb-e-i-awsebloa-1jk42nlshi8yb-2130246765.us-west-2.elb.amazonaws.com',
+        'aws_region': 'us-west-2'
+    }),
+    'uat': dict({
+        'protocol': 'https://',
+        'primary': 'uatapi.bidgely.com',
+        'secondary': 'uatapi.bidgely.com',
+        'aws_region': 'us-west-2'
+    }),
+
+    'productqa': dict({
+        'protocol': 'https://',
+        'primary': 'productqaapi.bidgely.com',
+        'secondary': 'productqaapi.bidgely.com',
+        'aws_region': 'us-west-2'
+    }),
+
+    'dewa-dev': dict({
+        'protocol': 'http://',
+        'primary': 'api.mslpdev.dewaaws.local',
+        'secondary': 'api.mslpdev.dewaaws.local',
+        'aws_region': 'me-central-1'
+    }),
+
+    'dewa-qa': dict({
+        'protocol': 'http://',
+        'primary': 'api.mslpqa.dewaaws.local',
+        'secondary': 'api.mslpqa.dewaaws.local',
+        'aws_region': 'me-central-1'
+    }),
+
+    'dewa-prod': dict({
+        'protocol': 'http://',
+        'primary': 'api-pyami.mslpprod.dewaaws.local',
+        'secondary': 'api-pyami.mslpprod.dewaaws.local',
+        'aws_region': 'me-central-1'
+    }),
+
+    'local': dict({
+        'protocol': 'http://',
+        'primary': os.getenv("MOCK_API_PRIMARY", "localhost:8080"),
+        'secondary': os.getenv("MOCK_API_SECONDARY", os.getenv("MOCK_API_PRIMARY", "localhost:8080")),
+        'aws_region': 'local'
+    }),
+}
+
+
+#Function to build the base url of an environment
+def get_env_url(env_name, host='primary'):
+    """
+    Builds the base url of the Bidgely API for the given environment.
+
+    Args:
+        env_name (str): The name of the environment, a key of env_properties_dict.
+        host (str, optional): Which host of the environment to use, 'primary' or 'secondary'. Defaults to 'primary'.
+
+    Returns:
+        str: The base url, e.g. 'https://devapi.bidgely.com'.
+    """
+    return env_properties_dict[env_name]['protocol'] + env_properties_dict[env_name][host]
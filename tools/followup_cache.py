@@ -0,0 +1,264 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from dataset import first_prompt, second_prompt, structured_prompt
+from tools.drivers import drivers_mode
+from tools.metrics import registry
+from tools.structured import structured_output_enabled
+
+# Cycle pairs whose follow-up answers are kept, least recently used first out (0 disables the cache)
+FOLLOWUP_CACHE_SIZE = int(os.getenv("BILL_ANALYZER_FOLLOWUP_CACHE_SIZE", "1024"))
+
+# Answers kept per cycle pair, the oldest is dropped first
+FOLLOWUP_MAX_QUESTIONS = int(os.getenv("BILL_ANALYZER_FOLLOWUP_MAX_QUESTIONS", "16"))
+
+# Cosine similarity a question needs with a cached one for its answer to be reused
+FOLLOWUP_MIN_SIMILARITY = float(os.getenv("BILL_ANALYZER_FOLLOWUP_MIN_SIMILARITY", "0.8"))
+
+# Questions with fewer words than this ("why?", "and cycle two?") depend on the conversation and are never cached
+FOLLOWUP_MIN_WORDS = 3
+
+# Spellings that analysts use interchangeably
+SYNONYMS = {
+    "tou": "time of use",
+    "ac": "air conditioning",
+    "a/c": "air conditioning",
+    "always-on": "always on",
+    "alwayson": "always on",
+    "ev": "electric vehicle",
+    "bc": "billing cycle",
+    "bill": "cost",
+    "bills": "cost",
+    "costs": "cost",
+    "expensive": "cost",
+    "usage": "consumption",
+    "reduce": "lower",
+    "decrease": "lower",
+    "decreased": "lower",
+    "cut": "lower",
+    "increase": "higher",
+    "increased": "higher",
+    "more": "higher",
+    "less": "lower",
+    "1": "one",
+    "2": "two",
+}
+
+STOPWORDS = {"a", "an", "the", "is", "are", "was", "were", "be", "do", "does", "did", "my", "i", "me", "can", "could",
+             "please", "in", "of", "for", "to", "on", "this", "that", "it", "its", "so", "what", "explain", "tell"}
+
+# Words that change the meaning of otherwise similar questions: they must match exactly for a cache hit
+KEY_TERMS = {"higher", "lower", "not", "one", "two", "first", "second", "why", "how", "when"}
+
+
+#Function to normalise a follow-up question
+def normalise_question(question):
+    """
+    Lowercases a question, maps synonyms to one spelling and drops punctuation and stop words.
+
+    Args:
+        question (str): The question of the analyst.
+
+    Returns:
+        list of str: The remaining words.
+    """
+    words = re.findall(r"[a-z0-9/\-]+", question.lower())
+    words = " ".join(SYNONYMS.get(word, word) for word in words).split()
+    return [word for word in words if word not in STOPWORDS]
+
+
+def _features(words):
+    """
+    Word unigrams and bigrams plus character trigrams, so that reordered words and typos still match.
+    """
+    features = Counter(words)
+    features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    for word in words:
+        padded = f"#{word}#"
+        features.update(f"~{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    return features
+
+
+_prompts_digest = None
+
+
+#Function to identify the prompts the cached answers were generated with
+def prompt_version():
+    """
+    Combines a hash of the first and follow-up prompts with the driver and structured output modes, which decide
+    what the LLM was asked.
+    Answers cached under another version are never returned.
+
+    Returns:
+        str: The version, BILL_ANALYZER_PROMPT_VERSION if set.
+    """
+    global _prompts_digest
+    version = os.getenv("BILL_ANALYZER_PROMPT_VERSION")
+    if version:
+        return version
+    if _prompts_digest is None:
+        payload = json.dumps([first_prompt.to_json(), second_prompt.to_json(), structured_prompt.to_json()],
+                             sort_keys=True, default=str)
+        _prompts_digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+    return f"{_prompts_digest}-{drivers_mode()}{'-structured' if structured_output_enabled() else ''}"
+
+
+#Function to identify a compared cycle pair
+def pair_key(cycle1, cycle2):
+    """
+    Hashes the two compared billing cycles, so that answers are only reused for the same comparison.
+    Every entry point passes the preprocessed cycle dicts, so that they share the cached answers.
+
+    Args:
+        cycle1 (dict): The first billing cycle, as returned by preprocess.
+        cycle2 (dict): The second billing cycle.
+
+    Returns:
+        str: The key.
+    """
+    payload = json.dumps([cycle1, cycle2], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FollowupCache:
+    """
+    Answers to follow-up questions per compared cycle pair, matched by TF-IDF cosine similarity of the normalised questions.
+
+    Document frequencies are shared by all cached questions, so that words every analyst uses ("cost", "cycle")
+    weigh less than the subject of the question ("always on", "time of use").
+
+    Args:
+        version (str): The prompt version of the cached answers, see prompt_version.
+        max_pairs (int, optional): The number of cycle pairs kept, least recently used first out.
+        max_questions (int, optional): The number of answers kept per cycle pair.
+        min_similarity (float, optional): The similarity a question needs with a cached one.
+    """
+    def __init__(self, version, max_pairs=FOLLOWUP_CACHE_SIZE, max_questions=FOLLOWUP_MAX_QUESTIONS,
+                 min_similarity=FOLLOWUP_MIN_SIMILARITY):
+        self.version = version
+        self.max_pairs = max_pairs
+        self.max_questions = max_questions
+        self.min_similarity = min_similarity
+        self._pairs = OrderedDict()
+        self._document_frequency = Counter()
+        self._documents = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def _weights(self, features):
+        # Sublinear tf times the smoothed idf, log((1 + N) / (1 + df)) + 1
+        weights = {feature: (1 + math.log(count)) * (math.log((1 + self._documents) / (1 + self._document_frequency[feature])) + 1)
+                   for feature, count in features.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+        return {feature: weight / norm for feature, weight in weights.items()}
+
+    def _forget(self, entry):
+        self._document_frequency.subtract(entry["features"].keys())
+        self._documents -= 1
+
+    def lookup(self, pair, question):
+        """
+        Returns the cached answer of the most similar question asked about the same cycle pair.
+
+        Args:
+            pair (str): The cycle pair, see pair_key.
+            question (str): The follow-up question.
+
+        Returns:
+            str or None: The answer, or None if no cached question is similar enough.
+        """
+        words = normalise_question(question)
+        best, best_similarity = None, 0.0
+        with self._lock:
+            entries = self._pairs.get(pair)
+            if entries is not None and len(words) >= FOLLOWUP_MIN_WORDS:
+                self._pairs.move_to_end(pair)
+                key_terms = KEY_TERMS.intersection(words)
+                query = self._weights(_features(words))
+                for entry in entries:
+                    if entry["key_terms"] != key_terms:
+                        continue
+                    cached = self._weights(entry["features"])
+                    similarity = sum(weight * cached.get(feature, 0.0) for feature, weight in query.items())
+                    if similarity > best_similarity:
+                        best, best_similarity = entry, similarity
+        if best is not None and best_similarity >= self.min_similarity:
+            registry.increment("bill_analyzer_followup_cache_total", {"outcome": "hit"})
+            return best["answer"]
+        registry.increment("bill_analyzer_followup_cache_total", {"outcome": "miss"})
+        return None
+
+    def store(self, pair, question, answer):
+        """
+        Caches the answer to a follow-up question about a cycle pair.
+
+        Args:
+            pair (str): The cycle pair, see pair_key.
+            question (str): The follow-up question.
+            answer (str): The answer of the LLM.
+        """
+        words = normalise_question(question)
+        if len(words) < FOLLOWUP_MIN_WORDS or not answer:
+            return
+        entry = {"words": words, "key_terms": KEY_TERMS.intersection(words), "features": _features(words), "answer": answer}
+        with self._lock:
+            entries = self._pairs.setdefault(pair, [])
+            self._pairs.move_to_end(pair)
+            for old in [old for old in entries if old["words"] == words]:
+                entries.remove(old)
+                self._forget(old)
+            entries.append(entry)
+            self._document_frequency.update(entry["features"].keys())
+            self._documents += 1
+            while len(entries) > self.max_questions:
+                self._forget(entries.pop(0))
+            while len(self._pairs) > self.max_pairs:
+                for old in self._pairs.popitem(last=False)[1]:
+                    self._forget(old)
+
+    def invalidate(self, version):
+        """
+        Drops every cached answer if the prompt version changed.
+
+        Returns:
+            bool: True if the cache was cleared.
+        """
+        with self._lock:
+            if version == self.version:
+                return False
+            self.version = version
+            self._pairs.clear()
+            self._document_frequency.clear()
+            self._documents = 0
+        registry.increment("bill_analyzer_followup_cache_total", {"outcome": "invalidated"})
+        return True
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+#Function to get the follow-up cache of the process
+def get_followup_cache():
+    """
+    Returns the follow-up cache shared by all sessions of the process, cleared whenever the prompt version changes.
+
+    Returns:
+        FollowupCache or None: The cache, or None if it is disabled (BILL_ANALYZER_FOLLOWUP_CACHE_SIZE=0).
+    """
+    global _cache
+    if FOLLOWUP_CACHE_SIZE <= 0:
+        return None
+    version = prompt_version()
+    with _cache_lock:
+        if _cache is None:
+            _cache = FollowupCache(version)
+    _cache.invalidate(version)
+    return _cache
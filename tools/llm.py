@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_openai import ChatOpenAI
+
+# 'openai' calls gpt-4o, 'record' calls gpt-4o and saves every response to the cassette,
+# 'replay' answers from the cassette without any network access
+LLM_BACKENDS = ("openai", "record", "replay")
+
+MODEL_NAME = "gpt-4o"
+
+# Answer of the replay backend for prompts missing from the cassette, when BILL_ANALYZER_LLM_REPLAY_MISSING=synthetic
+SYNTHETIC_RESPONSE = ("Possible reasons for the cost difference between the two billing cycles are:\n\n"
+                      "1. The number of days in the billing cycle changed, which changed the overall consumption.\n"
+                      "2. The usage of the largest appliance categories changed between the cycles.\n"
+                      "3. The average temperature changed, which affected heating and cooling usage.")
+
+
+#Function to build the cassette key of a prompt
+def prompt_key(messages, model=MODEL_NAME):
+    """
+    Hashes the messages sent to the model, so a recorded response is replayed for exactly the same prompt.
+
+    Args:
+        messages (list of BaseMessage): The prompt messages.
+        model (str, optional): The model the prompt is sent to.
+
+    Returns:
+        str: The SHA-256 hex digest.
+    """
+    payload = json.dumps([model] + [[message.type, message.content] for message in messages], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    return dict(usage) if usage else None
+
+
+class Cassette:
+    """
+    Append-only JSONL file of recorded prompts and responses, keyed by prompt_key.
+
+    Args:
+        path (str): The cassette file. It is created on the first recording.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    record = json.loads(line)
+                    self._records[record["key"]] = record
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, key):
+        return self._records.get(key)
+
+    def record(self, key, messages, content, usage):
+        record = {"key": key, "prompt": messages[-1].content[-500:], "response": content, "usage": usage}
+        with self._lock:
+            self._records[key] = record
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def open_cassette(path):
+    """
+    Returns the cassette at the given path, loading it once per process.
+    """
+    path = os.path.abspath(path)
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path)
+        return _cassettes[path]
+
+
+def _tokens(text):
+    """
+    Splits a response into the chunks it is streamed in, one word (with its trailing whitespace) per chunk.
+    """
+    return re.findall(r"\s*\S+\s*", text) or [text]
+
+
+class RecordingChatModel(BaseChatModel):
+    """
+    Chat model that forwards every call to another model and records the responses in a cassette.
+    """
+    inner: Any
+    cassette: Any
+    model_name: str = MODEL_NAME
+
+    @property
+    def _llm_type(self):
+        return "recording"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self.inner.invoke(messages, stop=stop, **kwargs)
+        self.cassette.record(prompt_key(messages, self.model_name), messages, response.content, _usage(response))
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = await self.inner.ainvoke(messages, stop=stop, **kwargs)
+        self.cassette.record(prompt_key(messages, self.model_name), messages, response.content, _usage(response))
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        full = None
+        for chunk in self.inner.stream(messages, stop=stop, **kwargs):
+            full = chunk if full is None else full + chunk
+            yield ChatGenerationChunk(message=chunk)
+        if full is not None:
+            self.cassette.record(prompt_key(messages, self.model_name), messages, full.content, _usage(full))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        full = None
+        async for chunk in self.inner.astream(messages, stop=stop, **kwargs):
+            full = chunk if full is None else full + chunk
+            yield ChatGenerationChunk(message=chunk)
+        if full is not None:
+            self.cassette.record(prompt_key(messages, self.model_name), messages, full.content, _usage(full))
+
+
+class ReplayChatModel(BaseChatModel):
+    """
+    Chat model that answers from a cassette, with synthetic latency and streaming rate, so the apps,
+    the benchmarks and load tests run without network access or spend.
+
+    latency_ms is waited before the first token and tokens_per_second paces the response (0 returns it at once);
+    invoke() waits for the whole response, stream() yields it word by word. Prompts missing from the cassette
+    raise a KeyError, or get SYNTHETIC_RESPONSE when missing is 'synthetic'.
+    """
+    cassette: Any
+    latency_ms: float = 0.0
+    tokens_per_second: float = 0.0
+    missing: str = "error"
+    model_name: str = MODEL_NAME
+
+    @property
+    def _llm_type(self):
+        return "replay"
+
+    def _lookup(self, messages):
+        key = prompt_key(messages, self.model_name)
+        record = self.cassette.get(key)
+        if record is not None:
+            return record["response"], record.get("usage")
+        if self.missing != "synthetic":
+            raise KeyError(f"No recorded response for prompt {key[:12]} in '{self.cassette.path}'. "
+                           "Record it first with BILL_ANALYZER_LLM_BACKEND=record.")
+        prompt_tokens = sum(len(_tokens(str(message.content))) for message in messages)
+        return SYNTHETIC_RESPONSE, {"input_tokens": prompt_tokens, "output_tokens": len(_tokens(SYNTHETIC_RESPONSE)),
+                                    "total_tokens": prompt_tokens + len(_tokens(SYNTHETIC_RESPONSE))}
+
+    def _delays(self):
+        token_delay = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        return self.latency_ms / 1000, token_delay
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        content, usage = self._lookup(messages)
+        first_token, token_delay = self._delays()
+        time.sleep(first_token + token_delay * len(_tokens(content)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        content, usage = self._lookup(messages)
+        first_token, token_delay = self._delays()
+        await asyncio.sleep(first_token + token_delay * len(_tokens(content)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        content, usage = self._lookup(messages)
+        first_token, token_delay = self._delays()
+        time.sleep(first_token)
+        for token in _tokens(content):
+            time.sleep(token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        if usage:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        content, usage = self._lookup(messages)
+        first_token, token_delay = self._delays()
+        await asyncio.sleep(first_token)
+        for token in _tokens(content):
+            await asyncio.sleep(token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        if usage:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+
+#Function to ask a chat model for JSON responses
+def json_mode(llm):
+    """
+    Asks gpt-4o, directly or through the record backend, to answer with a JSON object. The prompt must mention JSON.
+    Other chat models are returned unchanged.
+
+    Args:
+        llm (BaseChatModel): The chat model.
+
+    Returns:
+        Runnable: The chat model, bound to the JSON response format if supported.
+    """
+    if isinstance(llm, (ChatOpenAI, RecordingChatModel)):
+        return llm.bind(response_format={"type": "json_object"})
+    return llm
+
+
+#Function to switch a chat model to another model of the same backend
+def with_model(llm, model):
+    """
+    Returns a copy of a chat model created by get_chat_model that uses another model on the same backend:
+    the OpenAI model itself, or the model recorded or replayed, with the same cassette.
+
+    Args:
+        llm (BaseChatModel): The chat model.
+        model (str): The OpenAI model, e.g. 'gpt-4o-mini'.
+
+    Returns:
+        BaseChatModel or None: The copy, or None for other chat models (e.g. one injected by a test).
+    """
+    if isinstance(llm, RecordingChatModel):
+        inner = with_model(llm.inner, model)
+        return RecordingChatModel(inner=inner, cassette=llm.cassette, model_name=model) if inner is not None else None
+    if isinstance(llm, ReplayChatModel):
+        return ReplayChatModel(cassette=llm.cassette, latency_ms=llm.latency_ms, tokens_per_second=llm.tokens_per_second,
+                               missing=llm.missing, model_name=model)
+    if isinstance(llm, ChatOpenAI):
+        return ChatOpenAI(model=model, openai_api_key=llm.openai_api_key, temperature=llm.temperature, stream_usage=llm.stream_usage)
+    return None
+
+
+#Function to create the chat model selected by configuration
+def get_chat_model(backend=None, stream_usage=False, model=MODEL_NAME):
+    """
+    Creates the chat model of the analyzer, selected by BILL_ANALYZER_LLM_BACKEND (one of LLM_BACKENDS, default 'openai').
+
+    The 'record' and 'replay' backends use the cassette BILL_ANALYZER_LLM_CASSETTE (default 'llm_cassette.jsonl').
+    'replay' is paced by BILL_ANALYZER_LLM_LATENCY_MS and BILL_ANALYZER_LLM_TOKENS_PER_SECOND, and answers prompts
+    missing from the cassette according to BILL_ANALYZER_LLM_REPLAY_MISSING ('error' or 'synthetic').
+
+    Args:
+        backend (str, optional): Overrides BILL_ANALYZER_LLM_BACKEND.
+        stream_usage (bool, optional): Whether streamed gpt-4o responses should report token usage.
+        model (str, optional): The OpenAI model, gpt-4o by default. Recorded and replayed responses are kept per model.
+
+    Returns:
+        BaseChatModel: The chat model.
+    """
+    backend = (backend or os.getenv("BILL_ANALYZER_LLM_BACKEND", "openai")).strip().lower()
+    if backend not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM backend '{backend}', expected one of {', '.join(LLM_BACKENDS)}.")
+
+    cassette_path = os.getenv("BILL_ANALYZER_LLM_CASSETTE", "llm_cassette.jsonl")
+    if backend == "replay":
+        return ReplayChatModel(
+            cassette=open_cassette(cassette_path),
+            latency_ms=float(os.getenv("BILL_ANALYZER_LLM_LATENCY_MS", "0")),
+            tokens_per_second=float(os.getenv("BILL_ANALYZER_LLM_TOKENS_PER_SECOND", "0")),
+            missing=os.getenv("BILL_ANALYZER_LLM_REPLAY_MISSING", "error").strip().lower(),
+            model_name=model,
+        )
+
+    llm = ChatOpenAI(model=model, openai_api_key=os.getenv("OPENAI_API_KEY"), temperature=1.0, stream_usage=stream_usage)
+    if backend == "record":
+        return RecordingChatModel(inner=llm, cassette=open_cassette(cassette_path), model_name=model)
+    return llm
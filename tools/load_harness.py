@@ -0,0 +1,304 @@
+import argparse
+import gc
+import json
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from unittest.mock import MagicMock
+from urllib import parse
+
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.pages_manager import PagesManager
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+from streamlit.testing.v1.util import patch_config_options
+from tabulate import tabulate
+
+from tools.batch import DEFAULT_DATA_DIR, list_uuids
+from tools.benchmark import git_revision, percentile
+from tools.cancellation import TASK_POLL_SECONDS
+from tools.mock_server import MockApiConfig, start_mock_server
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chatbot_streamlit.py")
+
+# Steps of an analyst session, in the order they run
+STEPS = ["env", "token", "uuid", "first_cycle", "second_cycle", "chart", "chat"]
+
+# Follow-up questions asked in every session, in turn
+QUESTIONS = [
+    "Which appliance category changed the most?",
+    "How did the weather affect the bill?",
+    "Why is the always on usage different?",
+    "How can I lower my next bill?",
+]
+
+
+def rss_mib():
+    """
+    Returns the resident memory of this process in MiB, or its peak resident memory where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MemorySampler:
+    """
+    Samples the resident memory of the process in a background thread, to catch its peak while sessions run.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = rss_mib()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mib())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_mib())
+
+
+@contextmanager
+def shared_app_runtime():
+    """
+    Installs one mock Streamlit runtime for all the sessions of the process, like a single app server.
+
+    AppTest installs a fresh mock runtime, with its own cache storage, around every run and removes it afterwards,
+    which breaks the runs of other sessions still in flight. ConcurrentAppTest runs inside this shared runtime instead.
+    As in the Streamlit server, the script is compiled once for all sessions (concurrent compilations of the same
+    script also fail on some Python versions).
+    """
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    runtime.script_cache = ScriptCache()
+    Runtime._instance = runtime
+    try:
+        with patch_config_options({"global.appTest": True}):
+            yield runtime
+    finally:
+        Runtime._instance = None
+
+
+class ConcurrentAppTest(AppTest):
+    """
+    AppTest whose runs can overlap with the runs of other instances in other threads, within shared_app_runtime().
+    Secrets and multipage apps are not supported.
+    """
+    def _run(self, widget_state=None, timeout=None):
+        if Runtime._instance is None:
+            raise RuntimeError("ConcurrentAppTest must run inside shared_app_runtime().")
+        script_runner = LocalScriptRunner(self._script_path, self.session_state, PagesManager(self._script_path, setup_watcher=False),
+                                          args=self.args, kwargs=self.kwargs)
+        script_runner._script_cache = Runtime._instance.script_cache
+        self._tree = script_runner.run(widget_state, self.query_params, self.default_timeout if timeout is None else timeout, self._page_hash)
+        self._tree._runner = self
+        self.query_params = parse.parse_qs(script_runner.event_data[-1]["client_state"].query_string)
+        return self
+
+
+#Function to drive one analyst session of the Streamlit app
+def run_session(uuid, turns, env="local", access_token="load-test", start=None, timeout=120):
+    """
+    Steps through a whole session of chatbot_streamlit headlessly with ConcurrentAppTest: env, token and UUID entry,
+    selection of the two most recent cycles of the analysis window, the comparison chart and chat turns.
+
+    Args:
+        uuid (str): The user to analyse.
+        turns (int): The number of chat questions to ask after the first comparison.
+        env (str, optional): The environment to select, 'local' for the mock API server.
+        access_token (str, optional): The access token to enter.
+        start (threading.Barrier, optional): Waited on before the first step, so that concurrent sessions start together.
+        timeout (float, optional): The maximum number of seconds a single rerun may take.
+
+    Returns:
+        dict: The durations in seconds of every step ({step: [durations]}) and the exceptions shown by the app.
+    """
+    timings = defaultdict(list)
+    errors = []
+    app = ConcurrentAppTest(APP_PATH, default_timeout=timeout)
+
+    def step(name, action):
+        started = time.perf_counter()
+        try:
+            action().run()
+            # AppTest does not run the task poller fragment of the app, so rerun the page while background work is pending
+            while "pending_tasks" in app.session_state and app.session_state["pending_tasks"]:
+                if time.perf_counter() - started > timeout:
+                    raise TimeoutError(f"background work still pending after {timeout} s")
+                time.sleep(TASK_POLL_SECONDS)
+                app.run()
+        except Exception as e:
+            errors.append(f"{name}: {type(e).__name__}: {e}")
+            return False
+        timings[name].append(time.perf_counter() - started)
+        errors.extend(f"{name}: {exception.value[:200]}" for exception in app.exception)
+        return not app.exception
+
+    app.run()
+    if start is not None:
+        start.wait()
+
+    completed = (step("env", lambda: app.selectbox[0].select(env))
+                 and step("token", lambda: app.text_input[0].input(access_token))
+                 and step("uuid", lambda: app.text_input[1].input(uuid))
+                 and step("first_cycle", lambda: app.selectbox(key="first_cycle").select(app.selectbox(key="first_cycle").options[-2]))
+                 and step("second_cycle", lambda: app.selectbox(key="second_cycle").select(app.selectbox(key="second_cycle").options[-1]))
+                 and step("chart", lambda: app.selectbox(key="plot_choice").select("Yes")))
+    for turn in range(turns if completed else 0):
+        if not step("chat", lambda: app.chat_input[0].set_value(QUESTIONS[turn % len(QUESTIONS)])):
+            break
+    return {"timings": timings, "errors": errors}
+
+
+#Function to run a number of concurrent sessions
+def run_level(uuids, sessions, turns, timeout=120):
+    """
+    Runs concurrent sessions that start together, spread over the given users round-robin.
+    Must be called inside shared_app_runtime().
+
+    Args:
+        uuids (list of str): The users to analyse.
+        sessions (int): The number of concurrent sessions.
+        turns (int): The number of chat questions per session.
+        timeout (float, optional): The maximum number of seconds a single rerun may take.
+
+    Returns:
+        dict: Per-step latency percentiles in milliseconds, errors and resident memory in MiB.
+    """
+    start = threading.Barrier(sessions)
+    rss_before = rss_mib()
+    started = time.perf_counter()
+    with MemorySampler() as sampler, ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = [executor.submit(run_session, uuids[i % len(uuids)], turns, start=start, timeout=timeout)
+                   for i in range(sessions)]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    gc.collect()
+
+    timings = defaultdict(list)
+    errors = []
+    for result in results:
+        for name, durations in result["timings"].items():
+            timings[name].extend(durations)
+        errors.extend(result["errors"])
+
+    steps = {}
+    for name in STEPS:
+        durations_ms = [duration * 1000 for duration in timings.get(name, [])]
+        if durations_ms:
+            steps[name] = {
+                "count": len(durations_ms),
+                "p50_ms": round(percentile(durations_ms, 50), 1),
+                "p95_ms": round(percentile(durations_ms, 95), 1),
+                "p99_ms": round(percentile(durations_ms, 99), 1),
+                "max_ms": round(max(durations_ms), 1),
+            }
+    return {
+        "sessions": sessions,
+        "elapsed_s": round(elapsed, 2),
+        "steps": steps,
+        "errors": errors,
+        "rss_before_mib": round(rss_before, 1),
+        "rss_peak_mib": round(sampler.peak, 1),
+        "rss_after_mib": round(rss_mib(), 1),
+    }
+
+
+#Function to print the load test results
+def print_results(results):
+    """
+    Prints the per-step latency of every session count, followed by the memory growth of the app process.
+
+    Args:
+        results (dict): The load test results.
+    """
+    for level in results["levels"]:
+        print(f"\n{level['sessions']} concurrent sessions ({level['elapsed_s']}s, {len(level['errors'])} errors)")
+        rows = [[name, stats["count"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]]
+                for name, stats in level["steps"].items()]
+        print(tabulate(rows, headers=["Step", "Reruns", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Max (ms)"], tablefmt="grid"))
+        for error in level["errors"][:5]:
+            print(f"  {error}")
+
+    baseline = results["rss_start_mib"]
+    rows = [[level["sessions"], level["rss_peak_mib"], level["rss_after_mib"], f"{level['rss_after_mib'] - baseline:+.1f}"]
+            for level in results["levels"]]
+    print(f"\nApp process memory (started at {baseline} MiB)")
+    print(tabulate(rows, headers=["Sessions", "Peak RSS (MiB)", "RSS after (MiB)", "Growth (MiB)"], tablefmt="grid"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test chatbot_streamlit with concurrent headless sessions, "
+                                                 "against the mock API server and the replay LLM backend.")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--sessions", default="1,5,10,20", help="Comma separated numbers of concurrent sessions.")
+    parser.add_argument("--turns", type=int, default=3, help="Chat questions per session.")
+    parser.add_argument("--limit", type=int, default=None, help="Only spread the sessions over the first N users.")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="Latency of the mock API server.")
+    parser.add_argument("--llm-latency-ms", type=float, default=500.0, help="Latency of the replayed LLM before the first token.")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=0.0, help="Streaming rate of the replayed LLM (0 for instant).")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Maximum seconds a single rerun may take.")
+    parser.add_argument("--output", default="load_output.json", help="Machine-readable results file.")
+    args = parser.parse_args()
+
+    uuids = list_uuids(args.data_dir)[:args.limit]
+    if not uuids:
+        print(f"No users found in '{args.data_dir}'.")
+        return
+
+    # The app reads the LLM configuration when it first creates its model, in this process
+    os.environ.setdefault("BILL_ANALYZER_LLM_BACKEND", "replay")
+    os.environ.setdefault("BILL_ANALYZER_LLM_REPLAY_MISSING", "synthetic")
+    os.environ["BILL_ANALYZER_LLM_LATENCY_MS"] = str(args.llm_latency_ms)
+    os.environ["BILL_ANALYZER_LLM_TOKENS_PER_SECOND"] = str(args.llm_tokens_per_second)
+
+    server = start_mock_server(MockApiConfig(data_dir=args.data_dir, latency_ms=args.api_latency_ms))
+    from tools.env_config import env_properties_dict
+    env_properties_dict["local"]["primary"] = env_properties_dict["local"]["secondary"] = f"localhost:{server.server_port}"
+
+    results = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "turns": args.turns,
+        "users": len(uuids),
+        "llm_backend": os.environ["BILL_ANALYZER_LLM_BACKEND"],
+        "llm_latency_ms": args.llm_latency_ms,
+        "rss_start_mib": round(rss_mib(), 1),
+        "levels": [],
+    }
+    try:
+        with shared_app_runtime():
+            for sessions in [int(count) for count in args.sessions.split(",")]:
+                print(f"Running {sessions} concurrent sessions...", flush=True)
+                results["levels"].append(run_level(uuids, sessions, args.turns, args.timeout))
+    finally:
+        server.shutdown()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    print(f"\nResults written to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
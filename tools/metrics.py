@@ -0,0 +1,309 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Span tags that are exported as Prometheus labels. Other tags (uuid, session, ...) are high-cardinality
+# and only written to the JSONL span log.
+LABEL_TAGS = ("env",)
+
+# Seconds between two writes of the buffered spans to the span log
+SPAN_FLUSH_SECONDS = float(os.getenv("BILL_ANALYZER_SPANS_FLUSH_SECONDS", "1"))
+
+
+class Histogram:
+    """
+    Cumulative latency histogram in the Prometheus exposition format.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """
+    Process-wide store of stage latency histograms and counters, shared by every session of the app.
+
+    Spans are buffered in memory and appended to the span log by a background thread every SPAN_FLUSH_SECONDS,
+    so that finishing a span never waits for the disk (spans also finish on the event loop of the async handlers).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._span_file = None
+        # (path, line) of the spans not written yet. _span_write_lock keeps concurrent flushes in order.
+        self._span_buffer = []
+        self._span_write_lock = threading.Lock()
+        self._span_writer = None
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def increment(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def set_span_file(self, path):
+        """
+        Appends every finished span as one JSON line to the given file. Pass None to stop writing spans.
+        """
+        with self._lock:
+            self._span_file = path
+
+    def write_span(self, record):
+        """
+        Buffers a finished span for the span log, see set_span_file. It is written within SPAN_FLUSH_SECONDS.
+        """
+        with self._lock:
+            path = self._span_file
+        if not path:
+            return
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            self._span_buffer.append((path, line))
+            if self._span_writer is None:
+                self._span_writer = threading.Thread(target=self._write_spans_forever, daemon=True, name="span-writer")
+                self._span_writer.start()
+
+    def _write_spans_forever(self):
+        while True:
+            time.sleep(SPAN_FLUSH_SECONDS)
+            self.flush_spans()
+
+    def flush_spans(self):
+        """
+        Writes the buffered spans to the span log now, e.g. before reading it.
+        """
+        with self._span_write_lock:
+            with self._lock:
+                buffered, self._span_buffer = self._span_buffer, []
+            lines = {}
+            for path, line in buffered:
+                lines.setdefault(path, []).append(line)
+            for path, path_lines in lines.items():
+                try:
+                    with open(path, "a") as f:
+                        f.writelines(path_lines)
+                except OSError as e:
+                    print(f"Could not write {len(path_lines)} spans to '{path}': {e}")
+
+    def render_prometheus(self):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page.
+        """
+        lines = []
+        with self._lock:
+            for name in sorted({key[0] for key in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            for metric_type, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({key[0] for key in metrics}):
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    for (metric, labels), value in sorted(metrics.items()):
+                        if metric == name:
+                            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label_value(value):
+    # Backslash, double quote and line feed are the characters escaped in Prometheus label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels)
+    return "{" + escaped + "}"
+
+
+registry = MetricsRegistry()
+atexit.register(registry.flush_spans)
+
+
+class Span:
+    """
+    A timed stage of an analysis. Tags can be added while the span is open, e.g. LLM token counts.
+    """
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = dict(tags)
+        self.start = time.time()
+        self.duration = None
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+
+#Function to time a stage of the analysis
+@contextmanager
+def span(name, **tags):
+    """
+    Times a stage of the analysis and exports its duration.
+
+    The duration is added to the 'bill_analyzer_stage_seconds' histogram labelled with the stage and env,
+    and the full span including all tags (uuid, session, token counts, errors) is appended to the JSONL span log.
+
+    Args:
+        name (str): The stage name, e.g. 'fetch', 'preprocess' or 'llm_first'.
+        **tags: Tags of the span, e.g. uuid, env and session.
+
+    Yields:
+        Span: The open span.
+    """
+    current = Span(name, tags)
+    started = time.perf_counter()
+    try:
+        yield current
+    except asyncio.CancelledError:
+        # Work cancelled because the analyst moved on, e.g. see tools/cancellation.py
+        current.set_tag("cancelled", True)
+        raise
+    except Exception as e:
+        current.set_tag("error", type(e).__name__)
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        labels = {"stage": name}
+        labels.update({key: current.tags.get(key) or "none" for key in LABEL_TAGS})
+        registry.observe("bill_analyzer_stage_seconds", labels, current.duration)
+        if "error" in current.tags:
+            registry.increment("bill_analyzer_stage_errors_total", labels)
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if current.tags.get(kind):
+                registry.increment("bill_analyzer_llm_tokens_total", dict(labels, kind=kind), current.tags[kind])
+        registry.write_span({"span": name, "start": current.start, "duration_s": round(current.duration, 6), **current.tags})
+
+
+# Functions called with (span, prompt_tokens, completion_tokens, response) for every LLM response with token usage,
+# e.g. the token accounting of tools/accounting.py
+usage_listeners = []
+
+
+#Function to read the token usage of an LLM response
+def record_llm_usage(current, response):
+    """
+    Adds the prompt and completion token counts of a LangChain chat response to a span,
+    and the model route if the response went through tools.routing. The counts are passed on to usage_listeners.
+
+    Args:
+        current (Span): The span of the LLM call.
+        response (AIMessage): The response returned by the chat model.
+    """
+    route = (getattr(response, "response_metadata", None) or {}).get("route")
+    if route:
+        current.set_tag("route", route)
+
+    usage = getattr(response, "usage_metadata", None)
+    token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    if usage:
+        prompt_tokens, completion_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    elif token_usage:
+        prompt_tokens, completion_tokens = token_usage.get("prompt_tokens", 0), token_usage.get("completion_tokens", 0)
+    else:
+        return
+    current.set_tag("prompt_tokens", prompt_tokens)
+    current.set_tag("completion_tokens", completion_tokens)
+    for listener in usage_listeners:
+        listener(current, prompt_tokens, completion_tokens, response)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+#Function to expose the metrics over HTTP
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Serves the metrics on http://host:port/metrics in a background thread. Only one server is started per process.
+
+    Args:
+        port (int): The port to listen on.
+        host (str, optional): The interface to bind to. Defaults to the loopback interface, so that the metrics
+            are only reachable from other interfaces when asked for (see BILL_ANALYZER_METRICS_HOST).
+
+    Returns:
+        ThreadingHTTPServer: The running metrics server.
+    """
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+            _metrics_server.daemon_threads = True
+            threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
+
+
+#Function to set up metric export from environment variables
+def configure_metrics_from_env():
+    """
+    Configures metric export from the environment. Safe to call on every Streamlit rerun.
+
+    BILL_ANALYZER_METRICS_PORT starts the Prometheus endpoint on that port, bound to BILL_ANALYZER_METRICS_HOST
+    (127.0.0.1 by default, 0.0.0.0 for all interfaces), and BILL_ANALYZER_SPANS_FILE appends every span to that JSONL file.
+    """
+    span_file = os.getenv("BILL_ANALYZER_SPANS_FILE")
+    if span_file:
+        registry.set_span_file(span_file)
+
+    port = os.getenv("BILL_ANALYZER_METRICS_PORT")
+    if port:
+        try:
+            start_metrics_server(int(port), os.getenv("BILL_ANALYZER_METRICS_HOST", "127.0.0.1"))
+        except OSError as e:
+            print(f"Could not start the metrics server on port {port}: {e}")
@@ -0,0 +1,182 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from tools.batch import DEFAULT_DATA_DIR, has_user_payloads, load_user_payloads
+from tools.synthetic import amplify_user_payloads
+
+# Routes of the Bidgely API served by the mock server, mapped to the json_datas payload type they return
+ROUTES = [
+    (re.compile(r"^/v2\.0/dashboard/users/(?P<uuid>[^/]+)/usage-chart-details$"), "itemization"),
+    (re.compile(r"^/meta/users/(?P<uuid>[^/]+)/homes/1$"), "metadata"),
+    (re.compile(r"^/v3\.0/internal/users/(?P<uuid>[^/]+)/homes/1/ELECTRIC/vacation$"), "vacation"),
+]
+
+
+class MockApiConfig:
+    """
+    Behaviour of the mock Bidgely API server.
+
+    Args:
+        data_dir (str): The directory holding the itemization_output, metadata_output and vacation_output folders.
+        latency_ms (float): The mean latency added to every response, in milliseconds.
+        latency_jitter_ms (float): The maximum random deviation from the mean latency, in milliseconds.
+        error_rate (float): The probability (0 to 1) that a request fails with error_status.
+        error_status (int): The HTTP status returned for injected errors.
+        amplify (int): How many times longer the billing cycle history of every user should be.
+        seed (int, optional): Seed for the random generator used for latency and errors.
+    """
+    def __init__(self, data_dir=DEFAULT_DATA_DIR, latency_ms=0.0, latency_jitter_ms=0.0, error_rate=0.0,
+                 error_status=503, amplify=1, seed=None):
+        self.data_dir = data_dir
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.amplify = amplify
+        self.random = random.Random(seed)
+
+
+class MockApiServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server that serves the json_datas payloads on the Bidgely API routes.
+
+    Encoded payloads are cached per UUID, so the server itself stays cheap while being load tested.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, config):
+        super().__init__(server_address, MockApiRequestHandler)
+        self.config = config
+        self.request_count = 0
+        self._payload_cache = {}
+        self._lock = threading.Lock()
+
+    def get_payload(self, uuid, payload_type):
+        """
+        Returns the encoded payload of the given type for a user, or None if the user is unknown.
+        """
+        with self._lock:
+            payloads = self._payload_cache.get(uuid)
+        if payloads is None:
+            payloads = self._load_user(uuid)
+            if payloads is None:
+                return None
+            with self._lock:
+                self._payload_cache[uuid] = payloads
+        return payloads[payload_type]
+
+    def _load_user(self, uuid):
+        if not has_user_payloads(uuid, self.config.data_dir):
+            return None
+        payloads = load_user_payloads(uuid, self.config.data_dir)
+        if any(payload is None for payload in payloads):
+            return None
+
+        itemization_data, metadata, vacation_data = amplify_user_payloads(*payloads, self.config.amplify)
+        return {
+            "itemization": json.dumps(itemization_data).encode("utf-8"),
+            "metadata": json.dumps(metadata).encode("utf-8"),
+            "vacation": json.dumps(vacation_data).encode("utf-8"),
+        }
+
+
+class MockApiRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the mock Bidgely API server.
+    """
+    def do_GET(self):
+        config = self.server.config
+        with self.server._lock:
+            self.server.request_count += 1
+
+        # Simulate network and backend latency
+        delay_ms = config.latency_ms + config.random.uniform(-config.latency_jitter_ms, config.latency_jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send_json(200, b'{"status": "ok"}')
+            return
+
+        if config.error_rate > 0 and config.random.random() < config.error_rate:
+            self._send_json(config.error_status, b'{"error": "injected failure"}')
+            return
+
+        for pattern, payload_type in ROUTES:
+            match = pattern.match(path)
+            if match:
+                payload = self.server.get_payload(match.group("uuid"), payload_type)
+                if payload is None:
+                    self._send_json(404, b'{"error": "unknown user"}')
+                else:
+                    self._send_json(200, payload)
+                return
+
+        self._send_json(404, b'{"error": "unknown route"}')
+
+    def _send_json(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console quiet while load testing
+        pass
+
+
+#Function to start the mock server without blocking the caller
+def start_mock_server(config=None, host="localhost", port=0):
+    """
+    Starts the mock Bidgely API server in a background thread.
+
+    Args:
+        config (MockApiConfig, optional): The server behaviour. Defaults to serving json_datas without latency or errors.
+        host (str, optional): The host to bind to. Defaults to 'localhost'.
+        port (int, optional): The port to bind to. Defaults to 0, which picks a free port.
+
+    Returns:
+        MockApiServer: The running server. Its url is f"http://{host}:{server.server_port}" and it is stopped with server.shutdown().
+    """
+    server = MockApiServer((host, port), config or MockApiConfig())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve json_datas on the Bidgely API routes for local load testing.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean latency added to every response.")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0, help="Maximum random deviation from the mean latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of answering a request with --error-status.")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--amplify", type=int, default=1, help="Multiply every user's billing cycle history by this factor.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockApiConfig(args.data_dir, args.latency_ms, args.latency_jitter_ms, args.error_rate,
+                           args.error_status, args.amplify, args.seed)
+    server = MockApiServer((args.host, args.port), config)
+    print(f"Mock Bidgely API serving '{args.data_dir}' on http://{args.host}:{server.server_port}")
+    print("Select the 'local' env in the Bill Analyzer (set MOCK_API_PRIMARY if not using localhost:8080).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Stop expanding call stacks below this depth when writing collapsed stacks
+MAX_STACK_DEPTH = 64
+
+_index_lock = threading.Lock()
+
+# Held while a request is profiled. From Python 3.12, cProfile uses the process-wide sys.monitoring profiler slot,
+# so a second profiler enabled at the same time, e.g. by another session or thread, raises ValueError.
+_profile_lock = threading.Lock()
+
+
+#Function to decide whether a request should be profiled
+def should_profile(uuid=None):
+    """
+    Checks whether profiling is enabled for a request.
+
+    Profiling is enabled for every request when BILL_ANALYZER_PROFILE is '1'/'true'/'all', and for
+    the users listed in the comma separated BILL_ANALYZER_PROFILE_UUIDS.
+
+    Args:
+        uuid (str, optional): The unique identifier of the user being analysed.
+
+    Returns:
+        bool: True if the request should be profiled.
+    """
+    if os.getenv("BILL_ANALYZER_PROFILE", "").strip().lower() in ("1", "true", "all"):
+        return True
+    allow_list = {value.strip() for value in os.getenv("BILL_ANALYZER_PROFILE_UUIDS", "").split(",") if value.strip()}
+    return bool(uuid) and uuid in allow_list
+
+
+def _function_label(func):
+    filename, line, name = func
+    label = name if filename == "~" else f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(";", ":")
+
+
+#Function to convert a profile to collapsed stacks for flamegraph tools
+def write_collapsed_stacks(stats, path):
+    """
+    Writes a cProfile result as collapsed stacks ("root;caller;callee microseconds" per line),
+    the input format of flamegraph.pl, speedscope and similar tools.
+
+    cProfile only records caller/callee pairs, so the time of a function called from several places
+    is split across its call paths in proportion to the time each caller spent in it.
+
+    Args:
+        stats (pstats.Stats): The profile statistics.
+        path (str): The output file path.
+    """
+    raw = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in raw.items():
+        for caller, (_, _, _, edge_cumulative) in callers.items():
+            callees.setdefault(caller, []).append((func, edge_cumulative))
+
+    lines = {}
+
+    def expand(func, stack, weight):
+        _, _, total_time, cumulative_time, _ = raw[func]
+        stack = stack + [_function_label(func)]
+        self_us = int(total_time * weight * 1e6)
+        if self_us > 0:
+            key = ";".join(stack)
+            lines[key] = lines.get(key, 0) + self_us
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_cumulative in callees.get(func, []):
+            callee_cumulative = raw[callee][3]
+            if callee_cumulative <= 0 or _function_label(callee) in stack:
+                continue
+            callee_weight = weight * edge_cumulative / callee_cumulative
+            if callee_weight * callee_cumulative * 1e6 >= 1:
+                expand(callee, stack, callee_weight)
+
+    roots = [func for func, (_, _, _, _, callers) in raw.items() if not callers]
+    for root in roots:
+        expand(root, [], 1.0)
+
+    with open(path, "w") as f:
+        for stack, value in sorted(lines.items()):
+            f.write(f"{stack} {value}\n")
+
+
+class RequestProfiler:
+    """
+    cProfile wrapper for a single analysis request that can be paused while waiting for user input.
+    """
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.profile = cProfile.Profile()
+        self.elapsed = 0.0
+        self._started = None
+
+    def resume(self):
+        self._started = time.perf_counter()
+        self.profile.enable()
+
+    def pause(self):
+        self.profile.disable()
+        if self._started is not None:
+            self.elapsed += time.perf_counter() - self._started
+            self._started = None
+
+    @contextmanager
+    def paused(self):
+        """
+        Excludes a block, e.g. a blocking input() prompt, from the profile and the request duration.
+        """
+        self.pause()
+        try:
+            yield
+        finally:
+            self.resume()
+
+
+#Function to exclude a block from a profile that may not be running
+@contextmanager
+def pause_profiling(profiler):
+    """
+    Pauses the given request profiler for the enclosed block. Does nothing when profiling is disabled.
+
+    Args:
+        profiler (RequestProfiler or None): The profiler yielded by profile_request.
+    """
+    if profiler is None:
+        yield
+        return
+    with profiler.paused():
+        yield
+
+
+#Function to update the rolling set of slowest profiled requests
+def _record_profile(profile_dir, entry):
+    keep_slowest = int(os.getenv("BILL_ANALYZER_PROFILE_KEEP_SLOWEST", "10"))
+    keep_recent = int(os.getenv("BILL_ANALYZER_PROFILE_KEEP_RECENT", "20"))
+    index_path = os.path.join(profile_dir, "index.json")
+
+    with _index_lock:
+        try:
+            with open(index_path, "r") as f:
+                entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entries = []
+        entries.append(entry)
+
+        slowest = sorted(entries, key=lambda item: item["duration_s"], reverse=True)[:keep_slowest]
+        recent = entries[-keep_recent:]
+        kept = [item for item in entries if item in slowest or item in recent]
+
+        # Delete the profiles that dropped out of both rolling sets
+        for item in entries:
+            if item not in kept:
+                for key in ("pstats", "collapsed"):
+                    try:
+                        os.remove(os.path.join(profile_dir, item[key]))
+                    except FileNotFoundError:
+                        pass
+
+        with open(index_path, "w") as f:
+            json.dump(kept, f, indent=2)
+        with open(os.path.join(profile_dir, "slowest.json"), "w") as f:
+            json.dump(slowest, f, indent=2)
+
+
+#Function to profile an analysis request when profiling is enabled for it
+@contextmanager
+def profile_request(uuid=None, **tags):
+    """
+    Profiles the enclosed block if profiling is enabled for the user (see should_profile).
+
+    On exit, requests slower than BILL_ANALYZER_PROFILE_MIN_MS are written to BILL_ANALYZER_PROFILE_DIR
+    (default 'profiles') as '<uuid>_<timestamp>.pstats' and '<uuid>_<timestamp>.collapsed'. The directory
+    keeps the BILL_ANALYZER_PROFILE_KEEP_SLOWEST slowest and BILL_ANALYZER_PROFILE_KEEP_RECENT most recent
+    profiles, listed in 'slowest.json' and 'index.json'.
+
+    Only one request of the process is profiled at a time: requests starting while another one is profiled,
+    or while another profiler or debugger is active, run without profiling.
+
+    Args:
+        uuid (str, optional): The unique identifier of the user being analysed.
+        **tags: Extra information stored with the profile, e.g. env.
+
+    Yields:
+        RequestProfiler or None: The running profiler, or None when profiling is disabled.
+    """
+    if not should_profile(uuid) or not _profile_lock.acquire(blocking=False):
+        yield None
+        return
+
+    profiler = RequestProfiler(uuid)
+    try:
+        profiler.resume()
+    except ValueError as e:
+        # Another profiler holds the profiling slot of the interpreter
+        _profile_lock.release()
+        print(f"Request of '{uuid}' not profiled: {e}")
+        profiler = None
+    if profiler is None:
+        yield None
+        return
+    try:
+        yield profiler
+    finally:
+        profiler.pause()
+        _profile_lock.release()
+        if profiler.elapsed * 1000 >= float(os.getenv("BILL_ANALYZER_PROFILE_MIN_MS", "0")):
+            profile_dir = os.getenv("BILL_ANALYZER_PROFILE_DIR", "profiles")
+            os.makedirs(profile_dir, exist_ok=True)
+            name = f"{uuid or 'upload'}_{datetime.now().strftime('%Y%m%dT%H%M%S%f')}"
+
+            stats = pstats.Stats(profiler.profile)
+            stats.dump_stats(os.path.join(profile_dir, f"{name}.pstats"))
+            write_collapsed_stacks(stats, os.path.join(profile_dir, f"{name}.collapsed"))
+
+            _record_profile(profile_dir, {
+                "uuid": uuid,
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "duration_s": round(profiler.elapsed, 6),
+                "pstats": f"{name}.pstats",
+                "collapsed": f"{name}.collapsed",
+                **tags
+            })
+            print(f"Profile of '{uuid}' ({profiler.elapsed:.2f}s) written to '{os.path.join(profile_dir, name)}.pstats'.")
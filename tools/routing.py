@@ -0,0 +1,261 @@
+import os
+import re
+import time
+
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable
+from langchain_core.runnables.config import patch_config
+
+from tools.llm import with_model
+from tools.metrics import registry
+
+# Whether calls are routed between the large and the small model (off by default: every call goes to gpt-4o)
+ROUTING_ENABLED = os.getenv("BILL_ANALYZER_ROUTING", "off").strip().lower() in ("1", "true", "yes", "on")
+
+# The model of the 'small' route
+SMALL_MODEL_NAME = os.getenv("BILL_ANALYZER_SMALL_MODEL", "gpt-4o-mini")
+
+# Prompt types that may be answered by the small model. The first comparison always needs the large model.
+SMALL_MODEL_PROMPTS = ("followup",)
+
+# Prompts estimated above this many tokens (the follow-up prompt includes the whole conversation) go to the large model
+ROUTE_SMALL_MAX_TOKENS = int(os.getenv("BILL_ANALYZER_ROUTE_SMALL_MAX_TOKENS", "8000"))
+
+# Confidence that the small model is good enough (1 - question complexity) below which the large model is used
+ROUTE_MIN_CONFIDENCE = float(os.getenv("BILL_ANALYZER_ROUTE_MIN_CONFIDENCE", "0.6"))
+
+# Words of questions that need calculations or reasoning across cycles
+COMPLEX_TERMS = {"compare", "comparison", "calculate", "estimate", "predict", "forecast", "breakdown", "recommend",
+                 "versus", "vs", "trend", "percentage", "percent", "average", "total", "if", "would", "all", "each"}
+
+
+#Function to estimate the tokens of a prompt
+def estimate_tokens(messages):
+    """
+    Estimates the prompt tokens of a list of messages at four characters per token, without a tokenizer.
+    """
+    return sum(len(str(message.content)) for message in messages) // 4
+
+
+#Function to score how complex a question is
+def question_complexity(question):
+    """
+    Scores how much reasoning a question needs, from 0 (a short clarification) to 1.
+
+    Long questions, terms that ask for calculations or comparisons (see COMPLEX_TERMS), numbers to work with
+    and several questions in one message all add to the score.
+
+    Args:
+        question (str): The question of the analyst.
+
+    Returns:
+        float: The complexity.
+    """
+    words = re.findall(r"[a-z0-9%$']+", question.lower())
+    score = min(len(words) / 60, 1.0) * 0.4
+    score += 0.2 * len(COMPLEX_TERMS.intersection(words))
+    score += 0.1 * len(re.findall(r"\d+(?:\.\d+)?", question))
+    if question.count("?") > 1:
+        score += 0.2
+    return min(score, 1.0)
+
+
+#Function to pick the model of an LLM call
+def choose_route(prompt_type, question, prompt_tokens):
+    """
+    Picks the model of a call from the prompt type, the estimated prompt tokens and the complexity of the question.
+
+    Args:
+        prompt_type (str): The prompt of the call, e.g. 'first' or 'followup'.
+        question (str): The question of the analyst.
+        prompt_tokens (int): The estimated prompt tokens, see estimate_tokens.
+
+    Returns:
+        tuple: (route, confidence). route is 'small' or 'large'; confidence is how sure the router is that the small
+        model is good enough (0 when the prompt type or size rules it out).
+    """
+    if prompt_type not in SMALL_MODEL_PROMPTS or prompt_tokens > ROUTE_SMALL_MAX_TOKENS:
+        return "large", 0.0
+    confidence = 1 - question_complexity(question)
+    return ("small" if confidence >= ROUTE_MIN_CONFIDENCE else "large"), confidence
+
+
+def _question(input):
+    """
+    The question of a chain input: {'input': question}, or the messages passed by RunnableWithMessageHistory.
+    """
+    if isinstance(input, dict):
+        input = input.get("input", "")
+    if isinstance(input, list):
+        input = input[-1].content if input and isinstance(input[-1], BaseMessage) else ""
+    return str(input)
+
+
+def _record(prompt_type, route, started, response, outcome):
+    labels = {"prompt": prompt_type, "route": route}
+    registry.observe("bill_analyzer_llm_route_seconds", labels, time.perf_counter() - started)
+    registry.increment("bill_analyzer_llm_route_total", dict(labels, outcome=outcome))
+    usage = getattr(response, "usage_metadata", None) or {}
+    for kind, key in (("prompt_tokens", "input_tokens"), ("completion_tokens", "output_tokens")):
+        if usage.get(key):
+            registry.increment("bill_analyzer_llm_route_tokens_total", dict(labels, kind=kind), usage[key])
+
+
+class RoutedChain(Runnable):
+    """
+    A prompt followed by the model chosen per call (see choose_route), in place of `prompt | llm`.
+
+    Calls routed to the small model fall back to the large one if the small model fails or returns an empty answer
+    (when streaming, only before its first chunk). Errors of the large model are recorded and raised. The latency, outcome and tokens of every call are recorded per
+    prompt type and route, and the route is added to the response metadata for record_llm_usage.
+
+    Args:
+        prompt (ChatPromptTemplate): The prompt.
+        prompt_type (str): The name of the prompt, e.g. 'first' or 'followup'.
+        large (BaseChatModel): The large model.
+        small (BaseChatModel): The small model.
+    """
+    def __init__(self, prompt, prompt_type, large, small):
+        self.prompt = prompt
+        self.prompt_type = prompt_type
+        self.large = large
+        self.small = small
+
+    def _route(self, input, config):
+        messages = self.prompt.invoke(input, config).to_messages()
+        route, _ = choose_route(self.prompt_type, _question(input), estimate_tokens(messages))
+        return messages, route
+
+    def _model(self, route):
+        return self.small if route == "small" else self.large
+
+    def _tag(self, response, route):
+        response.response_metadata = dict(response.response_metadata or {}, route=route)
+        return response
+
+    def _invoke(self, input, run_manager, config):
+        config = patch_config(config, callbacks=run_manager.get_child())
+        messages, route = self._route(input, config)
+        started = time.perf_counter()
+        if route == "small":
+            try:
+                response = self.small.invoke(messages, config)
+                if response.content:
+                    _record(self.prompt_type, route, started, response, "ok")
+                    return self._tag(response, route)
+                _record(self.prompt_type, route, started, response, "fallback")
+            except Exception:
+                _record(self.prompt_type, route, started, None, "fallback")
+            route, started = "large", time.perf_counter()
+        try:
+            response = self.large.invoke(messages, config)
+        except Exception:
+            _record(self.prompt_type, route, started, None, "error")
+            raise
+        _record(self.prompt_type, route, started, response, "ok")
+        return self._tag(response, route)
+
+    async def _ainvoke(self, input, run_manager, config):
+        config = patch_config(config, callbacks=run_manager.get_child())
+        messages, route = self._route(input, config)
+        started = time.perf_counter()
+        if route == "small":
+            try:
+                response = await self.small.ainvoke(messages, config)
+                if response.content:
+                    _record(self.prompt_type, route, started, response, "ok")
+                    return self._tag(response, route)
+                _record(self.prompt_type, route, started, response, "fallback")
+            except Exception:
+                _record(self.prompt_type, route, started, None, "fallback")
+            route, started = "large", time.perf_counter()
+        try:
+            response = await self.large.ainvoke(messages, config)
+        except Exception:
+            _record(self.prompt_type, route, started, None, "error")
+            raise
+        _record(self.prompt_type, route, started, response, "ok")
+        return self._tag(response, route)
+
+    def _transform(self, inputs, run_manager, config):
+        config = patch_config(config, callbacks=run_manager.get_child())
+        messages, route = self._route(next(iter(inputs)), config)
+        started = time.perf_counter()
+        full = None
+        try:
+            for chunk in self._model(route).stream(messages, config):
+                full = chunk if full is None else full + chunk
+                yield self._tag(chunk, route) if full is chunk else chunk
+        except Exception:
+            if route != "small" or full is not None:
+                _record(self.prompt_type, route, started, full, "error")
+                raise
+            _record(self.prompt_type, route, started, None, "fallback")
+            route, started = "large", time.perf_counter()
+            for chunk in self.large.stream(messages, config):
+                full = chunk if full is None else full + chunk
+                yield self._tag(chunk, route) if full is chunk else chunk
+        _record(self.prompt_type, route, started, full, "ok")
+
+    async def _atransform(self, inputs, run_manager, config):
+        config = patch_config(config, callbacks=run_manager.get_child())
+        async for input in inputs:
+            break
+        messages, route = self._route(input, config)
+        started = time.perf_counter()
+        full = None
+        try:
+            async for chunk in self._model(route).astream(messages, config):
+                full = chunk if full is None else full + chunk
+                yield self._tag(chunk, route) if full is chunk else chunk
+        except Exception:
+            if route != "small" or full is not None:
+                _record(self.prompt_type, route, started, full, "error")
+                raise
+            _record(self.prompt_type, route, started, None, "fallback")
+            route, started = "large", time.perf_counter()
+            async for chunk in self.large.astream(messages, config):
+                full = chunk if full is None else full + chunk
+                yield self._tag(chunk, route) if full is chunk else chunk
+        _record(self.prompt_type, route, started, full, "ok")
+
+    def invoke(self, input, config=None, **kwargs):
+        return self._call_with_config(self._invoke, input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self._acall_with_config(self._ainvoke, input, config, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self._transform_stream_with_config(iter([input]), self._transform, config, **kwargs)
+
+    async def astream(self, input, config=None, **kwargs):
+        async def inputs():
+            yield input
+
+        async for chunk in self._atransform_stream_with_config(inputs(), self._atransform, config, **kwargs):
+            yield chunk
+
+
+#Function to build a chain with model routing
+def route_chain(prompt, llm, prompt_type, small=None):
+    """
+    Builds `prompt | llm`, routed between llm and a small model per call when BILL_ANALYZER_ROUTING is on.
+
+    Args:
+        prompt (ChatPromptTemplate): The prompt.
+        llm (BaseChatModel): The large model, see get_chat_model.
+        prompt_type (str): The name of the prompt, e.g. 'first' or 'followup'. See SMALL_MODEL_PROMPTS.
+        small (BaseChatModel, optional): The small model. Defaults to SMALL_MODEL_NAME on the backend of llm
+            (see with_model), so that recorded, replayed and injected models are never bypassed.
+            Without one, every call goes to llm.
+
+    Returns:
+        Runnable: The chain.
+    """
+    if not ROUTING_ENABLED:
+        return prompt | llm
+    # The copy keeps the backend, cassette and streamed usage reporting of the large model
+    small = small if small is not None else with_model(llm, SMALL_MODEL_NAME)
+    if small is None:
+        return prompt | llm
+    return RoutedChain(prompt, prompt_type, llm, small)
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from tools.metrics import registry
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs concurrent calls with the same key once: the first caller (the leader) runs the call, and callers arriving
+    while it is in flight wait for it and get the same result or exception instead of running it again.
+    A call finishing ends its flight, so later callers run it again.
+
+    Threads use do and coroutines use ado. Async flights are only shared between callers of the same event loop.
+    The async call keeps running while any of its callers waits for it: a cancelled caller only stops waiting,
+    and the call is cancelled with the last one.
+
+    Args:
+        name (str): The name of the flights in the metrics, e.g. 'user_store'.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._flights = {}
+
+    def _count(self, outcome):
+        registry.increment("bill_analyzer_singleflight_total", {"flight": self.name, "outcome": outcome})
+
+    def do(self, key, function):
+        """
+        Returns function(), or the result of the call of another thread with the same key that is in flight.
+
+        Args:
+            key (hashable): Identifies the call, e.g. (env, uuid, window).
+            function (callable): The call. Only called by the leader.
+
+        Returns:
+            The result of the call. Its exception is raised to every caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            self._count("coalesced")
+            return future.result()
+        self._count("leader")
+        try:
+            result = function()
+        except BaseException as e:
+            self._count("failed")
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def ado(self, key, coroutine_function):
+        """
+        Async version of do, where the call is a coroutine function.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._flights.get((loop, key))
+            leader = flight is None
+            if leader:
+                flight = self._flights[(loop, key)] = _Flight(loop.create_task(coroutine_function()))
+                flight.task.add_done_callback(lambda task: self._landed(loop, key, flight))
+            flight.waiters += 1
+        self._count("leader" if leader else "coalesced")
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller was cancelled: nobody needs the result anymore
+                with self._lock:
+                    if self._flights.get((loop, key)) is flight:
+                        del self._flights[(loop, key)]
+                flight.task.cancel()
+                self._count("abandoned")
+
+    def _landed(self, loop, key, flight):
+        with self._lock:
+            if self._flights.get((loop, key)) is flight:
+                del self._flights[(loop, key)]
+        if not flight.task.cancelled() and flight.task.exception() is not None:
+            self._count("failed")
+
+    def in_flight(self):
+        """
+        Returns the number of calls currently in flight.
+        """
+        with self._lock:
+            return len(self._calls) + len(self._flights)
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import threading
+
+from tools.metrics import registry
+
+# Number of predicted cycle pairs that are precomputed per loaded user. Off (0) by default, as every speculated pair
+# is a full first comparison call charged to the session whether the analyst picks it or not.
+SPECULATE_PAIRS = int(os.getenv("BILL_ANALYZER_SPECULATE_PAIRS", "0"))
+
+# Speculative LLM calls running at the same time across all sessions
+SPECULATE_MAX_INFLIGHT = int(os.getenv("BILL_ANALYZER_SPECULATE_MAX_INFLIGHT", "4"))
+
+# Speculative work that takes longer than this many seconds is abandoned
+SPECULATE_TIMEOUT_SECONDS = float(os.getenv("BILL_ANALYZER_SPECULATE_TIMEOUT", "60"))
+
+# Groups of untaken work kept at most; the oldest group is cancelled when a new one starts
+SPECULATE_MAX_GROUPS = 64
+
+
+#Function to predict which cycles an analyst will compare
+def predicted_pairs(json_file, limit=SPECULATE_PAIRS):
+    """
+    Predicts the most likely comparisons of an analysis window: the latest cycle against the previous one,
+    then the latest cycle against the cycle of the same month one year earlier.
+
+    Args:
+        json_file (list of dict): The billing cycles of the analysis window, oldest first.
+        limit (int, optional): The maximum number of pairs to return.
+
+    Returns:
+        list of tuple: (idx1, idx2) pairs, as selected in the first and second cycle selectboxes.
+    """
+    if len(json_file) < 2 or limit <= 0:
+        return []
+    latest = len(json_file) - 1
+    pairs = [(latest - 1, latest)]
+
+    year, month = json_file[latest]["IntervalEndDate"][:4], json_file[latest]["IntervalEndDate"][5:7]
+    last_year = f"{int(year) - 1}-{month}"
+    for i in range(latest - 2, -1, -1):
+        if json_file[i]["IntervalEndDate"][:7] == last_year:
+            pairs.append((i, latest))
+            break
+    return pairs[:limit]
+
+
+class SpeculativeRunner:
+    """
+    Runs speculative work on a private event loop thread so that it can be cancelled while in flight.
+
+    Work is submitted as coroutines under a key and grouped, e.g. by the loaded user, so that everything
+    speculated for a user can be cancelled once the analyst has made a choice. LLM calls made through
+    limit() share SPECULATE_MAX_INFLIGHT slots, and every piece of work is abandoned after SPECULATE_TIMEOUT_SECONDS.
+    """
+    def __init__(self, max_inflight=SPECULATE_MAX_INFLIGHT, timeout=SPECULATE_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._groups = {}
+        threading.Thread(target=self._loop.run_forever, daemon=True, name="speculation").start()
+
+    async def limit(self, coroutine):
+        """
+        Awaits a coroutine, e.g. an LLM call, in one of the shared in-flight slots.
+        Waits for a free slot without blocking the event loop.
+        """
+        while not self._slots.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+        try:
+            return await coroutine
+        finally:
+            self._slots.release()
+
+    async def _run(self, coroutine):
+        try:
+            return await asyncio.wait_for(coroutine, self.timeout)
+        except asyncio.TimeoutError:
+            registry.increment("bill_analyzer_speculation_total", {"outcome": "timeout"})
+            raise
+
+    def submit(self, group, key, coroutine_factory):
+        """
+        Starts speculative work unless work with the same key is already running or done.
+
+        Args:
+            group (hashable): The group of the work, e.g. the fingerprint of the loaded data.
+            key (hashable): The key of the work, e.g. the predicted cycle pair.
+            coroutine_factory (callable): Returns the coroutine to run. Only called if the work is started.
+
+        Returns:
+            bool: True if the work was started.
+        """
+        with self._lock:
+            if key in self._futures:
+                return False
+            stale = list(self._groups)[:len(self._groups) + 1 - SPECULATE_MAX_GROUPS] if group not in self._groups else []
+            future = asyncio.run_coroutine_threadsafe(self._run(coroutine_factory()), self._loop)
+            self._futures[key] = future
+            self._groups.setdefault(group, set()).add(key)
+        for old_group in stale:
+            self.cancel_group(old_group)
+        registry.increment("bill_analyzer_speculation_total", {"outcome": "started"})
+        return True
+
+    def claim(self, key):
+        """
+        Hands speculative work over to the caller without waiting for it, e.g. to the session that picked the
+        predicted comparison. Claimed work is no longer cancelled with its group.
+
+        Args:
+            key (hashable): The key the work was submitted under.
+
+        Returns:
+            concurrent.futures.Future or None: The work, running or done (see speculation_result), or None if
+            nothing was speculated for the key.
+        """
+        with self._lock:
+            future = self._futures.pop(key, None)
+            for keys in self._groups.values():
+                keys.discard(key)
+        registry.increment("bill_analyzer_speculation_total", {"outcome": "miss" if future is None else "claimed"})
+        return future
+
+    def cancel_group(self, group):
+        """
+        Cancels all speculative work of a group that has not been taken, including in-flight LLM calls.
+
+        Returns:
+            int: The number of pieces of work that were cancelled before they finished.
+        """
+        with self._lock:
+            futures = [self._futures.pop(key) for key in self._groups.pop(group, set()) if key in self._futures]
+        cancelled = sum(1 for future in futures if future.cancel())
+        if cancelled:
+            registry.increment("bill_analyzer_speculation_total", {"outcome": "cancelled"}, cancelled)
+        return cancelled
+
+
+#Function to await claimed speculative work
+async def speculation_result(future):
+    """
+    Awaits speculative work claimed with SpeculativeRunner.claim from any event loop, without blocking it.
+    Cancelling the caller cancels the work.
+
+    Args:
+        future (concurrent.futures.Future): The claimed work.
+
+    Returns:
+        The result, or None if the work had none, failed, timed out or was cancelled.
+    """
+    if future.cancelled():
+        return None
+    try:
+        result = await asyncio.wrap_future(future)
+    except Exception as e:
+        print(f"Speculative work was not used: {type(e).__name__}")
+        registry.increment("bill_analyzer_speculation_total", {"outcome": "failed"})
+        return None
+    # Work may finish without a result, e.g. when nothing had to be asked to the LLM
+    registry.increment("bill_analyzer_speculation_total", {"outcome": "hit" if result is not None else "empty"})
+    return result
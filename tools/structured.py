@@ -0,0 +1,246 @@
+import json
+import os
+import re
+
+from dataset import first_prompt, structured_prompt
+from tools.accounting import estimate_prompt_tokens
+from tools.drivers import analyse_drivers, render_drivers
+from tools.llm import json_mode
+from tools.metrics import registry
+from tools.utils import calculate_difference
+
+# Names of the itemization categories in the explanations
+CATEGORY_LABELS = {
+    "airConditioning": "Air conditioning",
+    "alwaysOn": "Always-on appliances",
+    "electricVehicle": "Electric vehicle charging",
+    "entertainment": "Entertainment",
+    "lighting": "Lighting",
+    "pool": "Pool pumps",
+    "otherGeneralUsage": "Other general usage",
+    "spaceHeating": "Space heating",
+    "waterHeating": "Water heating",
+}
+
+# Names of the other drivers, with the calculate_difference key that tells whether they changed
+# and whether their increase makes cycle two more expensive (1), cheaper (-1) or either (0)
+DRIVERS = {
+    "days": ("The billing period length", "num_days", 1),
+    "holidays": ("Holidays", "num_holidays", 1),
+    "vacation": ("Vacation days", "num_vacation", -1),
+    "temperature": ("The temperature", "temperature", 0),
+    "consumption": ("The overall consumption", "consumption", 1),
+    "rates": ("The electricity rates", "electricity_rates", 1),
+}
+
+# Keys the model sometimes uses instead of the requested ones
+DRIVER_ALIASES = {
+    "num_days": "days",
+    "billing days": "days",
+    "num_holidays": "holidays",
+    "num_vacation": "vacation",
+    "weather": "temperature",
+    "usage": "consumption",
+    "other usage": "consumption",
+    "rate": "rates",
+    "electricity_rates": "rates",
+    "tier": "rates",
+    "tou": "rates",
+}
+
+
+#Function to read whether the first comparison is answered with structured output
+def structured_output_enabled():
+    """
+    Returns True if BILL_ANALYZER_STRUCTURED_OUTPUT is set ('1', 'true', 'yes' or 'on'). Defaults to False.
+    """
+    return os.getenv("BILL_ANALYZER_STRUCTURED_OUTPUT", "off").strip().lower() in ("1", "true", "yes", "on")
+
+
+#Function to estimate the prompt tokens of the first comparison
+def first_prompt_tokens(query):
+    """
+    Estimates the prompt tokens of the first comparison of a query, with the structured or the prose prompt.
+    """
+    return estimate_prompt_tokens(structured_prompt if structured_output_enabled() else first_prompt, query)
+
+
+#Function to read the structured reasons of the LLM
+def parse_reasons(text):
+    """
+    Parses the JSON response of structured_prompt.
+
+    Args:
+        text (str): The response of the LLM. A surrounding markdown code fence is ignored.
+
+    Returns:
+        list of dict or None: The reasons, each with driver, amount, direction and detail, in the order given.
+        Reasons with an unusable amount or direction are left out. None if the response is not the requested JSON.
+    """
+    text = re.sub(r"^\s*```(?:json)?\s*|\s*```\s*$", "", text or "")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("reasons"), list):
+        return None
+
+    reasons = []
+    for entry in data["reasons"]:
+        if not isinstance(entry, dict) or not isinstance(entry.get("driver"), str):
+            continue
+        amount, direction = entry.get("amount"), str(entry.get("direction", "")).strip().lower()
+        if isinstance(amount, str):
+            amount = amount.strip().lstrip("$").replace(",", "")
+            amount = float(amount) if re.fullmatch(r"-?\d+(\.\d+)?", amount) else None
+        if not isinstance(amount, (int, float)) or direction not in ("up", "down"):
+            continue
+        driver = entry["driver"].strip()
+        detail = entry.get("detail") if isinstance(entry.get("detail"), str) else ""
+        reasons.append({
+            "driver": DRIVER_ALIASES.get(driver.lower(), driver),
+            "amount": round(abs(amount)),
+            "direction": direction,
+            "detail": detail.strip().rstrip("."),
+        })
+    return reasons
+
+
+def _sign(value):
+    return (value > 0) - (value < 0)
+
+
+#Function to check structured reasons against the data
+def validate_reasons(reasons, difference):
+    """
+    Checks the reasons against the difference of the two cycles, as returned by calculate_difference.
+
+    The cost change of an appliance category is taken from the data, correcting the amount and direction of the LLM
+    (the detail is dropped if the direction was wrong).
+    Reasons about factors that did not change (same number of days, no category cost change, same rates...),
+    reasons whose direction contradicts the data (more vacation days making cycle two more expensive...),
+    repeated drivers and unknown drivers are dropped.
+
+    Args:
+        reasons (list of dict): The reasons returned by parse_reasons.
+        difference (dict): The difference from cycle one to cycle two.
+
+    Returns:
+        list of dict: The remaining reasons, sorted by decreasing amount.
+    """
+    itemization = difference.get("itemizationDetailsList")
+    valid, seen = [], set()
+    for reason in reasons:
+        driver = reason["driver"]
+        if driver in seen:
+            outcome = "dropped"
+        elif driver in CATEGORY_LABELS:
+            change = itemization.get(driver, [None, None])[1] if isinstance(itemization, dict) else None
+            if change is None:
+                # No itemization for one of the cycles: the prompt forbids category reasons
+                outcome = "dropped"
+            elif round(change) == 0:
+                outcome = "dropped"
+            else:
+                corrected = dict(reason, amount=round(abs(change)), direction="up" if change > 0 else "down")
+                if corrected["direction"] != reason["direction"]:
+                    # The stated cause argued for the wrong direction
+                    corrected["detail"] = ""
+                outcome = "corrected" if corrected != reason else "kept"
+                reason = corrected
+        elif driver in DRIVERS:
+            _, key, effect = DRIVERS[driver]
+            change = difference.get(key)
+            if key == "electricity_rates":
+                change = {"higher in cycle2 and lower in cycle1": 1, "lower in cycle2 and higher in cycle1": -1, "same": 0}.get(change)
+            if change is None:
+                outcome = "kept"
+            elif change == 0:
+                outcome = "dropped"
+            elif effect and _sign(change) * effect != (1 if reason["direction"] == "up" else -1):
+                outcome = "dropped"
+            else:
+                outcome = "kept"
+        else:
+            outcome = "dropped"
+        registry.increment("bill_analyzer_structured_reasons_total", {"outcome": outcome})
+        if outcome != "dropped" and reason["amount"] > 0:
+            seen.add(driver)
+            valid.append(reason)
+    valid.sort(key=lambda reason: reason["amount"], reverse=True)
+    return valid
+
+
+#Function to render structured reasons
+def render_reasons(reasons, difference):
+    """
+    Renders validated reasons as the markdown explanation shown to the homeowner.
+
+    Args:
+        reasons (list of dict): The reasons returned by validate_reasons.
+        difference (dict): The difference from cycle one to cycle two, as returned by calculate_difference.
+
+    Returns:
+        str: The explanation.
+    """
+    change = difference.get("cost")
+    overall = _sign(change) if isinstance(change, (int, float)) else 0
+    if overall > 0:
+        lines = [f"Possible reasons for the higher cost in Cycle 2 (${change:g} more than Cycle 1) are:"]
+    elif overall < 0:
+        lines = [f"Possible reasons for the higher cost in Cycle 1 (${-change:g} more than Cycle 2) are:"]
+    else:
+        lines = ["Possible reasons for the cost difference between the two billing cycles are:"]
+    lines.append("")
+    for i, reason in enumerate(reasons, start=1):
+        label = CATEGORY_LABELS.get(reason["driver"]) or DRIVERS[reason["driver"]][0]
+        up = reason["direction"] == "up"
+        sentence = f"{label}: {reason['detail']}, which" if reason["detail"] else label
+        sentence += f" {'added' if up else 'saved'} about ${reason['amount']} {'to' if up else 'on'} the cost of Cycle 2"
+        if overall and (1 if up else -1) != overall:
+            sentence += f", although the total cost went {'down' if overall < 0 else 'up'}"
+        lines.append(f"{i}. {sentence}.")
+    return "\n".join(lines)
+
+
+def _answer(response, cycle1, cycle2):
+    difference = calculate_difference(cycle1, cycle2)
+    reasons = parse_reasons(response.content)
+    reasons = validate_reasons(reasons, difference) if reasons is not None else []
+    if reasons:
+        registry.increment("bill_analyzer_structured_output_total", {"outcome": "rendered"})
+        return render_reasons(reasons, difference), reasons
+    # Not the requested JSON, or nothing survived the validation
+    registry.increment("bill_analyzer_structured_output_total", {"outcome": "fallback"})
+    analysis = analyse_drivers(cycle1, cycle2)
+    return (render_drivers(analysis) if analysis is not None else response.content), None
+
+
+#Function to answer the first comparison with structured output
+def structured_first_answer(llm, query, cycle1, cycle2):
+    """
+    Answers the first comparison with a terse JSON list of reasons (see structured_prompt) instead of prose,
+    then checks the reasons against calculate_difference and renders them locally.
+    If the response is unusable, the templated driver explanation (see tools/drivers.py) is returned instead.
+
+    Args:
+        llm (BaseChatModel): The chat model.
+        query (str): The first question, as built by build_first_query or build_drivers_query.
+        cycle1 (dict): The first billing cycle, as returned by preprocess.
+        cycle2 (dict): The second billing cycle, as returned by preprocess.
+
+    Returns:
+        tuple: (text, reasons, response). text is the explanation. reasons are the validated reasons, or None
+        if the fallback was used. response is the message of the LLM, for usage accounting.
+    """
+    response = (structured_prompt | json_mode(llm)).invoke({"input": query})
+    return _answer(response, cycle1, cycle2) + (response,)
+
+
+#Function to answer the first comparison with structured output, asynchronously
+async def astructured_first_answer(llm, query, cycle1, cycle2):
+    """
+    Async version of structured_first_answer.
+    """
+    response = await (structured_prompt | json_mode(llm)).ainvoke({"input": query})
+    return _answer(response, cycle1, cycle2) + (response,)
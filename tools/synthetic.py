@@ -0,0 +1,210 @@
+import copy
+from datetime import datetime, timezone
+
+# Synthetic copies of a history never start before this year: older years are formatted with fewer than four
+# digits, which strptime('%Y') does not parse back
+MIN_SYNTHETIC_YEAR = 1000
+
+#Function to move a datetime back by a whole number of years
+def shift_years(value, years):
+    """
+    Moves a datetime by the given number of years, keeping month, day and time of day.
+
+    February 29th is mapped to February 28th when the target year is not a leap year.
+
+    Args:
+        value (datetime): The datetime to shift.
+        years (int): The number of years to add (negative values move back in time).
+
+    Returns:
+        datetime: The shifted datetime.
+    """
+    try:
+        return value.replace(year=value.year + years)
+    except ValueError:
+        return value.replace(year=value.year + years, day=28)
+
+
+#Function to shift a unix timestamp by a whole number of years
+def shift_epoch(timestamp, years):
+    """
+    Shifts a unix timestamp (in seconds) by a whole number of years.
+
+    Args:
+        timestamp (int or None): The unix timestamp to shift.
+        years (int): The number of years to add.
+
+    Returns:
+        int or None: The shifted timestamp, or None if no timestamp was given.
+    """
+    if timestamp is None:
+        return None
+    shifted = shift_years(datetime.fromtimestamp(timestamp, tz=timezone.utc), years)
+    return int(shifted.timestamp())
+
+
+#Function to shift a formatted date string by a whole number of years
+def shift_date_string(date_str, date_format, years):
+    """
+    Shifts a formatted date string by a whole number of years.
+
+    Args:
+        date_str (str or None): The date string to shift.
+        date_format (str): The strptime format of the date string.
+        years (int): The number of years to add.
+
+    Returns:
+        str or None: The shifted date string in the same format, or None if no date was given.
+    """
+    if not date_str:
+        return date_str
+    return shift_years(datetime.strptime(date_str, date_format), years).strftime(date_format)
+
+
+#Function to find how many years a copy of the history has to move back so that copies never overlap
+def history_span_years(data):
+    """
+    Calculates the number of whole years covered by the billing cycles of an itemization payload.
+
+    Args:
+        data (dict): The raw itemization JSON data containing the usage chart data list.
+
+    Returns:
+        int: The number of years each synthetic copy of the history is shifted back by.
+    """
+    cycles = data["payload"]["usageChartDataList"]
+    if not cycles:
+        return 1
+    first_year = int(cycles[0]["intervalStartDateFormatted"][:4])
+    last_year = int(cycles[-1]["intervalEndDateFormatted"][:4])
+    return last_year - first_year + 1
+
+
+#Function to find how many years each copy of a history can move back
+def copy_shift_years(data, factor, span_years):
+    """
+    Calculates the number of years between two consecutive copies of an amplified history.
+
+    This is the span of the history, so that copies never overlap, unless the oldest copy would then start
+    before MIN_SYNTHETIC_YEAR. The copies are then shifted by fewer whole years and overlap, which keeps the
+    amplified history as long and its seasons aligned, but not strictly chronological.
+
+    Args:
+        data (dict): The raw itemization JSON data containing the usage chart data list.
+        factor (int): How many times longer the resulting history should be (at least 2).
+        span_years (int): The number of whole years covered by the history, see history_span_years.
+
+    Returns:
+        int: The number of years each copy is shifted by, relative to the next more recent one.
+
+    Raises:
+        ValueError: If the factor is too large even with copies one year apart.
+    """
+    first_year = int(data["payload"]["usageChartDataList"][0]["intervalStartDateFormatted"][:4])
+    shift = min(span_years, (first_year - MIN_SYNTHETIC_YEAR) // (factor - 1))
+    if shift < 1:
+        raise ValueError(f"A history starting in {first_year} can be amplified at most "
+                         f"{first_year - MIN_SYNTHETIC_YEAR + 1} times, not {factor}.")
+    return shift
+
+
+#Function to synthesise a longer itemization history
+def amplify_itemization_data(data, factor, span_years=None):
+    """
+    Synthesises a larger itemization payload by prepending shifted copies of the billing cycle history.
+
+    Every copy is moved back by a whole number of years, so months and seasons of the synthetic cycles
+    still line up with the original ones. The original payload is not modified.
+
+    Args:
+        data (dict): The raw itemization JSON data containing the usage chart data list.
+        factor (int): How many times longer the resulting history should be. A factor of 1 returns a copy.
+        span_years (int, optional): The number of years covered by the history. Defaults to history_span_years.
+            Copies are shifted by this many years, or fewer if needed (see copy_shift_years).
+
+    Returns:
+        dict: The amplified itemization JSON data.
+    """
+    amplified = copy.deepcopy(data)
+    cycles = amplified["payload"]["usageChartDataList"]
+    if factor <= 1 or not cycles:
+        return amplified
+
+    shift = copy_shift_years(data, factor, span_years or history_span_years(data))
+    synthetic_cycles = []
+    for copy_index in range(factor - 1, 0, -1):
+        years = -copy_index * shift
+        for cycle in data["payload"]["usageChartDataList"]:
+            synthetic_cycle = copy.deepcopy(cycle)
+            synthetic_cycle["intervalStart"] = shift_epoch(cycle.get("intervalStart"), years)
+            synthetic_cycle["intervalEnd"] = shift_epoch(cycle.get("intervalEnd"), years)
+            synthetic_cycle["intervalStartDate"] = shift_date_string(cycle.get("intervalStartDate"), "%Y-%m-%d %H:%M:%S", years)
+            synthetic_cycle["intervalEndDate"] = shift_date_string(cycle.get("intervalEndDate"), "%Y-%m-%d %H:%M:%S", years)
+            synthetic_cycle["intervalStartDateFormatted"] = shift_date_string(cycle.get("intervalStartDateFormatted"), "%Y-%m-%d", years)
+            synthetic_cycle["intervalEndDateFormatted"] = shift_date_string(cycle.get("intervalEndDateFormatted"), "%Y-%m-%d", years)
+            # Only the most recent cycle of the real history can be ongoing
+            synthetic_cycle["isOngoingInterval"] = False
+            synthetic_cycles.append(synthetic_cycle)
+
+    amplified["payload"]["usageChartDataList"] = synthetic_cycles + cycles
+    return amplified
+
+
+#Function to synthesise a longer vacation history
+def amplify_vacation_data(data, factor, span_years):
+    """
+    Synthesises a larger vacation payload matching an amplified itemization payload.
+
+    Args:
+        data (dict): The raw vacation JSON data containing bill cycles and vacation timestamps.
+        factor (int): How many times longer the resulting history should be.
+        span_years (int): The number of years each copy is shifted by, as used for the itemization payload.
+
+    Returns:
+        dict: The amplified vacation JSON data.
+    """
+    amplified = copy.deepcopy(data)
+    bill_cycles = amplified["payload"]["billCycles"]
+    if factor <= 1 or not bill_cycles:
+        return amplified
+
+    synthetic_cycles = []
+    for copy_index in range(factor - 1, 0, -1):
+        years = -copy_index * span_years
+        for cycle in data["payload"]["billCycles"]:
+            synthetic_cycle = copy.deepcopy(cycle)
+            synthetic_cycle["billStartDate"] = shift_date_string(cycle.get("billStartDate"), "%Y-%m-%dT%H:%M:%SZ", years)
+            synthetic_cycle["billEndDate"] = shift_date_string(cycle.get("billEndDate"), "%Y-%m-%dT%H:%M:%SZ", years)
+            synthetic_cycle["billStartEpoch"] = shift_epoch(cycle.get("billStartEpoch"), years)
+            synthetic_cycle["billEndEpoch"] = shift_epoch(cycle.get("billEndEpoch"), years)
+            for vacation in synthetic_cycle.get("vacation") or []:
+                vacation["timeStamp"] = shift_epoch(vacation["timeStamp"], years)
+            synthetic_cycles.append(synthetic_cycle)
+
+    amplified["payload"]["billCycles"] = synthetic_cycles + bill_cycles
+    return amplified
+
+
+#Function to synthesise a larger user from its three raw payloads
+def amplify_user_payloads(itemization_data, metadata, vacation_data, factor):
+    """
+    Synthesises a larger user by amplifying the itemization and vacation payloads together.
+
+    Args:
+        itemization_data (dict): The raw itemization JSON data.
+        metadata (dict): The raw metadata JSON data. It is returned unchanged.
+        vacation_data (dict): The raw vacation JSON data.
+        factor (int): How many times longer the resulting history should be.
+
+    Returns:
+        tuple: The amplified (itemization_data, metadata, vacation_data).
+    """
+    span_years = history_span_years(itemization_data)
+    if factor > 1 and itemization_data["payload"]["usageChartDataList"]:
+        # The vacation copies move with the billing cycle copies
+        span_years = copy_shift_years(itemization_data, factor, span_years)
+    return (
+        amplify_itemization_data(itemization_data, factor, span_years),
+        metadata,
+        amplify_vacation_data(vacation_data, factor, span_years),
+    )
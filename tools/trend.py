@@ -0,0 +1,195 @@
+import json
+import re
+
+from dataset import trend_prompt
+from tools.llm import json_mode
+from tools.utils import calculate_difference
+
+# Columns of the compact cycle table sent to the LLM
+TREND_COLUMNS = ["id", "start", "end", "kwh", "cost", "days", "num_holidays", "vacation_days", "temperature", "rate_plan", "category_costs"]
+
+
+def _rate_plan(cycle):
+    if cycle.get("touDetails", "unavailable") != "unavailable":
+        return "tou"
+    if cycle.get("tierDetails", "unavailable") != "unavailable":
+        return "tier"
+    return "unavailable"
+
+
+#Function to summarise the analysis window as a compact table
+def compact_window(json_file):
+    """
+    Turns the billing cycles of the analysis window into one row per cycle (see TREND_COLUMNS), with 1-based ids.
+    Appliance categories are reduced to their usage cost and categories without cost are left out.
+
+    Args:
+        json_file (list of dict): The billing cycles of the analysis window, oldest first.
+
+    Returns:
+        list of list: The rows.
+    """
+    rows = []
+    for i, cycle in enumerate(json_file):
+        itemization = cycle.get("itemizationDetailsList")
+        if isinstance(itemization, dict):
+            category_costs = {category: value[1] for category, value in itemization.items()
+                              if isinstance(value, (list, tuple)) and value[1]}
+        else:
+            category_costs = "unavailable"
+        rows.append([
+            i + 1,
+            cycle["IntervalStartDate"],
+            cycle["IntervalEndDate"],
+            cycle["consumption"],
+            cycle["cost"],
+            cycle["num_days"],
+            cycle["num_holidays"],
+            cycle["num_vacation"],
+            cycle["temperature"],
+            _rate_plan(cycle),
+            category_costs,
+        ])
+    return rows
+
+
+#Function to compute the differences between consecutive cycles
+def consecutive_differences(json_file):
+    """
+    Computes calculate_difference for every cycle of the window against the previous one.
+    Unknown values and categories that did not change are left out.
+
+    Args:
+        json_file (list of dict): The billing cycles of the analysis window, oldest first.
+
+    Returns:
+        list of dict: One entry per cycle after the first, with 'from' and 'to' cycle ids.
+    """
+    differences = []
+    for i in range(1, len(json_file)):
+        difference = calculate_difference(json_file[i - 1], json_file[i])
+        itemization = difference.get("itemizationDetailsList")
+        if isinstance(itemization, dict):
+            difference["itemizationDetailsList"] = {category: value for category, value in itemization.items() if any(value)}
+        compact = {"from": i, "to": i + 1}
+        compact.update((key, value) for key, value in difference.items() if value is not None)
+        differences.append(compact)
+    return differences
+
+
+#Function to build the single trend question of a whole window
+def build_trend_query(json_file, loc):
+    """
+    Builds the input of trend_prompt: the compact cycle table, the consecutive differences and the location.
+
+    Args:
+        json_file (list of dict): The billing cycles of the analysis window, oldest first.
+        loc (dict): The location of the user.
+
+    Returns:
+        str: The question.
+    """
+    data = {
+        "columns": TREND_COLUMNS,
+        "cycles": compact_window(json_file),
+        "differences": consecutive_differences(json_file),
+        "location": loc,
+    }
+    return ("Explain how the cost changed from each billing cycle to the next one over this window. "
+            + json.dumps(data, separators=(",", ":"), default=str))
+
+
+#Function to read the structured trend response of the LLM
+def parse_trend_response(text, num_cycles):
+    """
+    Parses and validates the JSON response of trend_prompt.
+
+    Args:
+        text (str): The response of the LLM. A surrounding markdown code fence is ignored.
+        num_cycles (int): The number of cycles of the window.
+
+    Returns:
+        dict or None: {'summary': str, 'cycles': {cycle id: explanation}}, restricted to the cycles 2 to num_cycles.
+        None if the response is not a JSON object with a summary or per-cycle explanations.
+    """
+    text = re.sub(r"^\s*```(?:json)?\s*|\s*```\s*$", "", text or "")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    explanations = {}
+    for entry in data.get("cycles") or []:
+        if not isinstance(entry, dict):
+            continue
+        cycle, explanation = entry.get("cycle"), entry.get("explanation")
+        if isinstance(cycle, str) and cycle.isdigit():
+            cycle = int(cycle)
+        if isinstance(cycle, int) and 2 <= cycle <= num_cycles and isinstance(explanation, str) and explanation.strip():
+            explanations[cycle] = explanation.strip()
+    summary = data.get("summary") if isinstance(data.get("summary"), str) else ""
+    if not summary and not explanations:
+        return None
+    return {"summary": summary.strip(), "cycles": explanations}
+
+
+#Function to render a trend explanation
+def render_trend(trend, json_file):
+    """
+    Renders a parsed trend response as markdown, one line per cycle with its cost and the change from the
+    previous cycle, computed from the data rather than taken from the LLM.
+
+    Args:
+        trend (dict): The response parsed by parse_trend_response.
+        json_file (list of dict): The billing cycles of the analysis window, oldest first.
+
+    Returns:
+        str: The explanation.
+    """
+    lines = [trend["summary"], ""] if trend["summary"] else []
+    for i in range(1, len(json_file)):
+        cycle, previous = json_file[i], json_file[i - 1]
+        header = f"Cycle {i + 1} ({cycle['IntervalStartDate']} - {cycle['IntervalEndDate']}), ${cycle['cost']}"
+        if isinstance(cycle["cost"], (int, float)) and isinstance(previous["cost"], (int, float)):
+            header += f" ({cycle['cost'] - previous['cost']:+}$ from cycle {i})"
+        explanation = trend["cycles"].get(i + 1, "No explanation was given for this cycle.")
+        lines.append(f"- {header}: {explanation}")
+    return "\n".join(lines)
+
+
+def _trend_result(response, json_file):
+    trend = parse_trend_response(response.content, len(json_file))
+    if trend is None:
+        # Not the requested JSON: show the answer as it is
+        return response.content, None
+    return render_trend(trend, json_file), trend
+
+
+#Function to explain the whole analysis window in one LLM call
+def explain_trend(llm, json_file, loc):
+    """
+    Explains the cost change of every cycle of the window against the previous one with a single trend_prompt call,
+    instead of one first_prompt call per pair of cycles.
+
+    Args:
+        llm (BaseChatModel): The chat model.
+        json_file (list of dict): The billing cycles of the analysis window, oldest first.
+        loc (dict): The location of the user.
+
+    Returns:
+        tuple: (text, trend, response). text is the rendered explanation, or the raw answer if it is not valid JSON.
+        trend is the parsed response, or None. response is the message of the LLM, for usage accounting.
+    """
+    response = (trend_prompt | json_mode(llm)).invoke({"input": build_trend_query(json_file, loc)})
+    return _trend_result(response, json_file) + (response,)
+
+
+#Function to explain the whole analysis window in one LLM call, asynchronously
+async def aexplain_trend(llm, json_file, loc):
+    """
+    Async version of explain_trend.
+    """
+    response = await (trend_prompt | json_mode(llm)).ainvoke({"input": build_trend_query(json_file, loc)})
+    return _trend_result(response, json_file) + (response,)
@@ -0,0 +1,335 @@
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from tabulate import tabulate
+
+from tools.metrics import registry
+from tools.singleflight import SingleFlight
+
+# Megabytes of preprocessed user data kept in memory. Users still open in a session are never evicted,
+# so the store can go above this while more users are open than fit in it.
+USER_STORE_MAX_MB = float(os.getenv("BILL_ANALYZER_USER_STORE_MB", "256"))
+
+# Seconds after which a user is fetched again instead of being served from the store
+USER_STORE_TTL_SECONDS = int(os.getenv("BILL_ANALYZER_USER_STORE_TTL", "3600"))
+
+
+#Function to estimate the memory used by an object
+def footprint(value):
+    """
+    Estimates the bytes of memory held by an object and everything it contains (dicts, lists, tuples and sets),
+    counting objects shared between several containers once.
+
+    Args:
+        value: The object, e.g. the data returned by preprocess.
+
+    Returns:
+        int: The estimated size in bytes.
+    """
+    seen, stack, total = set(), [value], 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return total
+
+
+def _credential_hash(credential):
+    return hashlib.sha256(credential.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    def __init__(self, value, nbytes):
+        self.value = value
+        self.nbytes = nbytes
+        self.refs = 0
+        self.loaded_at = time.monotonic()
+        self.credentials = set()
+
+
+class _LoadError(Exception):
+    # Raised by a coalesced load, with the credential it was loaded with
+    def __init__(self, credential):
+        super().__init__("loading the user failed")
+        self.credential = credential
+
+
+class UserDataRef:
+    """
+    A session's reference to a user of the UserDataStore. The user stays in memory until every reference to it
+    is released, either explicitly or when the reference is garbage collected with the session.
+
+    The value is shared with every other session of the process and must not be modified.
+    """
+    def __init__(self, store, key, entry):
+        self.key = key
+        self.value = entry.value
+        self.loaded_at = entry.loaded_at
+        self._ttl_seconds = store.ttl_seconds
+        self._finalizer = weakref.finalize(self, store._release, key, entry)
+
+    @property
+    def released(self):
+        return not self._finalizer.alive
+
+    @property
+    def expired(self):
+        """
+        True once the user is older than the TTL of the store, and should be acquired again.
+        """
+        return self._ttl_seconds > 0 and time.monotonic() - self.loaded_at > self._ttl_seconds
+
+    def release(self):
+        """
+        Releases the reference. Releasing it again does nothing.
+        """
+        self._finalizer()
+
+
+class UserDataStore:
+    """
+    Process-wide, read-only store of preprocessed users shared by all sessions, instead of one copy per session.
+
+    Sessions acquire a reference to a user (see acquire) and read the shared value through it. Users are kept in least
+    recently used order and evicted once no session references them and the store holds more than max_bytes.
+    Users older than ttl_seconds are loaded again on the next acquire, while the sessions already using the
+    old data keep it until they release it. Sessions acquiring a user that is being loaded wait for that load
+    instead of starting their own (see SingleFlight).
+
+    Args:
+        max_bytes (int, optional): The memory budget, see USER_STORE_MAX_MB.
+        ttl_seconds (int, optional): The age after which a user is reloaded, see USER_STORE_TTL_SECONDS.
+    """
+    def __init__(self, max_bytes=int(USER_STORE_MAX_MB * 1024 * 1024), ttl_seconds=USER_STORE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bytes of every entry still in memory, including replaced entries that sessions still reference
+        self._resident = 0
+        self._refs = 0
+        self._flights = SingleFlight("user_store")
+
+    def _expired(self, entry):
+        return self.ttl_seconds > 0 and time.monotonic() - entry.loaded_at > self.ttl_seconds
+
+    def acquire(self, key, load, credential=None, authorize=None):
+        """
+        Returns a reference to the user stored under key, loading it with load() if it is not in the store.
+
+        When a credential (e.g. the access token of the analyst) is given, a user loaded with another credential is
+        only shared after authorize() confirms that this credential may read it too. The same applies to a load
+        with another credential that this call waited for; if that load failed, the user is loaded with this one.
+
+        Args:
+            key (tuple): Identifies the user, e.g. ('api', env, uuid, HISTORY_WINDOW), or the hash of uploaded payloads.
+            load (callable): Loads the value to store. Concurrent calls for the same key share one load.
+                Exceptions are raised and nothing is stored.
+            credential (str, optional): The credential the user is requested with.
+            authorize (callable, optional): Returns True if the credential may read the stored user.
+                Without it, a user stored under another credential is loaded again.
+
+        Returns:
+            UserDataRef: The reference, to be released when the session no longer needs the user.
+        """
+        credential = _credential_hash(credential) if credential is not None else None
+        entry, needs_authorization = self._lookup(key, credential)
+        if needs_authorization and (authorize is None or not authorize()):
+            entry = None
+        if entry is None:
+            entry = self._load(key, load, credential, authorize)
+        else:
+            registry.increment("bill_analyzer_user_store_total", {"outcome": "hit"})
+        return self._add_ref(key, entry, credential)
+
+    async def aacquire(self, key, load, credential=None, authorize=None):
+        """
+        Async version of acquire, where load and authorize are coroutine functions.
+        """
+        credential = _credential_hash(credential) if credential is not None else None
+        entry, needs_authorization = self._lookup(key, credential)
+        if needs_authorization and (authorize is None or not await authorize()):
+            entry = None
+        if entry is None:
+            entry = await self._aload(key, load, credential, authorize)
+        else:
+            registry.increment("bill_analyzer_user_store_total", {"outcome": "hit"})
+        return self._add_ref(key, entry, credential)
+
+    def _lookup(self, key, credential):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._drop(key, entry)
+                registry.increment("bill_analyzer_user_store_total", {"outcome": "expired"})
+                entry = None
+        return entry, entry is not None and credential is not None and credential not in entry.credentials
+
+    def _load(self, key, load, credential, authorize):
+        def flight():
+            try:
+                return self._loaded(load(), credential)
+            except Exception as e:
+                raise _LoadError(credential) from e
+
+        try:
+            entry = self._flights.do(key, flight)
+        except _LoadError as e:
+            if e.credential == credential:
+                raise e.__cause__ from None
+            # Only the load with another credential failed
+            return self._loaded(load(), credential)
+        if credential is not None and credential not in entry.credentials and (authorize is None or not authorize()):
+            entry = self._loaded(load(), credential)
+        return entry
+
+    async def _aload(self, key, load, credential, authorize):
+        async def flight():
+            try:
+                return self._loaded(await load(), credential)
+            except Exception as e:
+                raise _LoadError(credential) from e
+
+        try:
+            entry = await self._flights.ado(key, flight)
+        except _LoadError as e:
+            if e.credential == credential:
+                raise e.__cause__ from None
+            return self._loaded(await load(), credential)
+        if credential is not None and credential not in entry.credentials and (authorize is None or not await authorize()):
+            entry = self._loaded(await load(), credential)
+        return entry
+
+    def _loaded(self, value, credential=None):
+        registry.increment("bill_analyzer_user_store_total", {"outcome": "miss"})
+        entry = _Entry(value, footprint(value))
+        if credential is not None:
+            entry.credentials.add(credential)
+        return entry
+
+    def _add_ref(self, key, entry, credential):
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not entry:
+                if current is not None and not self._expired(current):
+                    # Loaded by another session meanwhile (and this credential was just authorized by loading it)
+                    entry = current
+                else:
+                    if current is not None:
+                        self._drop(key, current)
+                    self._entries[key] = entry
+                    self._resident += entry.nbytes
+            if credential is not None:
+                entry.credentials.add(credential)
+            entry.refs += 1
+            self._refs += 1
+            self._entries.move_to_end(key)
+            self._evict()
+            self._update_gauges()
+        return UserDataRef(self, key, entry)
+
+    def _drop(self, key, entry):
+        # The lock must be held. Entries still referenced stay resident until released.
+        del self._entries[key]
+        if entry.refs == 0:
+            self._resident -= entry.nbytes
+
+    def _release(self, key, entry):
+        with self._lock:
+            entry.refs -= 1
+            self._refs -= 1
+            if entry.refs == 0 and self._entries.get(key) is not entry:
+                self._resident -= entry.nbytes
+            self._evict()
+            self._update_gauges()
+
+    def _evict(self):
+        # The lock must be held
+        if self._resident <= self.max_bytes:
+            return
+        for key, entry in list(self._entries.items()):
+            if self._resident <= self.max_bytes:
+                break
+            if entry.refs == 0:
+                self._drop(key, entry)
+                registry.increment("bill_analyzer_user_store_total", {"outcome": "evicted"})
+
+    def _update_gauges(self):
+        # The lock must be held
+        registry.set_gauge("bill_analyzer_user_store_bytes", {}, self._resident)
+        registry.set_gauge("bill_analyzer_user_store_users", {}, len(self._entries))
+        registry.set_gauge("bill_analyzer_user_store_refs", {}, self._refs)
+
+    def stats(self):
+        """
+        Returns the resident bytes, the number of stored users, the number of references held by sessions and the
+        number of users being loaded.
+        """
+        with self._lock:
+            stats = {"bytes": self._resident, "users": len(self._entries), "refs": self._refs}
+        stats["loading"] = self._flights.in_flight()
+        return stats
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+#Function to get the user data store of the process
+def get_user_store():
+    """
+    Returns the user data store shared by all sessions of the process.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = UserDataStore()
+        return _store
+
+
+def main():
+    from tools.batch import DEFAULT_DATA_DIR, list_uuids, load_user_payloads
+    from tools.preprocessing import preprocess
+
+    parser = argparse.ArgumentParser(description="Open many sessions on a few users and compare the memory of the "
+                                                 "shared user store with one copy of the data per session.")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--users", type=int, default=3, help="Distinct users opened by the sessions.")
+    parser.add_argument("--sessions", type=int, default=50)
+    args = parser.parse_args()
+
+    uuids = list_uuids(args.data_dir)[:args.users]
+    if not uuids:
+        parser.error(f"No users found in '{args.data_dir}'.")
+    store = UserDataStore()
+    sessions, copies, rows = [], 0, []
+    for i in range(args.sessions):
+        uuid = uuids[i % len(uuids)]
+        sessions.append(store.acquire(("local", uuid), lambda: preprocess(*load_user_payloads(uuid, args.data_dir), True)))
+        copies += footprint(sessions[-1].value)
+        if (i + 1) in (1, len(uuids), 10, args.sessions) or (i + 1) % 25 == 0:
+            stats = store.stats()
+            rows.append([i + 1, stats["users"], f"{stats['bytes'] / 1e6:.2f}", f"{copies / 1e6:.2f}"])
+    print(tabulate(rows, headers=["Sessions", "Users", "Shared store (MB)", "One copy per session (MB)"], tablefmt="grid"))
+
+    for session in sessions:
+        session.release()
+    stats = store.stats()
+    print(f"\nAfter closing every session: {stats['users']} users, {stats['bytes'] / 1e6:.2f} MB, {stats['refs']} references.")
+
+
+if __name__ == "__main__":
+    main()
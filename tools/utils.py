@@ -3,12 +3,16 @@ from datetime import datetime
 import requests 
 import json
 
+from tools.archive import archive_for_file
+
 # Function to load JSON file
 def load_json_file(file_path):
     """
     Loads data from a JSON file.
 
     This function attempts to read a JSON file from the given file path and parse its contents into a dictionary. 
+    If the file is missing but its directory has been converted to an archive ('<directory>.archive', see tools.archive),
+    the payload is read from the archive instead.
     If the file is not found or the contents cannot be decoded as JSON, an appropriate error message is printed and None is returned.
 
     Args:
@@ -22,6 +26,9 @@ def load_json_file(file_path):
             data = json.load(f)
             return data
     except FileNotFoundError:
+        archive, uuid = archive_for_file(file_path)
+        if archive is not None and uuid in archive:
+            return archive.get(uuid)
         print(f"File '{file_path}' not found.")
         return None
     except json.JSONDecodeError:
@@ -154,8 +161,28 @@ def transform_itemization_details(details):
     return {detail["category"]: [int(detail["usage"]), int(detail["cost"])] 
             for detail in details if detail["category"]}
 
+class HostError(Exception):
+    """
+    Raised by the API calls when asked to (raise_host_errors), for a transport error or a 5xx response: a failure of
+    the host rather than of the request, which another host of the environment may answer.
+    """
+
+
+# Epoch seconds (start, end) of the consumption and vacation history fetched for a user
+HISTORY_WINDOW = (0, 1885314000)
+
+#Functions to build the Bidgely API urls of a user's location, consumption and vacation data
+def location_url(uuid, env_url, access_token):
+    return f'{env_url}/meta/users/{uuid}/homes/1?access_token={access_token}'
+
+def itemization_url(uuid, env_url, access_token):
+    return f'{env_url}/v2.0/dashboard/users/{uuid}/usage-chart-details?measurement-type=ELECTRIC&mode=year&start={HISTORY_WINDOW[0]}&end={HISTORY_WINDOW[1]}&date-format=DATE_TIME&locale=en_US&next-bill-cycle=false&show-at-granularity=false&skip-ongoing-cycle=false&access_token={access_token}'
+
+def vacation_url(uuid, env_url, access_token):
+    return f'{env_url}/v3.0/internal/users/{uuid}/homes/1/ELECTRIC/vacation?from={HISTORY_WINDOW[0]}&to={HISTORY_WINDOW[1]}&access_token={access_token}'
+
 #API call to fetch user's location
-def fetch_location(uuid, env_url, access_token):
+def fetch_location(uuid, env_url, access_token, raise_host_errors=False):
     """
     Fetches the user's location using an API call.
 
@@ -163,12 +190,13 @@ def fetch_location(uuid, env_url, access_token):
 
     Args:
         uuid (str): The unique identifier of the user.
+        raise_host_errors (bool, optional): Raise HostError for transport errors and 5xx responses instead of returning None.
 
     Returns:
         dict or None: The dictionary containing the user's location data if the 
         request is successful, or None if an error occurs.
     """
-    api_url = f'{env_url}/meta/users/{uuid}/homes/1?access_token={access_token}'
+    api_url = location_url(uuid, env_url, access_token)
 
     try:
         # Make the request
@@ -181,15 +209,19 @@ def fetch_location(uuid, env_url, access_token):
             return data
         else:
             print(f"Failed to fetch data: {response.status_code}")
+            if raise_host_errors and response.status_code >= 500:
+                raise HostError(f"HTTP {response.status_code}")
             return None
 
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data: {e}")
+        if raise_host_errors:
+            raise HostError(str(e)) from e
         return None
 
     
 #API call to fetch user's consumption data
-def fetch_itemization_data(uuid, env_url, access_token):
+def fetch_itemization_data(uuid, env_url, access_token, raise_host_errors=False):
     """
     Fetches the user's consumption data using an API call.
 
@@ -197,12 +229,13 @@ def fetch_itemization_data(uuid, env_url, access_token):
     
     Args:
         uuid (str): The unique identifier of the user.
+        raise_host_errors (bool, optional): Raise HostError for transport errors and 5xx responses instead of returning None.
 
     Returns:
         dict or None: The dictionary containing the user's consumption data if 
         the request is successful, or None if an error occurs.
     """
-    api_url = f'{env_url}/v2.0/dashboard/users/{uuid}/usage-chart-details?measurement-type=ELECTRIC&mode=year&start=0&end=1885314000&date-format=DATE_TIME&locale=en_US&next-bill-cycle=false&show-at-granularity=false&skip-ongoing-cycle=false&access_token={access_token}'
+    api_url = itemization_url(uuid, env_url, access_token)
     
     try:
         # Make the request
@@ -215,14 +248,18 @@ def fetch_itemization_data(uuid, env_url, access_token):
             return data
         else:
             print(f"Failed to fetch data: {response.status_code}")
+            if raise_host_errors and response.status_code >= 500:
+                raise HostError(f"HTTP {response.status_code}")
             return None
     
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data: {e}")
+        if raise_host_errors:
+            raise HostError(str(e)) from e
         return None
 
 #API call to fetch user's vacation data
-def fetch_vacation_data(uuid, env_url, access_token):
+def fetch_vacation_data(uuid, env_url, access_token, raise_host_errors=False):
     """
     Fetches the user's vacation data using an API call.
 
@@ -230,12 +267,13 @@ def fetch_vacation_data(uuid, env_url, access_token):
     
     Args:
         uuid (str): The unique identifier of the user.
+        raise_host_errors (bool, optional): Raise HostError for transport errors and 5xx responses instead of returning None.
 
     Returns:
         dict or None: The dictionary containing the user's vacation data if 
         the request is successful, or None if an error occurs.
     """
-    api_url = f'{env_url}/v3.0/internal/users/{uuid}/homes/1/ELECTRIC/vacation?from=0&to=1885314000&access_token={access_token}'
+    api_url = vacation_url(uuid, env_url, access_token)
     
     try:
         # Make the request
@@ -248,10 +286,14 @@ def fetch_vacation_data(uuid, env_url, access_token):
             return data
         else:
             print(f"Failed to fetch data: {response.status_code}")
+            if raise_host_errors and response.status_code >= 500:
+                raise HostError(f"HTTP {response.status_code}")
             return None
 
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data: {e}")
+        if raise_host_errors:
+            raise HostError(str(e)) from e
         return None
 
 #Function to calculate the difference between two given billing cycles